@@ -93,6 +93,31 @@ class BrowserTest(unittest.TestCase):
             self._do_test_browser(browser)
 
 
+class BrowserProfileTest(unittest.TestCase):
+    def test_temp_profile_dirs(self):
+        class ProfileBrowser(Browser):
+            name = "profilebrowser"
+            nopath = True
+            needs_temporary_profile_dir = True
+
+        browsers = [ProfileBrowser(BrowserInfo(name="profilebrowser")) for
+                    i in range(2)]
+        for browser in browsers:
+            browser.prepare_launch()
+            self.assertTrue(os.path.isdir(browser.profile_dir))
+        # Instances of the same browser don't share their profile.
+        self.assertNotEqual(browsers[0].profile_dir, browsers[1].profile_dir)
+
+        old_profile_dir = browsers[0].profile_dir
+        browsers[0].prepare_launch()
+        self.assertFalse(os.path.exists(old_profile_dir))
+
+        for browser in browsers:
+            profile_dir = browser.profile_dir
+            browser._remove_temp_profile_dir()
+            self.assertFalse(os.path.exists(profile_dir))
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
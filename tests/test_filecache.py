@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from w3testrunner.filecache import FileCache
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, name, content, mtime=None):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, "wb")
+        f.write(content)
+        f.close()
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_revalidate(self):
+        cache = FileCache()
+        path = self._write("a.html", "first", 1000)
+        cached_file = cache.get(path)
+        self.assertEqual(cached_file.data, "first")
+        self.assertTrue(cache.get(path) is cached_file)
+
+        self._write("a.html", "second", 2000)
+        cached_file2 = cache.get(path)
+        self.assertEqual(cached_file2.data, "second")
+        self.assertNotEqual(cached_file2.etag, cached_file.etag)
+
+        os.remove(path)
+        self.assertEqual(cache.get(path), None)
+        self.assertEqual(cache.get(self.tempdir), None)
+        self.assertEqual(len(cache), 0)
+
+        # Files that are not revalidated are kept as first read.
+        cache = FileCache(revalidate=False)
+        path = self._write("b.html", "first", 1000)
+        cache.get(path)
+        self._write("b.html", "second", 2000)
+        self.assertEqual(cache.get(path).data, "first")
+
+    def test_lru(self):
+        cache = FileCache(max_size=25, max_file_size=15)
+        paths = [self._write("%s.html" % i, "x" * 10) for i in range(3)]
+        big_path = self._write("big.html", "x" * 20)
+
+        self.assertEqual(cache.get(big_path), None)
+        self.assertEqual(len(cache), 0)
+
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+        self.assertEqual(cache.paths(), [paths[0], paths[2]])
+        cache.get(paths[0])
+        self.assertEqual(cache.paths(), [paths[2], paths[0]])
+        self.assertEqual(cache.size, 20)
@@ -15,6 +15,7 @@ from lovely.jsonrpc.proxy import RemoteException
 import w3testrunner
 from w3testrunner import runner
 from w3testrunner.runner import Runner
+from w3testrunner.blobstore import blob_url
 from w3testrunner.browsers.dummy import DummyBrowser
 from w3testrunner.browsers.manager import browsers_manager
 from w3testrunner.teststores import remote
@@ -30,7 +31,16 @@ runner_data_dir = os.path.join(os.path.dirname(__file__), "runner_data")
 class BaseMockOptions(object):
     nouacheck = False
     browser = None
+    browser_instances = 1
+    host = "localhost"
+    port = 8888
+    webapp_workers = 10
     tests_path = None
+    import_state = None
+    import_jobs = 1
+    changed_files = None
+    tests_include = None
+    tests_exclude = None
     timeout = 0
     username = None
     debug = False
@@ -107,6 +117,13 @@ class MockBrowser(BaseMockBrowser):
 #logging.basicConfig(level=logging.DEBUG)
 
 class TestRunner(utils.WTRTestCase):
+    rpc_runner = None
+
+    def tearDown(self):
+        # Free the port for the next tests.
+        if self.rpc_runner:
+            self.rpc_runner.webapp.stop()
+
     def reset_and_load(self, client, runner):
         client.reset()
         runner._set_tests([{
@@ -136,7 +153,7 @@ class TestRunner(utils.WTRTestCase):
         client.set_status(w3testrunner.runner.RUNNING, "Started tests.")
 
     def test_rpc(self):
-        runner = Runner(BaseMockOptions(), start_loop=False)
+        runner = self.rpc_runner = Runner(BaseMockOptions(), start_loop=False)
         self.assertEqual(runner.status, w3testrunner.runner.STOPPED)
 
         client = proxy.ServerProxy('http://localhost:8888/rpc', json_impl=json)
@@ -238,6 +255,122 @@ class TestRunner(utils.WTRTestCase):
         })
         runner.options.timeout = 0
 
+    def test_ephemeral_port(self):
+        class MockOptions(BaseMockOptions):
+            port = 0
+            tests_path = os.path.join(runner_data_dir, "sample_tests_0")
+
+        runner = Runner(MockOptions(), start_loop=False)
+        server_url = runner.webapp.server_url
+        try:
+            self.assertNotEqual(runner.webapp.server_port, 8888)
+            self.assertEqual(server_url, "http://localhost:%s/" %
+                                         runner.webapp.server_port)
+
+            client = proxy.ServerProxy(server_url + "rpc", json_impl=json)
+            state = client.get_state()
+            self.assertEqual(len(state["tests"]), 3)
+            for test in state["tests"]:
+                self.assertTrue(test["url"].startswith(server_url))
+        finally:
+            urllib2.urlopen(server_url + "stop").read()
+
+    def test_state_snapshot(self):
+        class MockOptions(BaseMockOptions):
+            port = 0
+            tests_path = os.path.join(runner_data_dir, "sample_tests_0")
+
+        runner = Runner(MockOptions(), start_loop=False)
+        try:
+            runner.set_status(w3testrunner.runner.RUNNING, "Started tests.")
+            tests = runner.get_state()["tests"]
+            # No copy of the tests is kept between calls.
+            self.assertFalse(runner.get_state()["tests"] is tests)
+            self.assertEqual(runner.get_state()["tests"], tests)
+
+            runner.test_started("test_mochi_pass.html")
+            runner.set_result("test_mochi_pass.html", {"status": "pass"}, True)
+            new_tests = runner.get_state()["tests"]
+            # The previous state isn't modified.
+            self.assertFalse([t for t in tests if "result" in t])
+            self.assertEqual([t["result"] for t in new_tests if "result" in t],
+                             [{"status": "pass"}])
+
+            runner.clear_results()
+            self.assertFalse([t for t in runner.get_state()["tests"] if
+                              "result" in t])
+        finally:
+            urllib2.urlopen(runner.webapp.server_url + "stop").read()
+
+    def test_release_blobs(self):
+        class MockOptions(BaseMockOptions):
+            port = 0
+            tests_path = os.path.join(runner_data_dir, "sample_tests_0")
+
+        runner = Runner(MockOptions(), start_loop=False)
+        blob_store = runner.webapp.blob_store
+        def set_screenshot_result(testid, data):
+            runner.test_started(testid)
+            runner.set_result(testid, {
+                "status": "pass",
+                "image1": blob_url(blob_store.put(data)),
+            }, True)
+
+        try:
+            runner.set_status(w3testrunner.runner.RUNNING, "Started tests.")
+            set_screenshot_result("test_mochi_pass.html", "image")
+            self.assertEqual(len(blob_store), 1)
+
+            # Clearing a result drops its screenshots.
+            runner.set_result("test_mochi_pass.html", None, False)
+            self.assertEqual(len(blob_store), 0)
+
+            # A result ignored after a hang.
+            runner.test_started("test_mochi_pass.html")
+            runner.workers[0].running_test = None
+            runner.workers[0].last_hung_testid = "test_mochi_pass.html"
+            runner.set_result("test_mochi_pass.html", {
+                "status": "pass",
+                "image1": blob_url(blob_store.put("image")),
+            }, True)
+            self.assertEqual(len(blob_store), 0)
+
+            set_screenshot_result("test_mochi_pass.html", "image")
+            runner.clear_results()
+            self.assertEqual(len(blob_store), 0)
+
+            set_screenshot_result("test_mochi_pass.html", "image")
+            runner.reset()
+            self.assertEqual(len(blob_store), 0)
+        finally:
+            urllib2.urlopen(runner.webapp.server_url + "stop").read()
+
+    def test_hang_watchdog(self):
+        expired = []
+        expired_event = threading.Event()
+        def callback(key, token):
+            if watchdog.expire(key, token):
+                expired.append(key)
+                expired_event.set()
+
+        watchdog = runner.HangWatchdog(callback)
+        try:
+            watchdog.arm("a", 0.3)
+            watchdog.arm("b", 0.1)
+            watchdog.arm("c", 0.2)
+            self.assertTrue(watchdog.disarm("c"))
+            self.assertFalse(watchdog.disarm("c"))
+            # Arming again replaces the previous deadline.
+            watchdog.arm("b", 0.4)
+            for i in range(2):
+                expired_event.wait(2)
+                expired_event.clear()
+            self.assertEqual(expired, ["a", "b"])
+            self.assertFalse(watchdog.disarm("a"))
+            self.assertEqual(watchdog.entries, {})
+        finally:
+            watchdog.stop()
+
     def _exercise_browsers(self, mockbrowser_class, callback):
         browser_names = utils.browser_names_to_test()
 
@@ -415,6 +548,89 @@ class TestRunner(utils.WTRTestCase):
         self._exercise_browsers(MockBrowserTimingOut, test_browser)
 
 
+    def _run_several_browsers(self, browsers, browser_instances):
+        finished_events = []
+        running_tests = []
+        overlaps = []
+        front_workers = []
+
+        class MockBrowserDispatched(BaseMockBrowser):
+            def __init__(self, *args, **kwargs):
+                super(MockBrowserDispatched, self).__init__(*args, **kwargs)
+                self.finished_event = threading.Event()
+                finished_events.append(self.finished_event)
+
+            def on_webapp_ready(self):
+                try:
+                    self._run_tests()
+                except Exception, e:
+                    # The runner may already be stopped when asking for a
+                    # test after the last one.
+                    log.debug("Exception when running tests: %s", e)
+                finally:
+                    self.finished_event.set()
+
+            def _maximize_and_move_front(self):
+                front_workers.append(self.worker_id)
+
+            def _run_tests(self):
+                while True:
+                    res = self.client.next_test(self.worker_id)
+                    if res["wait"]:
+                        time.sleep(0.1)
+                        continue
+                    if not res["testid"]:
+                        break
+                    self.client.test_started(res["testid"])
+                    running_tests.append(res["testid"])
+                    if len(running_tests) > 1 and [
+                        t for t in running_tests if "reftest" in t]:
+                        overlaps.append(list(running_tests))
+                    time.sleep(0.3)
+                    running_tests.remove(res["testid"])
+                    self.client.set_result(res["testid"], {
+                        u'status': u'pass',
+                        u'worker': self.worker_id,
+                    }, True)
+
+        class MockOptions(BaseMockOptions):
+            browser = browsers
+            tests_path = os.path.join(runner_data_dir, "sample_tests_0")
+        MockOptions.browser_instances = browser_instances
+
+        old_browser_classes = browsers_manager.browser_classes[:]
+        browsers_manager.browser_classes.insert(0, MockBrowserDispatched)
+        try:
+            runner = Runner(MockOptions(), start_loop=False)
+            runner.end_event.wait()
+            for event in finished_events:
+                event.wait(10)
+        finally:
+            browsers_manager.browser_classes = old_browser_classes
+
+        self.assertEqual(len(runner.workers), 2)
+        saved_tests = runner.test_store.saved_tests
+        self.assertEqual(len(saved_tests), 3)
+        for test in saved_tests:
+            self.assertEqual(test["result"]["status"], "pass")
+        # Each browser ran some of the tests.
+        self.assertEqual(set(t["result"]["worker"] for t in saved_tests),
+                         set([0, 1]))
+        # The reftest had the screen for itself, with its browser in front.
+        self.assertEqual(overlaps, [])
+        self.assertEqual(front_workers, [t["result"]["worker"] for t in
+                                         saved_tests if t["type"] == "reftest"])
+        return runner
+
+    def test_batch_several_browsers(self):
+        # The same browser given twice runs two instances.
+        runner = self._run_several_browsers(["mockbrowser", "mockbrowser"], 1)
+        self.assertEqual([b.pooled for b in runner.browsers], [True, True])
+
+    def test_batch_browser_instances(self):
+        runner = self._run_several_browsers("mockbrowser", 2)
+        self.assertEqual([b.pooled for b in runner.browsers], [True, True])
+
     @classmethod
     def setup_class(cls):
         cls.store_server = test_remote.StoreServer()
@@ -480,6 +696,10 @@ class TestRunner(utils.WTRTestCase):
                 remote_url = test_remote.STORE_SERVER_URL
                 filter_types = None
                 filter_count = 50
+                batch_duration = 0
+                stream_interval = 0
+                compress = False
+                no_prefetch = False
 
             self.assertEqual(len(self.store_server.load_requests), 0)
             runner = Runner(MockOptions(), start_loop=False)
@@ -530,6 +750,86 @@ class TestRunner(utils.WTRTestCase):
 
         self._exercise_browsers(MockBrowser, test_browser)
 
+    def test_batch_pipelined_remote_store(self):
+        class MockBrowserKeptAlive(BaseMockBrowser):
+            launch_count = 0
+
+            def launch(self):
+                MockBrowserKeptAlive.launch_count += 1
+                super(MockBrowserKeptAlive, self).launch()
+
+            def on_webapp_ready(self):
+                while True:
+                    res = self.client.next_test(None)
+                    if res["wait"]:
+                        time.sleep(0.1)
+                        continue
+                    if not res["testid"]:
+                        break
+                    self.client.test_started(res["testid"])
+                    self.client.set_result(res["testid"],
+                                           {u'status': u'pass'}, True)
+
+        def make_batch(testids):
+            return {
+                "error": None,
+                "proxy_mappings": [
+                    ("http://localhost:8888/", "/sample_tests_0/"),
+                ],
+                "tests": [{
+                    'id': testid,
+                    'full_id': testid,
+                    'file': testid,
+                    'type': 'mochitest',
+                    'url': 'http://localhost:8888/' + testid,
+                } for testid in testids],
+            }
+
+        self.store_server.tests_path = runner_data_dir
+        self.store_server.tests_data = [
+            make_batch(["test_mochi_pass.html"]),
+            make_batch(["test_browser_pass.html", "test_frame_escape.html"]),
+            {"error": None, "tests": []},
+        ]
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+
+        class MockOptions(BaseMockOptions):
+            browser = "mockbrowser"
+            username = "alice"
+            token = "a_token"
+            remote_url = test_remote.STORE_SERVER_URL
+            filter_types = None
+            filter_count = 50
+            batch_duration = 0
+            stream_interval = 0
+            compress = False
+            no_prefetch = False
+
+        old_browser_classes = browsers_manager.browser_classes[:]
+        browsers_manager.browser_classes.insert(0, MockBrowserKeptAlive)
+        try:
+            runner = Runner(MockOptions(), start_loop=False)
+            runner.end_event.wait()
+        finally:
+            browsers_manager.browser_classes = old_browser_classes
+
+        try:
+            # The browser was launched once and ran the tests of both batches.
+            self.assertEqual(MockBrowserKeptAlive.launch_count, 1)
+            self.assertEqual(len(self.store_server.load_requests), 3)
+            self.assertEqual(
+                [[r["testid"] for r in request["results"]] for
+                 request in self.store_server.save_requests],
+                [["test_mochi_pass.html"],
+                 ["test_browser_pass.html", "test_frame_escape.html"]])
+            for request in self.store_server.save_requests:
+                for result in request["results"]:
+                    self.assertEqual(result["status"], "pass")
+        finally:
+            self.store_server.reset()
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -1,8 +1,15 @@
+import hashlib
 import os
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 
-from w3testrunner.teststores.local import LocalTestStore
+from w3testrunner.teststores.local import LocalTestStore, ImportedTest, \
+                                         ResourceGraph, ReftestManifest, \
+                                         file_signature, parse_changes, \
+                                         PathFilter
 
 try:
     from test_webapp import MockWebApp
@@ -72,3 +79,439 @@ class LocalTestsLoaderTest(utils.WTRTestCase):
 
         store.cleanup()
         self.assertEqual(runner.webapp.tests_path, None)
+
+    def test_import_state(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tests_dir = os.path.join(tmp_dir, "sample_tests_0")
+            shutil.copytree(os.path.join(local_data_dir, "sample_tests_0"),
+                            tests_dir)
+            store_info = {
+                "type": "local",
+                "path": tests_dir,
+                "import_state": os.path.join(tmp_dir, "import_state.pickle"),
+            }
+
+            created_tests = []
+            def load():
+                del created_tests[:]
+                store = LocalTestStore(MockRunner(), store_info)
+                tests = store.load({})
+                store.cleanup()
+                return sorted(t["id"] for t in tests)
+
+            old_fixup_test = ImportedTest._fixup_test
+            def fixup_test(itest, test, *args, **kwargs):
+                created_tests.append(test)
+                return old_fixup_test(itest, test, *args, **kwargs)
+            ImportedTest._fixup_test = fixup_test
+            try:
+                expected_ids = [
+                    "reftests/reftest:a3e11f282c81ad5492950595618f9ed1",
+                    "test_browser_pass.html",
+                    "test_mochi_pass.html",
+                ]
+                self.assertEqual(load(), expected_ids)
+                # foo.html is a layouttest which is created but not loaded.
+                self.assertEqual(len(created_tests), 4)
+                self.assertTrue(os.path.isfile(store_info["import_state"]))
+
+                self.assertEqual(load(), expected_ids)
+                self.assertEqual(created_tests, [])
+
+                # Modifying a resource used by a test should only recreate
+                # that test.
+                ref_path = os.path.join(tests_dir, "reftests", "ref_pass.html")
+                with open(ref_path, "a") as f:
+                    f.write("<!-- modified -->")
+                mtime = time.time() + 10
+                os.utime(ref_path, (mtime, mtime))
+                self.assertEqual(load(), expected_ids)
+                self.assertEqual([t.type for t in created_tests], ["reftest"])
+
+                # Removing a file only rescans the files of its directory.
+                os.remove(os.path.join(tests_dir, "test_mochi_pass.html"))
+                self.assertEqual(load(), expected_ids[:-1])
+                self.assertEqual(sorted(t.type for t in created_tests),
+                                 ["browsertest", "layouttest"])
+            finally:
+                ImportedTest._fixup_test = old_fixup_test
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_parallel_extraction(self):
+        tests_dir = os.path.join(local_data_dir, "sample_tests_0")
+
+        def load(jobs):
+            store_info = {
+                "type": "local",
+                "path": tests_dir,
+                "import_jobs": jobs,
+            }
+            store = LocalTestStore(MockRunner(), store_info)
+            tests = store.load({})
+            store.cleanup()
+            return tests
+
+        serial_tests = load(1)
+        self.assertEqual(len(serial_tests), 3)
+        self.assertEqual(load(2).to_list(), serial_tests.to_list())
+
+    def test_resource_graph(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            files = {
+                "test_a.html": "<script src='common/shared.js'></script>",
+                "test_b.html": "<script src='/common/shared.js'></script>"
+                               "<link href='missing.css'>",
+                "common/shared.js": "// <img src='image.png'>",
+                "common/image.png": "",
+            }
+            os.mkdir(os.path.join(tmp_dir, "common"))
+            for path, content in files.iteritems():
+                with open(os.path.join(tmp_dir, path), "w") as f:
+                    f.write(content)
+
+            graph = ResourceGraph(tmp_dir)
+            scanned = []
+            old_scan_file = graph._scan_file
+            def scan_file(resource):
+                scanned.append(resource)
+                return old_scan_file(resource)
+            graph._scan_file = scan_file
+
+            self.assertEqual(graph.get_related_resources("test_a.html"), (
+                frozenset(["test_a.html", "common/shared.js",
+                           "common/image.png"]),
+                frozenset()))
+            self.assertEqual(graph.get_related_resources("test_b.html"), (
+                frozenset(["test_b.html", "common/shared.js",
+                           "common/image.png"]),
+                frozenset(["missing.css"])))
+            self.assertEqual(sorted(scanned),
+                             ["common/shared.js", "test_a.html",
+                              "test_b.html"])
+
+            self.assertEqual(graph.get_text_markers("common/shared.js"),
+                             frozenset())
+            self.assertEqual(graph.get_digest("common/image.png"),
+                             hashlib.md5("").hexdigest())
+            self.assertEqual(graph.get_digest("missing.css"), None)
+            self.assertEqual(sorted(scanned),
+                             ["common/image.png", "common/shared.js",
+                              "test_a.html", "test_b.html"])
+
+            # File information is reused when given to a new graph.
+            del scanned[:]
+            graph2 = ResourceGraph(tmp_dir, graph.get_used_file_infos())
+            graph2._scan_file = scan_file
+            self.assertEqual(graph2.get_related_resources("test_b.html"),
+                             graph.get_related_resources("test_b.html"))
+            self.assertEqual(graph2.get_digest("test_b.html"),
+                             graph.get_digest("test_b.html"))
+            self.assertEqual(scanned, [])
+
+            # Only the files used since the previous call are returned.
+            self.assertEqual(sorted(graph2.pop_new_used_file_infos()),
+                             ["common/shared.js", "test_b.html"])
+            graph2.get_related_resources("test_a.html")
+            self.assertEqual(graph2.pop_new_used_file_infos().keys(),
+                             ["test_a.html"])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_resource_graph_text_markers(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp_dir, "test.html"), "w") as f:
+                f.write("<script>layoutTestController.waitUntilDone();"
+                        " alert('x'); netscape.security.foo</script>")
+            with open(os.path.join(tmp_dir, "test2.html"), "w") as f:
+                f.write("layoutTestController.confirm(1);prompt ('x');"
+                        "reftest-waiting reftest-print")
+            graph = ResourceGraph(tmp_dir)
+            self.assertEqual(graph.get_text_markers("test.html"), frozenset([
+                "layoutTestController.waitUntilDone", "alert(",
+                "netscape.security"]))
+            self.assertEqual(graph.get_text_markers("test2.html"), frozenset([
+                "layoutTestController.confirm", "confirm(", "reftest-wait",
+                "reftest-print"]))
+
+            # A dialog call at the very start of a file is found too.
+            with open(os.path.join(tmp_dir, "test3.js"), "w") as f:
+                f.write("alert('x'); foo.prompt(1); noconfirm(2)")
+            graph = ResourceGraph(tmp_dir)
+            self.assertEqual(graph.get_text_markers("test3.js"), frozenset([
+                "alert(", "prompt("]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_reftest_manifest(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            manifest_path = os.path.join(tmp_dir, "reftest.list")
+            with open(manifest_path, "w") as f:
+                f.write("# comment\n"
+                        "\n"
+                        "== a.html a-ref.html # trailing comment\n"
+                        "fails random-if(foo) != b.html?x b-ref.html\n"
+                        "HTTP(../..) load c.html\n")
+            signature = file_signature(manifest_path)
+            manifest = ReftestManifest.load(tmp_dir, "reftest.list",
+                                            signature)
+            self.assertEqual([(line_no, line) for (line_no, line, reftest) in
+                              manifest.entries], [
+                (3, "== a.html a-ref.html"),
+                (4, "fails random-if(foo) != b.html?x b-ref.html"),
+                (5, "HTTP(../..) load c.html")])
+            reftests = [reftest for (line_no, line, reftest) in
+                        manifest.entries]
+            self.assertEqual(reftests[0]["equal"], True)
+            self.assertEqual(reftests[0]["file2"], "a-ref.html")
+            self.assertEqual(reftests[1]["equal"], False)
+            self.assertEqual(reftests[1]["file"], "b.html")
+            self.assertEqual(reftests[1]["failure_types"],
+                             " fails random-if(foo)")
+            self.assertEqual(reftests[2]["expected"],
+                             ReftestManifest.EXPECTED_LOAD)
+
+            # Unchanged manifests are not parsed again.
+            self.assertTrue(ReftestManifest.load(tmp_dir, "reftest.list",
+                                                 signature) is manifest)
+            with open(manifest_path, "a") as f:
+                f.write("== d.html d-ref.html\n")
+            manifest2 = ReftestManifest.load(tmp_dir, "reftest.list",
+                                             file_signature(manifest_path))
+            self.assertEqual(len(manifest2.entries), 4)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_reftest_includes(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tests_dir = os.path.join(tmp_dir, "tests")
+            files = {
+                "reftest.list": "== a.html a.html\n"
+                                "include sub/extra.list\n"
+                                "include sub/reftest.list\n"
+                                "include missing.list\n",
+                "a.html": "",
+                "sub/b.html": "",
+                "sub/c.html": "",
+                "sub/extra.list": "== b.html b.html\n"
+                                  "include more.list\n",
+                # Cyclic include.
+                "sub/more.list": "include extra.list\n",
+                "sub/reftest.list": "== c.html c.html\n",
+            }
+            os.makedirs(os.path.join(tests_dir, "sub"))
+            for path, content in files.iteritems():
+                with open(os.path.join(tests_dir, path), "w") as f:
+                    f.write(content)
+            store_info = {
+                "type": "local",
+                "path": tests_dir,
+                "import_state": os.path.join(tmp_dir, "import_state.pickle"),
+            }
+
+            def load():
+                store = LocalTestStore(MockRunner(), store_info)
+                tests = store.load({})
+                store.cleanup()
+                return sorted(t["full_id"] for t in tests)
+
+            self.assertEqual(load(), [
+                "reftest:== a.html a.html",
+                "sub/reftest:== b.html b.html",
+                "sub/reftest:== c.html c.html",
+            ])
+
+            # Changes to included manifests are found with an import state.
+            def write(path, content):
+                full_path = os.path.join(tests_dir, path)
+                with open(full_path, "w") as f:
+                    f.write(content)
+                mtime = time.time() + 10
+                os.utime(full_path, (mtime, mtime))
+            write("sub/more.list", "include extra.list\n== b.html c.html\n")
+            write("missing.list", "load a.html\n")
+            self.assertEqual(load(), [
+                "reftest:== a.html a.html",
+                "reftest:load a.html",
+                "sub/reftest:== b.html b.html",
+                "sub/reftest:== b.html c.html",
+                "sub/reftest:== c.html c.html",
+            ])
+
+            # The manifests not included from the root manifest are ignored.
+            os.makedirs(os.path.join(tests_dir, "other"))
+            write("other/reftest.list", "== ../a.html ../a.html\n")
+            write("reftest.list", "== a.html a.html\n"
+                                  "include sub/reftest.list\n")
+            self.assertEqual(load(), [
+                "reftest:== a.html a.html",
+                "sub/reftest:== c.html c.html",
+            ])
+            write("reftest.list", "include other/reftest.list\n"
+                                  "include sub/extra.list\n")
+            self.assertEqual(load(), [
+                "other/reftest:== ../a.html ../a.html",
+                "sub/reftest:== b.html b.html",
+                "sub/reftest:== b.html c.html",
+            ])
+
+            # A filtered load imports the included manifests of the subtree.
+            store_info["include"] = ["sub"]
+            self.assertEqual(load(), [
+                "sub/reftest:== b.html b.html",
+                "sub/reftest:== b.html c.html",
+            ])
+            del store_info["include"]
+
+            # Without a root manifest, each reftest.list imports its tests.
+            os.remove(os.path.join(tests_dir, "reftest.list"))
+            self.assertEqual(load(), [
+                "other/reftest:== ../a.html ../a.html",
+                "sub/reftest:== c.html c.html",
+            ])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_parse_changes(self):
+        self.assertEqual(parse_changes(["a.html\n", "\n", "dir/b.html\n"]),
+                         {"a.html": None, "dir/b.html": None})
+
+        diff = """diff --git a/reftests/reftest.list b/reftests/reftest.list
+index 1234567..89abcde 100644
+--- a/reftests/reftest.list
++++ b/reftests/reftest.list
+@@ -1,2 +1,2 @@
+ == a.html a.html
+--- b.html b.html
++== c.html c.html
+diff --git a/image.png b/image.png
+Binary files a/image.png and b/image.png differ
+diff --git a/removed.html b/removed.html
+deleted file mode 100644
+--- a/removed.html
++++ /dev/null
+@@ -1 +0,0 @@
+-<p>removed
+"""
+        self.assertEqual(parse_changes(diff.splitlines(True)), {
+            "reftests/reftest.list": ["--- b.html b.html",
+                                      "+== c.html c.html"],
+            "image.png": None,
+            "removed.html": ["-<p>removed"],
+        })
+
+    def test_changed_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tests_dir = os.path.join(tmp_dir, "sample_tests_0")
+            shutil.copytree(os.path.join(local_data_dir, "sample_tests_0"),
+                            tests_dir)
+            changes_path = os.path.join(tmp_dir, "changes")
+            store_info = {
+                "type": "local",
+                "path": tests_dir,
+                "import_state": os.path.join(tmp_dir, "import_state.pickle"),
+            }
+
+            created_tests = []
+            def load(changes=None):
+                del created_tests[:]
+                info = dict(store_info)
+                if changes is not None:
+                    with open(changes_path, "w") as f:
+                        f.write(changes)
+                    info["changed_files"] = changes_path
+                store = LocalTestStore(MockRunner(), info)
+                tests = store.load({})
+                store.cleanup()
+                return sorted(t["full_id"] for t in tests)
+
+            old_fixup_test = ImportedTest._fixup_test
+            def fixup_test(itest, test, *args, **kwargs):
+                created_tests.append(test)
+                return old_fixup_test(itest, test, *args, **kwargs)
+            ImportedTest._fixup_test = fixup_test
+            try:
+                full_ids = load()
+                self.assertEqual(len(created_tests), 4)
+
+                # Only the added reftest line is imported.
+                with open(os.path.join(tests_dir, "reftests", "reftest.list"),
+                          "a") as f:
+                    f.write("!= ref_pass.html about:blank\n")
+                full_ids.append("reftests/reftest:!= ref_pass.html about:blank")
+                self.assertEqual(load("--- a/reftests/reftest.list\n"
+                                      "+++ b/reftests/reftest.list\n"
+                                      "@@ -1 +1,2 @@\n"
+                                      " == ref_pass.html ref_pass.html\n"
+                                      "+!= ref_pass.html about:blank\n"),
+                                 sorted(full_ids))
+                self.assertEqual([t.full_id for t in created_tests],
+                                 [full_ids[-1]])
+
+                # Tests depending on a changed file are imported again.
+                self.assertEqual(load("reftests/ref_pass.html\n"),
+                                 sorted(full_ids))
+                self.assertEqual(len(created_tests), 2)
+
+                # Removing a file rescans the files of its directory.
+                os.remove(os.path.join(tests_dir, "test_mochi_pass.html"))
+                full_ids.remove("test_mochi_pass.html")
+                self.assertEqual(load("test_mochi_pass.html\n"),
+                                 sorted(full_ids))
+                self.assertEqual(sorted(t.type for t in created_tests),
+                                 ["browsertest", "layouttest"])
+
+                # The result is the same as with a full load.
+                self.assertEqual(load(), sorted(full_ids))
+                self.assertEqual(created_tests, [])
+            finally:
+                ImportedTest._fixup_test = old_fixup_test
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_path_filter(self):
+        path_filter = PathFilter(["reftests", "css/*/bugs/"], ["css/21/bugs"])
+        self.assertTrue(path_filter.is_selected("reftests/reftest.list"))
+        self.assertTrue(path_filter.is_selected("css/3/bugs/a/test.html"))
+        self.assertFalse(path_filter.is_selected("css/21/bugs/test.html"))
+        self.assertFalse(path_filter.is_selected("css/3/test.html"))
+        self.assertFalse(path_filter.is_selected("test.html"))
+        self.assertTrue(path_filter.may_select_under("css"))
+        self.assertTrue(path_filter.may_select_under("css/3"))
+        self.assertTrue(path_filter.may_select_under("css/3/bugs/a"))
+        self.assertFalse(path_filter.may_select_under("css/21/bugs"))
+        self.assertFalse(path_filter.may_select_under("css/3/other"))
+        self.assertFalse(path_filter.may_select_under("mochitests"))
+
+        path_filter = PathFilter(exclude=["*.html"])
+        self.assertTrue(path_filter.is_selected("reftests/test.html"))
+        self.assertFalse(path_filter.is_selected("test.html"))
+
+    def test_load_filtered(self):
+        tests_dir = os.path.join(local_data_dir, "sample_tests_0")
+
+        def load(include=None, exclude=None):
+            store_info = {
+                "type": "local",
+                "path": tests_dir,
+                "include": include,
+                "exclude": exclude,
+            }
+            store = LocalTestStore(MockRunner(), store_info)
+            tests = store.load({})
+            store.cleanup()
+            return sorted(t["id"] for t in tests)
+
+        self.assertEqual(load(include=["reftests"]),
+                         ["reftests/reftest:a3e11f282c81ad5492950595618f9ed1"])
+        self.assertEqual(load(include=["test_*.html"],
+                              exclude=["test_browser*"]),
+                         ["test_mochi_pass.html"])
+        self.assertEqual(load(exclude=["reftests", "test_mochi_pass.html"]),
+                         ["test_browser_pass.html"])
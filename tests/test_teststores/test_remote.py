@@ -1,25 +1,31 @@
 import BaseHTTPServer
 import errno
+import hashlib
 import httplib
 import logging
 import posixpath
 import os
 import signal
+import socket
 from SimpleHTTPServer import SimpleHTTPRequestHandler
+import SocketServer
 import sys
 import threading
 import time
 import unittest
 import urllib
 import urllib2
+import zlib
 try:
     import simplejson as json
 except ImportError:
     import json # Python >= 2.6
 
+from w3testrunner.blobstore import BlobStore, blob_url
 from w3testrunner.webapp import PortCheckerMixin
 from w3testrunner.teststores.common import StoreException
-from w3testrunner.teststores.remote import RemoteTestStore
+from w3testrunner.teststores.remote import RemoteTestStore, \
+                                           HTTPConnectionPool
 
 try:
     from test_webapp import MockWebApp
@@ -39,7 +45,13 @@ remote_data_dir = os.path.join(os.path.dirname(__file__), "remote_data")
 
 class HTTPHandler(SimpleHTTPRequestHandler):
 
-    SUPPORTED_PROTOCOL_VERSION = 1
+    SUPPORTED_PROTOCOL_VERSION = 2
+    # Keep-alive connections.
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        SimpleHTTPRequestHandler.setup(self)
+        self.server.store_server.connection_count += 1
 
     def send_head(self):
         if not self.server.store_server.tests_path:
@@ -78,12 +90,48 @@ class HTTPHandler(SimpleHTTPRequestHandler):
         return self.server.store_server.tests_data.pop(0)
 
     def _save_results(self, request):
-        self.server.store_server.save_requests.append(request)
+        store_server = self.server.store_server
+        if request.get("partial") and store_server.partial_save_error:
+            store_server.failed_requests.append(request)
+            time.sleep(store_server.partial_save_delay)
+            return {
+                "error": store_server.partial_save_error,
+            }
+        store_server.save_requests.append(request)
+        return {
+            "error": None,
+        }
+
+    def _save_blob(self):
+        length = int(self.headers["content-length"])
+        body = self.rfile.read(length)
+        store_server = self.server.store_server
+        store_server.request_sizes.append(length)
+        if (self.headers.get("x-protocol-version") !=
+            str(self.SUPPORTED_PROTOCOL_VERSION)):
+            return {
+                "error": "Unsupported protocol version"
+            }
+        username = self.headers.get("x-username")
+        if (not username in store_server.credentials or
+            store_server.credentials[username] !=
+            self.headers.get("x-token")):
+            return {
+                "error": "Invalid username or token"
+            }
+        blob_id = self.path[len("/blob/"):]
+        if hashlib.sha1(body).hexdigest() != blob_id:
+            return {
+                "error": "Blob content doesn't match its identifier"
+            }
+        store_server.blobs[blob_id] = body
         return {
             "error": None,
         }
 
     def _handle_request(self):
+        if self.path.startswith("/blob/"):
+            return self._save_blob()
         if self.headers["content-type"].lower() != "application/json":
             return {
                 "error": "Content-type must be application/json"
@@ -91,6 +139,9 @@ class HTTPHandler(SimpleHTTPRequestHandler):
 
         length = int(self.headers["content-length"])
         body = self.rfile.read(length)
+        self.server.store_server.request_sizes.append(length)
+        if self.headers.get("content-encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
         try:
             request = json.loads(body)
         except ValueError, e:
@@ -135,17 +186,42 @@ class HTTPHandler(SimpleHTTPRequestHandler):
         return SimpleHTTPRequestHandler.do_GET(self)
 
     def do_POST(self):
-        response = self._handle_request()
+        store_server = self.server.store_server
+        if store_server.error_statuses:
+            status = store_server.error_statuses.pop(0)
+            if status == 503:
+                # Not handled.
+                self.rfile.read(int(self.headers["content-length"]))
+            else:
+                # Handled, but failed afterwards.
+                self._handle_request()
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        response = json.dumps(self._handle_request())
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("accept-encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            response = compressor.compress(response) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(response)))
         self.end_headers()
 
-        self.wfile.write(json.dumps(response))
+        self.wfile.write(response)
 
     def log_message(self, format, *args):
         pass
 
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    # Keep-alive connections stay open in their thread until the client
+    # closes them.
+    daemon_threads = True
+
 class StoreServer(PortCheckerMixin):
     """Simple HTTP Server implementing the remote store protocol for testing."""
 
@@ -156,14 +232,14 @@ class StoreServer(PortCheckerMixin):
         self.reset()
         self.server_port = STORE_SERVER_PORT
 
-        self.check_free_port()
+        self.check_port_available()
         threading.Thread(target=self._start).start()
         self.check_server_started()
 
     def _start(self):
         self.httpd_running = True
         server_address = ("", STORE_SERVER_PORT)
-        self.httpd = BaseHTTPServer.HTTPServer(server_address, HTTPHandler)
+        self.httpd = ThreadingHTTPServer(server_address, HTTPHandler)
         self.httpd.store_server = self
         self.ready_event.set()
         while self.httpd_running:
@@ -191,12 +267,25 @@ class StoreServer(PortCheckerMixin):
         }
         self.load_requests = []
         self.save_requests = []
+        # Partial saves fail with this error, after the delay, if it is set.
+        self.partial_save_error = None
+        self.partial_save_delay = 0
+        self.failed_requests = []
+        # HTTP statuses of the error responses to send to the next POST
+        # requests.
+        self.error_statuses = []
+        self.blobs = {}
         self.tests_path = None
+        # Number of connections accepted and size of the request bodies
+        # received, to check what is sent on the wire.
+        self.connection_count = 0
+        self.request_sizes = []
 
 class MockRunner(object):
     def __init__(self):
         self.webapp = MockWebApp()
         self.tests = []
+        self.workers = [None]
 
 
 class TestRemoteStore(unittest.TestCase):
@@ -330,6 +419,273 @@ class TestRemoteStore(unittest.TestCase):
         self.assertEquals(mock_runner.webapp.proxy_mappings, None)
         self.assertEquals(mock_runner.webapp.default_target_url, None)
 
+    def test_batch_duration(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        self.store_server.tests_data = [{"error": None, "tests": []}] * 5
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+            "count": 50,
+            "batch_duration": 60,
+        }
+        mock_runner = MockRunner()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+
+        def load_count():
+            remote_store.load({})
+            return self.store_server.load_requests[-1]["count"]
+
+        # The fixed count is used until durations were measured.
+        self.assertEquals(load_count(), 50)
+
+        def make_test(testid, test_type, duration):
+            return {"id": testid, "type": test_type, "duration": duration,
+                    "result": {"status": "pass"}}
+
+        remote_store.save({}, [make_test("a", "mochitest", 0.5),
+                               make_test("b", "mochitest", 1.5),
+                               make_test("c", "mochitest", 1)])
+        self.assertEquals(load_count(), 60)
+
+        # Slower tests give smaller batches. The previous durations of a
+        # type are taken into account.
+        remote_store.save({}, [make_test("d", "reftest", 10),
+                               make_test("e", "mochitest", 3)])
+        self.assertEquals(remote_store.type_durations,
+                          {"mochitest": 2, "reftest": 10})
+        self.assertEquals(load_count(), 10)
+
+        # The tests are shared by the workers, which run them in parallel.
+        mock_runner.workers = [None, None, None]
+        self.assertEquals(load_count(), 30)
+        mock_runner.workers = [None] * 1000
+        self.assertEquals(load_count(), RemoteTestStore.MAX_COUNT)
+
+    def test_stream_results(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+            "stream_interval": 0.1,
+        }
+        mock_runner = MockRunner()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+
+        tests = [{"id": "a", "type": "mochitest",
+                  "result": {"status": "pass"}},
+                 {"id": "b", "type": "mochitest",
+                  "result": {"status": "fail"}}]
+        remote_store.result_added(tests[0])
+        for i in range(50):
+            if self.store_server.save_requests:
+                break
+            time.sleep(0.1)
+        self.assertEquals(len(self.store_server.save_requests), 1)
+        request = self.store_server.save_requests[0]
+        self.assertTrue(request["partial"])
+        self.assertEquals(request["results"],
+                          [{"testid": "a", "status": "pass"}])
+
+        # The results not uploaded yet are sent with the batch results.
+        remote_store.stream_interval = 60
+        # Let the upload thread start waiting for the new interval.
+        time.sleep(0.3)
+        remote_store.result_added(tests[1])
+        remote_store.save({}, tests)
+        self.assertEquals(remote_store.pending_results, [])
+        self.assertEquals(len(self.store_server.save_requests), 2)
+        self.assertFalse("partial" in self.store_server.save_requests[1])
+
+    def test_stream_unexpected_error(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+            "stream_interval": 0.1,
+        }
+        mock_runner = MockRunner()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+        errors = []
+        upload_blobs = remote_store._upload_blobs
+        def failing_upload_blobs(results):
+            if not errors:
+                errors.append(True)
+                raise KeyError("image1")
+            return upload_blobs(results)
+        remote_store._upload_blobs = failing_upload_blobs
+
+        # The results are uploaded after an error which isn't a
+        # StoreException.
+        remote_store.result_added({"id": "a", "type": "mochitest",
+                                   "result": {"status": "pass"}})
+        for i in range(50):
+            if self.store_server.save_requests:
+                break
+            time.sleep(0.1)
+        self.assertEquals(errors, [True])
+        self.assertEquals(len(self.store_server.save_requests), 1)
+        remote_store.cleanup()
+
+    def test_stream_failure_before_save(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        self.store_server.partial_save_error = "Partial save failed"
+        self.store_server.partial_save_delay = 0.5
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+            "stream_interval": 0.1,
+        }
+        mock_runner = MockRunner()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+
+        tests = [{"id": "a", "type": "mochitest",
+                  "result": {"status": "pass"}}]
+        remote_store.result_added(tests[0])
+        for i in range(50):
+            if self.store_server.failed_requests:
+                break
+            time.sleep(0.1)
+        self.assertEquals(len(self.store_server.failed_requests), 1)
+
+        # The batch is saved while the partial upload is in flight. The
+        # failed upload isn't retried after the save.
+        remote_store.save({}, tests)
+        self.assertEquals(remote_store.stream_thread, None)
+        self.assertEquals(remote_store.pending_results, [])
+        time.sleep(0.5)
+        self.assertEquals(len(self.store_server.failed_requests), 1)
+        self.assertEquals(len(self.store_server.save_requests), 1)
+        self.assertFalse("partial" in self.store_server.save_requests[0])
+
+    def test_wire(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+            "compress": True,
+        }
+        mock_runner = MockRunner()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+
+        # Reftest results carry screenshots as data URLs.
+        image = "data:image/png;base64," + "iVBORw0KGgo" * 2000
+        tests = [{"id": "test_%s" % i, "type": "reftest",
+                  "result": {"status": "pass", "image1": image,
+                             "image2": image}} for i in range(10)]
+        raw_size = len(json.dumps([remote_store._make_result(t) for
+                                   t in tests]))
+
+        latencies = []
+        for i in range(3):
+            start = time.time()
+            remote_store.save({}, tests)
+            latencies.append(time.time() - start)
+        log.info("Save latencies: %s", latencies)
+
+        # The connection is reused and the requests are compressed.
+        self.assertEquals(self.store_server.connection_count, 1)
+        self.assertEquals(len(self.store_server.request_sizes), 3)
+        for size in self.store_server.request_sizes:
+            self.assertTrue(size < raw_size / 10)
+        self.assertEquals(self.store_server.save_requests[0]["results"],
+                          [remote_store._make_result(t) for t in tests])
+
+    def test_retry(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+        }
+        mock_runner = MockRunner()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+        remote_store.RETRY_DELAY = 0.01
+        remote_store.save({}, [])
+
+        # A pooled connection closed by the server is replaced.
+        for connection in remote_store.connections.idle_connections:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        remote_store.save({}, [])
+        self.assertEquals(len(self.store_server.save_requests), 2)
+
+        # A request is sent again if the server is unavailable, but not if
+        # it may have been handled.
+        self.store_server.error_statuses = [503]
+        remote_store.save({}, [])
+        self.assertEquals(len(self.store_server.save_requests), 3)
+        self.store_server.error_statuses = [500]
+        self.assertRaises(StoreException, remote_store.save, {}, [])
+        self.assertEquals(len(self.store_server.save_requests), 4)
+
+        # Requests to a server which doesn't answer fail after MAX_TRIES
+        # attempts.
+        remote_store.connections = HTTPConnectionPool("http://localhost:1/")
+        start = time.time()
+        self.assertRaises(StoreException, remote_store.save, {}, [])
+        self.assertTrue(time.time() - start >= 0.03)
+
+    def test_blobs(self):
+        self.store_server.credentials = {
+            "alice": "a_token",
+        }
+        store_info = {
+            "remote_url": STORE_SERVER_URL,
+            "username": "alice",
+            "token": "a_token",
+        }
+        mock_runner = MockRunner()
+        mock_runner.webapp.blob_store = BlobStore()
+        remote_store = RemoteTestStore(mock_runner, store_info)
+
+        png1 = "\x89PNG image 1"
+        png2 = "\x89PNG image 2"
+        url1 = blob_url(mock_runner.webapp.blob_store.put(png1))
+        url2 = blob_url(mock_runner.webapp.blob_store.put(png2))
+        # Both screenshots are the same, only one copy is kept.
+        self.assertEquals(mock_runner.webapp.blob_store.put(png1),
+                          hashlib.sha1(png1).hexdigest())
+        self.assertEquals(len(mock_runner.webapp.blob_store), 2)
+
+        tests = [{"id": "a", "type": "reftest",
+                  "result": {"status": "pass", "image1": url1,
+                             "image2": url1}},
+                 {"id": "b", "type": "reftest",
+                  "result": {"status": "fail", "image1": url1,
+                             "image2": url2, "imagediff": url2}}]
+        remote_store.save({}, tests)
+
+        self.assertEquals(self.store_server.blobs, {
+            hashlib.sha1(png1).hexdigest(): png1,
+            hashlib.sha1(png2).hexdigest(): png2,
+        })
+        # The results reference the blobs, which were sent once.
+        self.assertEquals(len(self.store_server.request_sizes), 3)
+        self.assertEquals(self.store_server.save_requests[0]["results"][1],
+                          {"testid": "b", "status": "fail", "image1": url1,
+                           "image2": url2, "imagediff": url2})
+        # The runner drops the blobs once it is done with the results.
+        self.assertEquals(len(mock_runner.webapp.blob_store), 2)
+
+        remote_store.save({}, tests)
+        self.assertEquals(len(self.store_server.request_sizes), 4)
+
     def test_protocol_version_mismatch(self):
         self.store_server.credentials = {
             "alice": "a_token",
@@ -0,0 +1,71 @@
+import unittest
+
+from w3testrunner.testtable import TestTable
+
+class TestTestTable(unittest.TestCase):
+    def _get_tests(self):
+        return [{
+            "id": "dir/test_a.html",
+            "full_id": "dir/test_a.html",
+            "type": "mochitest",
+            "url": "http://localhost:8888/tests/dir/test_a.html",
+            "file": "dir/test_a.html",
+            "equal": None,
+        }, {
+            "id": "dir/reftest.list:1",
+            "type": "reftest",
+            "url": "http://localhost:8888/tests/dir/a.html",
+            "url2": "http://localhost:8888/tests/dir/a-ref.html",
+            "equal": True,
+            "expected": "pass",
+        }]
+
+    def test_dict_view(self):
+        tests = self._get_tests()
+        table = TestTable(tests)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.to_list(), tests)
+        self.assertEqual(list(table), tests)
+        self.assertEqual(table[-1], tests[1])
+
+        test = table.by_id["dir/test_a.html"]
+        self.assertTrue("equal" in test)
+        self.assertFalse("url2" in test)
+        self.assertEqual(test.get("url2", "default"), "default")
+        self.assertRaises(KeyError, lambda: test["result"])
+        self.assertRaises(IndexError, lambda: table[2])
+
+        test["result"] = {"status": "pass"}
+        test["url"] = "http://localhost:8888/tests/other/test_a.html"
+        self.assertEqual(table[0]["result"], {"status": "pass"})
+        self.assertEqual(table[0]["url"],
+                         "http://localhost:8888/tests/other/test_a.html")
+        del test["result"]
+        del test["equal"]
+        self.assertEqual(sorted(table[0].keys()),
+                         ["file", "full_id", "id", "type", "url"])
+
+    def test_snapshot(self):
+        tests = self._get_tests()
+        table = TestTable(tests)
+        table[1]["result"] = {"status": "fail"}
+        snapshot = table.snapshot()
+
+        table[0]["result"] = {"status": "pass"}
+        table[0]["url"] = "http://localhost:8888/tests/other/test_a.html"
+        del table[1]["result"]
+        table.append({"id": "dir/test_b.html"})
+
+        tests[1]["result"] = {"status": "fail"}
+        self.assertEqual(snapshot.to_list(), tests)
+
+    def test_shared_strings(self):
+        table = TestTable(self._get_tests())
+        test = table[0]
+        # The file name part is only stored once.
+        self.assertEqual(len(table._strings), 7)
+        self.assertTrue(table._strings["test_a.html"] is
+                        table._columns["id"][1][0])
+        self.assertTrue(table._columns["url"][1][0] is
+                        table._columns["file"][1][0])
+        self.assertEqual(test["file"], "dir/test_a.html")
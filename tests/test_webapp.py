@@ -1,10 +1,16 @@
 import httplib
 import logging
 import os
+import shutil
+import socket
+import tempfile
+import time
 import unittest
 import urllib
+import zlib
 
-from w3testrunner.webapp import WebApp
+from w3testrunner.webapp import WebApp, MimeAndHeadersUpdaterMiddleware, \
+                                StreamingProxy
 
 webapp = None
 webapp_data_dir = os.path.join(os.path.dirname(__file__), "webapp_data")
@@ -21,8 +27,14 @@ class MockRunner(object):
             nouacheck = False
         self.options = MockOptions()
 
+    def match_user_agent(self, ua_string, worker_id=None):
+        if not self.ua_string:
+            self.ua_string = ua_string
+        return self.ua_string == ua_string
+
 class MockWebApp(object):
     def __init__(self):
+        self.server_url = "http://localhost:8888/"
         self.tests_path = None
         self.proxy_mappings = None
         self.default_target_url = None
@@ -55,7 +67,7 @@ class TestWebApp(unittest.TestCase):
 
     @classmethod
     def teardown_class(cls):
-        cls.webapp.running = False
+        cls.webapp.stop()
         cls.store_server.stop()
 
     def test_root(self):
@@ -70,6 +82,84 @@ class TestWebApp(unittest.TestCase):
         content = response.fp.read()
         self.assertTrue("W3TestRunner" in content)
 
+    def test_blobs(self):
+        blob_id = self.webapp.blob_store.put("\x89PNG data")
+        conn = httplib.HTTPConnection("localhost", 8888)
+        conn.request("GET", "/blobs/%s.png" % blob_id)
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("content-type"), "image/png")
+        self.assertEqual(response.read(), "\x89PNG data")
+
+        conn = httplib.HTTPConnection("localhost", 8888)
+        conn.request("GET", "/blobs/%s.png" % ("0" * 40))
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+
+    def test_port_in_use(self):
+        # A second server on the same port fails without stopping the first.
+        self.assertRaises(Exception, WebApp, MockRunner())
+        conn = httplib.HTTPConnection("localhost", 8888)
+        conn.request("GET", "/")
+        self.assertEqual(conn.getresponse().status, 200)
+
+    def test_concurrent_requests(self):
+        # A client that never finishes its request must not prevent the
+        # other requests from being handled.
+        slow_client = socket.create_connection(("localhost", 8888))
+        try:
+            slow_client.sendall("GET / HTTP/1.1\r\nHost: localhost\r\n")
+            conn = httplib.HTTPConnection("localhost", 8888, timeout=10)
+            conn.request("GET", "/")
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertTrue("W3TestRunner" in response.read())
+        finally:
+            slow_client.close()
+
+    def test_static_cache(self):
+        conn = httplib.HTTPConnection("localhost", 8888)
+        conn.request("GET", "/browsertest.js")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("content-encoding"), None)
+        content = response.read()
+        etag = response.getheader("etag")
+        self.assertTrue(etag)
+
+        conn.request("GET", "/browsertest.js", headers={
+            "Accept-Encoding": "gzip, deflate",
+        })
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("content-encoding"), "gzip")
+        self.assertEqual(response.getheader("vary"), "Accept-Encoding")
+        gzip_content = response.read()
+        self.assertTrue(len(gzip_content) < len(content))
+        self.assertEqual(zlib.decompress(gzip_content, 16 + zlib.MAX_WBITS),
+                         content)
+        gzip_etag = response.getheader("etag")
+        self.assertNotEqual(gzip_etag, etag)
+
+        for headers in ({"If-None-Match": etag},
+                        {"If-None-Match": gzip_etag,
+                         "Accept-Encoding": "gzip"}):
+            conn.request("GET", "/browsertest.js", headers=headers)
+            response = conn.getresponse()
+            self.assertEqual(response.status, 304)
+            self.assertEqual(response.read(), "")
+        self.assertTrue(len(self.webapp.resources_cache) > 0)
+
+        self.webapp.enable_localtests(webapp_data_dir)
+        conn.request("GET", "/foo.xml")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("X-Some-Header"), "Foo Value")
+        response.read()
+        self.assertEqual(len(self.webapp.tests_cache), 1)
+        self.webapp.disable_localtests()
+        self.assertEqual(len(self.webapp.tests_cache), 0)
+
     def test_cgi(self):
         conn = httplib.HTTPConnection("localhost", 8888)
         conn.request("GET", "/hello_cgi.py")
@@ -88,6 +178,18 @@ class TestWebApp(unittest.TestCase):
         content = response.fp.read()
         self.assertEqual(content, "Test content here\n")
 
+        # The next scripts run in workers started in advance.
+        pool = self.webapp.cgi_worker_pool
+        for i in range(50):
+            if len(pool.idle) == pool.size:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(pool.idle), pool.size)
+        conn.request("GET", "/hello_cgi.py")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.fp.read(), "Test content here\n")
+
         conn.request("GET", "/status_cgi.py")
         response = conn.getresponse()
         self.assertEqual(response.status, 500)
@@ -176,6 +278,7 @@ class TestWebApp(unittest.TestCase):
             ("http://localhost:8888/some_directory/", "/proxy_data/"),
             ("http://localhost:8888/", "/proxy_data/"),
         ), test_remote.STORE_SERVER_URL)
+        connection_count = self.store_server.connection_count
 
         conn.request("GET", "/proxy.txt")
         response = conn.getresponse()
@@ -191,6 +294,42 @@ class TestWebApp(unittest.TestCase):
         content = response.fp.read()
         self.assertEqual(content, "Dummy content.\n")
 
+        # The connection to the proxied server is kept alive.
+        self.assertEqual(self.store_server.connection_count,
+                         connection_count + 1)
+
+        # The longest matching path is used, whatever the mappings order.
+        self.webapp.enable_remotetests((
+            ("http://localhost:8888/", "/proxy_data/"),
+            ("http://localhost:8888/some_directory/", "/not_found/"),
+        ), test_remote.STORE_SERVER_URL)
+        conn.request("GET", "/some_directory/proxy.txt")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+        conn.request("GET", "/proxy.txt")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), "Dummy content.\n")
+
+        # A body closed before being read doesn't put its connection back
+        # in the pool, a body read entirely does.
+        proxy = StreamingProxy("localhost:%s" % test_remote.STORE_SERVER_PORT)
+        environ = {
+            "HTTP_HOST": "localhost:8888",
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": "/proxy_data/proxy.txt",
+        }
+        body = proxy(environ, lambda status, headers: None)
+        connection = body.connection
+        body.close()
+        self.assertEqual(connection.sock, None)
+        self.assertEqual(proxy.connections.idle_connections, [])
+        body = proxy(environ, lambda status, headers: None)
+        self.assertEqual("".join(body), "Dummy content.\n")
+        body.close()
+        self.assertEqual(len(proxy.connections.idle_connections), 1)
+
         self.store_server.reset()
         self.webapp.disable_remotetests()
 
@@ -198,6 +337,53 @@ class TestWebApp(unittest.TestCase):
         response = conn.getresponse()
         self.assertEqual(response.status, 404)
 
+class TestHeadersIndex(unittest.TestCase):
+    def setUp(self):
+        self.tests_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tests_path)
+
+    def _write(self, name, content, mtime):
+        path = os.path.join(self.tests_path, name)
+        f = open(path, "w")
+        f.write(content)
+        f.close()
+        os.utime(path, (mtime, mtime))
+        os.utime(self.tests_path, (mtime, mtime))
+
+    def test_index(self):
+        middleware = MimeAndHeadersUpdaterMiddleware(None, self.tests_path)
+        middleware.INDEX_CHECK_INTERVAL = 0
+        self._write("a.html", "", 1000)
+        self.assertEqual(middleware._maybe_parse_headers_file("/a.html"),
+                         (None, {}))
+        self.assertEqual(middleware._maybe_parse_headers_file("/"),
+                         (None, {}))
+
+        self._write("a.html^headers^", "HTTP 404 Not found\nX-Foo: bar\n",
+                    2000)
+        self.assertEqual(middleware._maybe_parse_headers_file("/a.html"),
+                         ("404 Not found", {"X-Foo": "bar"}))
+
+        self._write("a.html^headers^", "X-Foo: baz\n", 3000)
+        self.assertEqual(middleware._maybe_parse_headers_file("/a.html"),
+                         (None, {"X-Foo": "baz"}))
+
+        # The index is not checked again before INDEX_CHECK_INTERVAL.
+        middleware.INDEX_CHECK_INTERVAL = 60
+        os.remove(os.path.join(self.tests_path, "a.html^headers^"))
+        self._write("b.html", "", 4000)
+        self._write("b.html^headers^", "X-Foo: b\n", 4000)
+        self.assertEqual(middleware._maybe_parse_headers_file("/b.html"),
+                         (None, {}))
+        self.assertEqual(middleware._maybe_parse_headers_file("/a.html"),
+                         (None, {}))
+
+        middleware.INDEX_CHECK_INTERVAL = 0
+        self.assertEqual(middleware._maybe_parse_headers_file("/b.html"),
+                         (None, {"X-Foo": "b"}))
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
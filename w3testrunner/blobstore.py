@@ -0,0 +1,86 @@
+from __future__ import with_statement
+
+import hashlib
+import threading
+
+# Path of the blobs on the webapp. Results reference blobs with URLs made of
+# this prefix, the blob identifier and BLOB_URL_SUFFIX.
+BLOB_URL_PREFIX = "/blobs/"
+BLOB_URL_SUFFIX = ".png"
+# Keys of the test results which may reference a screenshot blob.
+RESULT_IMAGE_KEYS = ("image1", "image2", "imagediff")
+
+def blob_url(blob_id):
+    return BLOB_URL_PREFIX + blob_id + BLOB_URL_SUFFIX
+
+def blob_id_from_url(url):
+    """Return the identifier of the blob referenced by url, or None if it
+    isn't a blob URL."""
+    if (not isinstance(url, basestring) or
+        not url.startswith(BLOB_URL_PREFIX) or
+        not url.endswith(BLOB_URL_SUFFIX)):
+        return None
+    return url[len(BLOB_URL_PREFIX):-len(BLOB_URL_SUFFIX)]
+
+def get_result_blob_ids(result):
+    """Return the identifiers of the blobs referenced by a test result, once
+    for each reference."""
+    blob_ids = []
+    for key in RESULT_IMAGE_KEYS:
+        blob_id = blob_id_from_url(result.get(key))
+        if blob_id:
+            blob_ids.append(blob_id)
+    return blob_ids
+
+class BlobStore(object):
+    """Content-addressed store for the reftest screenshots.
+
+    The blobs are kept in memory and identified by the SHA-1 hash of their
+    content, so that an image stored several times is only kept once. The
+    blobs are reference counted: put() gives a reference to the result the
+    screenshot is taken for, which is dropped with remove() when the result
+    is cleared or the runner is done with it. A blob is kept until all its
+    references are dropped.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.refcounts = {}
+
+    def put(self, data):
+        """Store data and return its identifier."""
+        blob_id = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.blobs.setdefault(blob_id, data)
+            self.refcounts[blob_id] = self.refcounts.get(blob_id, 0) + 1
+        return blob_id
+
+    def get(self, blob_id):
+        """Return the data of a blob, or None if it isn't stored."""
+        with self.lock:
+            return self.blobs.get(blob_id)
+
+    def retain(self, blob_ids):
+        """Add a reference to each of the given blobs which are stored, an
+        identifier being repeated for each reference."""
+        with self.lock:
+            for blob_id in blob_ids:
+                if blob_id in self.refcounts:
+                    self.refcounts[blob_id] += 1
+
+    def remove(self, blob_ids):
+        """Drop a reference to each of the given blobs, an identifier being
+        repeated for each reference. The blobs without references left are
+        removed."""
+        with self.lock:
+            for blob_id in blob_ids:
+                refcount = self.refcounts.get(blob_id, 0) - 1
+                if refcount > 0:
+                    self.refcounts[blob_id] = refcount
+                    continue
+                self.refcounts.pop(blob_id, None)
+                self.blobs.pop(blob_id, None)
+
+    def __len__(self):
+        return len(self.blobs)
@@ -7,6 +7,7 @@ import subprocess
 import sys
 import tempfile
 import time
+import urllib
 
 try:
     from talos import ffprocess
@@ -68,6 +69,9 @@ class Browser(object):
     # If True, a temporary directory will be created in prepare_launch() that
     # is stored in self.profile_dir.
     needs_temporary_profile_dir = False
+    # Set to True if several instances of this browser can run at the same
+    # time (each one with its own temporary profile directory).
+    allows_several_instances = False
 
     proc = None
     screen = None
@@ -76,6 +80,14 @@ class Browser(object):
         self.browser_info = browser_info
         self.profile_dir = None
         self.ua_string = None
+        # Set by the Runner if its webapp doesn't use the default address.
+        self.runner_url = self.RUNNER_URL
+        # Identifier of the Runner worker controlling this browser.
+        self.worker_id = None
+        # True if other instances of this browser run at the same time. As
+        # they share the same process name, only the process launched by this
+        # instance and its windows are handled.
+        self.pooled = False
 
         assert self.name
         attrs = self._compute_attributes()
@@ -136,7 +148,7 @@ class Browser(object):
         if not self.cmd:
             self.cmd = [self.browser_info.path]
 
-        url = "%s?skip_cache=%s" % (self.RUNNER_URL, random.randint(1, 10**10))
+        url = self.get_runner_url(skip_cache=random.randint(1, 10**10))
         cmd = self.cmd + [url]
         log.debug("Launching %s ...", cmd)
 
@@ -166,6 +178,23 @@ class Browser(object):
         if not self.is_alive():
             raise BrowserException("Failed to launch browser")
 
+    def get_runner_url(self, **params):
+        """Return the URL of the runner page to open in this browser."""
+        if self.worker_id is not None:
+            params["worker"] = self.worker_id
+        if not params:
+            return self.runner_url
+        return "%s?%s" % (self.runner_url,
+                          urllib.urlencode(sorted(params.items())))
+
+    def move_front(self):
+        """Maximize the browser window and move it in front of the others.
+
+        This is needed before running a reftest when several browsers are
+        running, as the screenshots are taken from the whole screen.
+        """
+        self._maximize_and_move_front()
+
     def _maximize_and_move_front(self):
         raise NotImplementedError()
 
@@ -199,13 +228,21 @@ class Browser(object):
     def _create_temp_profile_dir(self):
         """Create a temporary directory for the browser profile.
 
-        The empty directory created is stored in self.profile_dir.
+        The empty directory created is stored in self.profile_dir. Each
+        instance gets its own directory, the one of a previous launch is
+        removed.
         """
-        self.profile_dir = os.path.join(tempfile.gettempdir(),
-                                        "testrunner_profile_%s" % self.name)
+        self._remove_temp_profile_dir()
+        self.profile_dir = tempfile.mkdtemp(
+            prefix="testrunner_profile_%s_" % self.name)
+
+    def _remove_temp_profile_dir(self):
+        if not self.profile_dir:
+            return
         if os.path.exists(self.profile_dir):
+            log.debug("Removing temporary profile %r", self.profile_dir)
             shutil.rmtree(self.profile_dir)
-        os.makedirs(self.profile_dir)
+        self.profile_dir = None
 
     def initialize_profile(self):
         """Override to initialize the profile directory in self.profile_dir."""
@@ -224,7 +261,10 @@ class Browser(object):
             self.initialize_profile()
 
     def is_alive(self):
-        alive = ffprocess.ProcessesWithNameExist(self.process_name)
+        if self.pooled:
+            alive = bool(self.proc) and self.proc.poll() is None
+        else:
+            alive = ffprocess.ProcessesWithNameExist(self.process_name)
         log.debug("is_alive: %s", alive)
         return alive
 
@@ -239,8 +279,13 @@ class Browser(object):
         if not self.process_name:
             raise BrowserException("No process_name defined")
 
-        log.debug("Terminating process: '%s'", self.process_name)
-        ffprocess.TerminateAllProcesses(self.process_name)
+        if self.pooled:
+            if self.proc and self.proc.poll() is None:
+                log.debug("Terminating process %s", self.proc.pid)
+                self.proc.terminate()
+        else:
+            log.debug("Terminating process: '%s'", self.process_name)
+            ffprocess.TerminateAllProcesses(self.process_name)
         # Crash reporter processes could still have some browser files opened
         # (dwwin on Windows for instance). Cleanup them when terminating.
         self.cleanup_processes()
@@ -260,9 +305,7 @@ class Browser(object):
             self.terminate()
         assert not self.is_alive(), "Didn't terminate correctly"
 
-        if self.profile_dir:
-            log.debug("Removing temporary profile %r", self.profile_dir)
-            shutil.rmtree(self.profile_dir)
+        self._remove_temp_profile_dir()
 
 if sys.platform == "win32":
     import win32ui, win32gui, win32con, win32process, win32api, pywintypes
@@ -307,6 +350,12 @@ class BrowserWin(Browser):
                                    process_name)
         return pids
 
+    def _get_own_pids(self):
+        """Return the pids whose windows belong to this browser."""
+        if self.pooled:
+            return [self.proc.pid]
+        return self._get_pids(self.process_name)
+
     def _get_windows_by_pids(self, pids):
         all_windows = []
         win32gui.EnumWindows(lambda win, all_windows: all_windows.append(win),
@@ -334,7 +383,7 @@ class BrowserWin(Browser):
         return windows
 
     def _maximize_and_move_front(self):
-        pids = self._get_pids(self.process_name)
+        pids = self._get_own_pids()
         log.debug("Found pids %s", pids)
 
         # XXX there should be only one window at this point, the following code
@@ -357,7 +406,7 @@ class BrowserWin(Browser):
                       "Retrying (%i/%i)...", len(windows), i, tries)
             time.sleep(3)
             # Pids could have changed, for instance with a Firefox EM restart.
-            pids = self._get_pids(self.process_name)
+            pids = self._get_own_pids()
         else:
             raise BrowserException("Couldn't find browser window for pids %s" %
                                    pids)
@@ -375,7 +424,7 @@ class BrowserWin(Browser):
                                        "focus (%s)" % e)
 
     def _count_windows(self):
-        pids = self._get_pids(self.process_name)
+        pids = self._get_own_pids()
         windows = self._get_windows_by_pids(pids)
         return len(windows)
 
@@ -400,7 +449,11 @@ class BrowserLin(Browser):
         # This is run in a separate process to avoid dealing with a GTK loop.
         thisdir = os.path.abspath(os.path.dirname(__file__))
         delegate_path = os.path.join(thisdir, "tools", "wnck_delegate.py")
-        return subprocess.Popen([delegate_path, cmd, self.appname],
+        args = [delegate_path, cmd, self.appname]
+        # Only the windows of the process launched by this instance.
+        if self.pooled:
+            args.append(str(self.proc.pid))
+        return subprocess.Popen(args,
                                 stdout=subprocess.PIPE).communicate()[0]
 
     def _maximize_and_move_front(self):
@@ -460,8 +513,15 @@ class BrowserMac(Browser):
             return None
         return default_path
 
+    def _get_process(self):
+        if self.pooled:
+            import appscript
+            return self.sysevents.processes[
+                appscript.its.unix_id == self.proc.pid].first
+        return self.sysevents.processes[self.process_name]
+
     def _maximize_and_move_front(self):
-        process = self.sysevents.processes[self.process_name]
+        process = self._get_process()
         process.frontmost.set(True)
 
         # XXX there should be only one window at this point, the following code
@@ -482,6 +542,6 @@ class BrowserMac(Browser):
         win.size.set(self.desktopsize)
 
     def _count_windows(self):
-        process = self.sysevents.processes[self.process_name]
+        process = self._get_process()
         windows = process.windows()
         return len(windows)
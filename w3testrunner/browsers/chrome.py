@@ -10,6 +10,7 @@ from w3testrunner.browsers.browser import BrowserLin, BrowserWin, BrowserMac
 class ChromeMixin(object):
     name = "chrome"
     needs_temporary_profile_dir = True
+    allows_several_instances = True
 
     def initialize_profile(self):
         first_run_file = os.path.join(self.profile_dir, "First Run")
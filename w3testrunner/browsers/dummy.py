@@ -10,6 +10,7 @@ class DummyBrowser(Browser):
 
     name = "dummy"
     nopath = True
+    allows_several_instances = True
 
     def __init__(self, browser_info):
         super(DummyBrowser, self).__init__(browser_info)
@@ -20,7 +21,7 @@ class DummyBrowser(Browser):
 
         # Simulate a browser fetching the runner url.
         try:
-            urllib2.urlopen(self.RUNNER_URL).read()
+            urllib2.urlopen(self.get_runner_url()).read()
         except urllib2.URLError, e:
             log.debug("Error connecting to runner url: %s", e)
 
@@ -29,3 +30,9 @@ class DummyBrowser(Browser):
 
     def terminate(self):
         self.alive = False
+
+    def _maximize_and_move_front(self):
+        pass
+
+    def _count_windows(self):
+        return int(self.alive)
@@ -5,6 +5,7 @@ from w3testrunner.browsers.browser import BrowserLin, BrowserWin, BrowserMac
 class FirefoxMixin(object):
     name = "firefox"
     needs_temporary_profile_dir = True
+    allows_several_instances = True
 
     def initialize_profile(self):
         """Sets up the standard testing profile.
@@ -41,7 +42,7 @@ user_pref("svg.smil.enabled", true); // Needed for SMIL mochitests until bug 482
 user_pref("media.cache_size", 100);
 user_pref("security.warn_viewing_mixed", false);
 
-user_pref("geo.wifi.uri", "http://localhost:8888/tests/dom/tests/mochitest/geolocation/network_geolocation.sjs");
+user_pref("geo.wifi.uri", "%(server_url)stests/dom/tests/mochitest/geolocation/network_geolocation.sjs");
 user_pref("geo.wifi.testing", true);
 
 user_pref("camino.warn_when_closing", false); // Camino-only, harmless to others
@@ -49,12 +50,12 @@ user_pref("camino.warn_when_closing", false); // Camino-only, harmless to others
 // Make url-classifier updates so rare that they won't affect tests
 user_pref("urlclassifier.updateinterval", 172800);
 // Point the url-classifier to the local testing server for fast failures
-user_pref("browser.safebrowsing.provider.0.gethashURL", "http://localhost:8888/safebrowsing-dummy/gethash");
-user_pref("browser.safebrowsing.provider.0.keyURL", "http://localhost:8888/safebrowsing-dummy/newkey");
-user_pref("browser.safebrowsing.provider.0.lookupURL", "http://localhost:8888/safebrowsing-dummy/lookup");
-user_pref("browser.safebrowsing.provider.0.updateURL", "http://localhost:8888/safebrowsing-dummy/update");
+user_pref("browser.safebrowsing.provider.0.gethashURL", "%(server_url)ssafebrowsing-dummy/gethash");
+user_pref("browser.safebrowsing.provider.0.keyURL", "%(server_url)ssafebrowsing-dummy/newkey");
+user_pref("browser.safebrowsing.provider.0.lookupURL", "%(server_url)ssafebrowsing-dummy/lookup");
+user_pref("browser.safebrowsing.provider.0.updateURL", "%(server_url)ssafebrowsing-dummy/update");
 """
-        prefs.append(part)
+        prefs.append(part % {"server_url": self.runner_url})
 
         # write the preferences
         prefsFile = open(self.profile_dir + "/" + "user.js", "a")
@@ -13,11 +13,11 @@ if __name__ == "__main__":
     screen.force_update()
     windows = screen.get_windows()
 
-    if len(sys.argv) != 3:
-        print "Usage: %s {maximize|countwindows} APPNAME"
+    if len(sys.argv) not in (3, 4):
+        print "Usage: %s {maximize|countwindows} APPNAME [PID]"
         sys.exit(1)
 
-    cmd, appname = sys.argv[1:]
+    cmd, appname = sys.argv[1:3]
 
     #print "App names:", [w.get_application().get_name() for w in windows]
 
@@ -26,12 +26,18 @@ if __name__ == "__main__":
     # That's why "in" is used instead of strict equality. This is suboptimal
     # because there could be false positives.
     windows = [w for w in windows if appname in w.get_application().get_name()]
+    # When several instances of the application are running, only the windows
+    # of the given process are used.
+    if len(sys.argv) == 4:
+        pid = int(sys.argv[3])
+        windows = [w for w in windows if w.get_pid() == pid]
     if cmd == "maximize":
         if len(windows) != 1:
             print "Did not find only one window to maximize (count: %s)" % \
                   len(windows)
             sys.exit(1)
         windows[0].maximize()
+        windows[0].activate(0)
     elif cmd == "countwindows":
         print len(windows)
     else:
@@ -0,0 +1,149 @@
+"""Python processes started ahead of the CGI requests.
+
+Starting a Python interpreter takes tens of milliseconds, which is most of
+the time needed to run a small CGI script. The webapp keeps a few worker
+processes started in advance, each of them waiting on its standard input for
+the script to run. A worker runs a single script and then exits, so that the
+scripts are isolated from each other just like when they were run in a
+fresh interpreter.
+
+When run as a script, this module is the worker side.
+"""
+
+from __future__ import with_statement
+
+import imp
+import marshal
+import os
+import subprocess
+import sys
+import threading
+
+# Number of workers kept waiting for a request.
+CGI_WORKERS = 2
+
+WORKER_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+class CGIWorkerPool(object):
+    """Pool of single-use worker processes.
+
+    The workers are only started on the first request, so that no process is
+    started when the tests don't use CGI scripts.
+    """
+
+    def __init__(self, size=CGI_WORKERS):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.starting = 0
+        self.closed = False
+
+    def _start_worker(self):
+        return subprocess.Popen(
+            # The -u option is used prevent Python replacing \n to \r\n when
+            # writing to sys.stdout on Windows.
+            [sys.executable, "-u", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=(sys.platform != "win32"),
+            )
+
+    def _fill(self):
+        while True:
+            with self.lock:
+                if self.closed or len(self.idle) + self.starting >= self.size:
+                    return
+                self.starting += 1
+            proc = self._start_worker()
+            with self.lock:
+                self.starting -= 1
+                if not self.closed:
+                    self.idle.append(proc)
+                    continue
+            proc.stdin.close()
+            proc.wait()
+            return
+
+    def fill(self):
+        """Start workers in the background until there are size of them
+        waiting. This is called once a request is done, so that starting the
+        workers doesn't slow it down."""
+        thread = threading.Thread(target=self._fill)
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self, script, environ, cwd):
+        """Return a worker process running script with the given environment
+        and working directory. The caller writes the request body to its
+        standard input and reads the script output from its standard output
+        and error, like for a process created with subprocess.Popen(), then
+        calls fill()."""
+        with self.lock:
+            proc = self.idle and self.idle.pop(0)
+        if not proc:
+            proc = self._start_worker()
+
+        request = marshal.dumps({
+            "script": script,
+            "environ": environ,
+            "cwd": cwd,
+        })
+        proc.stdin.write("%d\n" % len(request))
+        proc.stdin.write(request)
+        proc.stdin.flush()
+        return proc
+
+    def close(self):
+        """Stop the idle workers."""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for proc in idle:
+            # The worker exits when its standard input is closed.
+            proc.stdin.close()
+            proc.wait()
+
+def main():
+    length = sys.stdin.readline()
+    if not length:
+        # The pool was closed.
+        return
+    request = marshal.loads(sys.stdin.read(int(length)))
+    script = request["script"]
+
+    os.environ.clear()
+    os.environ.update(request["environ"])
+    os.chdir(request["cwd"])
+    sys.argv = [script]
+    sys.path[0] = os.path.dirname(script)
+
+    # Run the script like "python script" does.
+    module = imp.new_module("__main__")
+    module.__file__ = script
+    module.__builtins__ = __builtins__
+    sys.modules["__main__"] = module
+    status = 0
+    try:
+        execfile(script, module.__dict__)
+    except SystemExit, e:
+        status = e.code
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            print >>sys.stderr, status
+            status = 1
+    except:
+        sys.excepthook(*sys.exc_info())
+        status = 1
+
+    # Exit without the interpreter shutdown, which takes longer than running
+    # most scripts. The atexit handlers are still called.
+    if hasattr(sys, "exitfunc"):
+        sys.exitfunc()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+from __future__ import with_statement
+
+import hashlib
+import os
+import stat
+import threading
+import zlib
+
+# Files larger than this are not cached and are read from disk on each
+# request.
+MAX_FILE_SIZE = 1024 * 1024
+# Files smaller than this are not worth compressing.
+COMPRESS_MIN_SIZE = 1024
+
+class CachedFile(object):
+    """Content of a file, with a strong ETag computed from the content."""
+
+    def __init__(self, path, mtime, data):
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.gzip_data = None
+        self.size = len(data)
+        # Neighbours in the recency list of the FileCache.
+        self.prev = self.next = None
+
+class _RecencyListHead(object):
+    """Sentinel of the circular list of the cached files."""
+
+    def __init__(self):
+        self.prev = self.next = self
+
+class FileCache(object):
+    """In-memory LRU cache of file contents, keyed by path and mtime.
+
+    max_size is the total size of the cached content in bytes, or None to
+    never evict any file. When revalidate is False, the files are read once
+    and kept without checking their modification time again, which is meant
+    for files that don't change while the runner is running.
+    """
+
+    def __init__(self, max_size=None, revalidate=True,
+                 max_file_size=MAX_FILE_SIZE):
+        self.max_size = max_size
+        self.revalidate = revalidate
+        self.max_file_size = max_file_size
+        self.lock = threading.Lock()
+        self.files = {}
+        self.size = 0
+        # Circular doubly linked list of the cached files, from the least
+        # (head.next) to the most (head.prev) recently used one, so that
+        # using and evicting a file are done in constant time.
+        self.head = _RecencyListHead()
+
+    def get(self, path):
+        """Return the CachedFile of the file at path, reading it if it isn't
+        cached or if it was modified. None is returned if path is not a
+        regular file or if the file is too large to be cached."""
+        with self.lock:
+            cached_file = self.files.get(path)
+            if cached_file and not self.revalidate:
+                self._touch(cached_file)
+                return cached_file
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(path)
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.max_file_size:
+            self.discard(path)
+            return None
+
+        with self.lock:
+            cached_file = self.files.get(path)
+            if cached_file and cached_file.mtime == st.st_mtime:
+                self._touch(cached_file)
+                return cached_file
+
+        try:
+            f = open(path, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            self.discard(path)
+            return None
+
+        cached_file = CachedFile(path, st.st_mtime, data)
+        with self.lock:
+            self._remove(path)
+            self.files[path] = cached_file
+            self.size += cached_file.size
+            self._link_last(cached_file)
+            self._evict()
+        return cached_file
+
+    def get_gzip_data(self, cached_file):
+        """Return the content of a cached file compressed with gzip, or None
+        if the file is too small to be worth it. The compressed content is
+        computed once and kept with the file."""
+        if len(cached_file.data) < COMPRESS_MIN_SIZE:
+            return None
+        if cached_file.gzip_data is not None:
+            return cached_file.gzip_data
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzip_data = compressor.compress(cached_file.data) + compressor.flush()
+        with self.lock:
+            if cached_file.gzip_data is None:
+                cached_file.gzip_data = gzip_data
+                cached_file.size += len(gzip_data)
+                if self.files.get(cached_file.path) is cached_file:
+                    self.size += len(gzip_data)
+                    self._evict()
+        return cached_file.gzip_data
+
+    def discard(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.size = 0
+            self.head = _RecencyListHead()
+
+    def paths(self):
+        """Return the paths of the cached files, from the least to the most
+        recently used."""
+        with self.lock:
+            paths = []
+            cached_file = self.head.next
+            while cached_file is not self.head:
+                paths.append(cached_file.path)
+                cached_file = cached_file.next
+            return paths
+
+    def __len__(self):
+        return len(self.files)
+
+    def _link_last(self, cached_file):
+        last = self.head.prev
+        cached_file.prev, cached_file.next = last, self.head
+        last.next = self.head.prev = cached_file
+
+    def _unlink(self, cached_file):
+        cached_file.prev.next = cached_file.next
+        cached_file.next.prev = cached_file.prev
+        cached_file.prev = cached_file.next = None
+
+    def _touch(self, cached_file):
+        self._unlink(cached_file)
+        self._link_last(cached_file)
+
+    def _remove(self, path):
+        cached_file = self.files.pop(path, None)
+        if cached_file:
+            self._unlink(cached_file)
+            self.size -= cached_file.size
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits in
+        max_size."""
+        if self.max_size is None:
+            return
+        while self.size > self.max_size and self.files:
+            self._remove(self.head.next.path)
@@ -0,0 +1,100 @@
+from __future__ import with_statement
+
+import errno
+import httplib
+import socket
+import threading
+import urlparse
+
+class RequestNotSent(Exception):
+    """The request couldn't be sent to the server, so sending it again can't
+    make the server handle it twice."""
+
+    def __init__(self, error):
+        Exception.__init__(self, str(error))
+        self.error = error
+
+class HTTPConnectionPool(object):
+    """Keep-alive connections to the server of a base URL.
+
+    Connections are taken from the pool for a request and put back once the
+    response is read, unless the server closes them.
+    """
+    # Maximum number of idle connections kept.
+    MAX_IDLE = 4
+
+    def __init__(self, base_url):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(base_url)
+        if scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = netloc
+        self.base_path = path or "/"
+        self.lock = threading.Lock()
+        self.idle_connections = []
+
+    def acquire(self):
+        """Return an idle connection, or a new one if there is none. The
+        second item of the returned tuple is True for an idle connection,
+        which may have been closed by the server in the meantime."""
+        with self.lock:
+            if self.idle_connections:
+                return self.idle_connections.pop(), True
+        return self.connection_class(self.netloc), False
+
+    def release(self, connection, response):
+        """Put back a connection once response was entirely read."""
+        with self.lock:
+            if (response.will_close or
+                len(self.idle_connections) >= self.MAX_IDLE):
+                connection.close()
+            else:
+                self.idle_connections.append(connection)
+
+    def request(self, method, path, body=None, headers={}):
+        """Send a request for a path relative to the base URL.
+
+        Returns the response and its body. An idle connection closed by the
+        server is replaced, as the server didn't handle the request then.
+        Raises RequestNotSent if the server can't be connected to, or
+        httplib.HTTPException or socket.error if the request failed after
+        being sent, in which case the server may have handled it.
+        """
+        while True:
+            connection, reused = self.acquire()
+            if not reused:
+                try:
+                    connection.connect()
+                except socket.error, e:
+                    connection.close()
+                    raise RequestNotSent(e)
+            sent = False
+            try:
+                connection.request(method, self.base_path + path, body,
+                                   headers)
+                sent = True
+                response = connection.getresponse()
+                response_body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused and self._closed_while_idle(sent, e):
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+
+            self.release(connection, response)
+            return response, response_body
+
+    def _closed_while_idle(self, sent, error):
+        """Return True if error means that the server closed an idle
+        connection before receiving the request on it."""
+        if not sent:
+            return True
+        if isinstance(error, httplib.BadStatusLine):
+            # No response at all.
+            return True
+        return (isinstance(error, socket.error) and
+                error.args[0] == errno.ECONNRESET)
@@ -233,12 +233,15 @@ class ImageComparator(object):
                 return False
         return True
 
-    def _to_data_url(self, image):
+    def _to_png(self, image):
         output = StringIO.StringIO()
         image.save(output, "PNG")
         image_data = output.getvalue()
         output.close()
-        return "data:image/png;base64," + base64.b64encode(image_data)
+        return image_data
+
+    def _to_data_url(self, image):
+        return "data:image/png;base64," + base64.b64encode(self._to_png(image))
 
     def _grab_image(self):
         image = self._take_screenshot()
@@ -275,12 +278,13 @@ class ImageComparator(object):
         return pixel_diff
 
     def save_images(self):
+        """Return the images of the last comparison as PNG data."""
         images = {}
         imagenames = ["image1", "image2", "imagediff"]
         for imagename in imagenames:
             image = getattr(self, imagename, None)
             if image:
-                images[imagename] = self._to_data_url(image)
+                images[imagename] = self._to_png(image)
         return images
 
     def reset(self):
@@ -491,7 +491,7 @@ var TestRunner = TR = {
   },
 
   loadState: function() {
-    this.rpc("get_state", [], function(msg) {
+    this.rpc("get_state", [this._params.worker || null], function(msg) {
       this._state = msg;
       LOG("current status: ", this._state.status);
 
@@ -608,6 +608,11 @@ var TestRunner = TR = {
     this.assert(this._state.status == RUNNING,
                 "runAllTests should be called when the status is RUNNING");
 
+    if (this._state.batch) {
+      this.runDispatchedTests();
+      return;
+    }
+
     var nextTest = this._state.tests[this._currentTestIndex];
     if (nextTest && nextTest.result)
       nextTest = null;
@@ -637,6 +642,62 @@ var TestRunner = TR = {
         TR.runAllTests();
       }
     });
+  },
+
+  findTest: function(testid) {
+    for (var i = 0; i < this._state.tests.length; i++) {
+      if (this._state.tests[i].id == testid)
+        return this._state.tests[i];
+    }
+    return null;
+  },
+
+  reloadTests: function() {
+    this.rpc("get_state", [this._params.worker || null], function(msg) {
+      this._state.tests = msg.tests;
+      $("#totalTests").text(this._state.tests.length);
+      this._counters = null;
+      this.updateUI();
+      this.updateTestsTable();
+    }, true);
+  },
+
+  // In batch mode, several browsers can share the tests, so the server
+  // decides which test to run next.
+  runDispatchedTests: function() {
+    this.rpc("next_test", [this._params.worker || null], function(msg) {
+      if (this._state.status != RUNNING)
+        return;
+
+      if (msg.wait) {
+        setTimeout(function() {
+          if (TR._state.status == RUNNING)
+            TR.runDispatchedTests();
+        }, 500);
+        return;
+      }
+
+      if (msg.testid === null) {
+        // The server sets the FINISHED status once all the browsers are done.
+        this.setStatus(FINISHED, "No more tests to run in this browser", true);
+        return;
+      }
+
+      var nextTest = this.findTest(msg.testid);
+      if (!nextTest) {
+        // The server loaded the next batch of tests without relaunching
+        // the browser.
+        this.reloadTests();
+        nextTest = this.findTest(msg.testid);
+      }
+      this.assert(nextTest, "Unknown test id " + msg.testid);
+
+      this.runTest(nextTest, function() {
+        if (TR._state.status == RUNNING) {
+          TR.runDispatchedTests();
+        }
+      });
+    }, true);
   }
 };
 
@@ -1,5 +1,8 @@
 from __future__ import with_statement
 
+import collections
+import heapq
+import itertools
 import optparse
 import os
 import logging
@@ -10,8 +13,11 @@ import threading
 import time
 import traceback
 
-from w3testrunner.webapp import WebApp
+from w3testrunner.webapp import WebApp, WEBAPP_HOST, WEBAPP_PORT, \
+                                WEBAPP_WORKERS
 from w3testrunner import teststores
+from w3testrunner.blobstore import get_result_blob_ids
+from w3testrunner.testtable import TestTable
 from w3testrunner.browsers.browser import BrowserInfo, BrowserException
 from w3testrunner.browsers.manager import browsers_manager
 
@@ -25,39 +31,229 @@ for value, name in enumerate(STATUSES.split()):
     locals()[name] = value
     STATUS_TO_NAME[value] = name
 
-# from http://code.activestate.com/recipes/465057/
-def synchronized(lock):
-    """ Synchronization decorator. """
+def synchronized(f):
+    """Decorator for the Runner methods which run while holding the Runner
+    lock."""
+
+    def newFunction(self, *args, **kw):
+        with self.lock:
+            return f(self, *args, **kw)
+    return newFunction
+
+# How much to multiply the timeout duration to get the server side
+# waiting time. The intention is to have a timeout larger than
+# the timout used in the client-side harness to allow it to catch
+# hangs first.
+SERVER_HANG_TIMER_RATIO = 1.2
+
+class HangWatchdog(object):
+    """Thread calling a callback when a deadline expires.
+
+    This replaces a threading.Timer (and so a thread) per running test. The
+    deadlines are armed for a key (a BrowserWorker) and kept in a heap.
+    Disarming a deadline only forgets it, the heap entry is dropped when it
+    reaches the top of the heap or when the heap is compacted.
+
+    The callback is called with the key and a token, without holding any
+    lock. It should call expire() with them, which returns False if the
+    deadline was disarmed or armed again in the meantime.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.heap = []
+        # The current heap entry of each armed key.
+        self.entries = {}
+        self.counter = itertools.count()
+        self.thread = None
+
+    def arm(self, key, delay):
+        with self.condition:
+            entry = [time.time() + delay, self.counter.next(), key]
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [e for e in self.heap if
+                             self.entries.get(e[2]) is e]
+                heapq.heapify(self.heap)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+
+    def disarm(self, key):
+        """Disarm the deadline of key. Returns False if it wasn't armed."""
+        with self.condition:
+            return self.entries.pop(key, None) is not None
+
+    def expire(self, key, token):
+        with self.condition:
+            entry = self.entries.get(key)
+            if not entry or entry[1] != token:
+                return False
+            del self.entries[key]
+            return True
+
+    def stop(self):
+        with self.condition:
+            self.thread = None
+            self.condition.notify()
+
+    def _next_expired_entry(self):
+        while self.thread is threading.currentThread():
+            while self.heap and self.entries.get(self.heap[0][2]) is not \
+                  self.heap[0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                self.condition.wait()
+                continue
+            remaining = self.heap[0][0] - time.time()
+            if remaining <= 0:
+                return heapq.heappop(self.heap)
+            self.condition.wait(remaining)
+        return None
 
-    def wrap(f):
-        def newFunction(*args, **kw):
-            lock.acquire()
-            try:
-                return f(*args, **kw)
-            finally:
-                lock.release()
-        return newFunction
-    return wrap
+    def _run(self):
+        while True:
+            with self.condition:
+                entry = self._next_expired_entry()
+            if not entry:
+                return
+            deadline, token, key = entry
+            self.callback(key, token)
 
-runner_lock = threading.RLock()
+class BackgroundCall(object):
+    """Call a function in a thread. get() waits for its return value."""
+
+    def __init__(self, function, *args):
+        self.value = None
+        self.exc_info = None
+        self.thread = threading.Thread(target=self._run, args=(function, args))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self, function, args):
+        try:
+            self.value = function(*args)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def get(self):
+        """Return the value returned by the function or raise the exception
+        it raised."""
+        self.thread.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class BrowserWorker(object):
+    """State of one browser running tests.
+
+    Each worker has its own hang deadline and running test, so that several
+    browsers can run the tests of the Runner at the same time. The tests are
+    handed out to the workers by Runner.next_test(). In interactive mode, there
+    is a single worker without a browser.
+    """
+
+    def __init__(self, runner, worker_id, browser=None):
+        self.runner = runner
+        self.id = worker_id
+        self.browser = browser
+        if browser:
+            browser.worker_id = worker_id
+        self.initializing = False
+        self._ua_string = None
+        self.reset()
+
+    def reset(self):
+        self.stop_hang_timer()
+        self.running_test = None
+        # When test_started() was first called for the running test.
+        self.test_start_time = None
+        self.last_hung_testid = None
+        # Identifiers of the tests which got a result while running in
+        # this worker.
+        self.finished_testids = []
+        if not self.browser:
+            self._ua_string = None
+
+    def _get_ua_string(self):
+        if self.browser:
+            return self.browser.ua_string
+        return self._ua_string
+
+    def _set_ua_string(self, value):
+        if self.browser:
+            self.browser.ua_string = value
+            return
+        self._ua_string = value
+
+    ua_string = property(_get_ua_string, _set_ua_string)
+
+    def is_running(self, testid):
+        return bool(self.running_test) and self.running_test["id"] == testid
+
+    def start_hang_timer(self):
+        timeout = self.runner.options.timeout
+        if timeout <= 0:
+            return
+        self.stop_hang_timer()
+        self.runner.watchdog.arm(self, timeout * SERVER_HANG_TIMER_RATIO)
+
+    def stop_hang_timer(self):
+        if self.runner.watchdog.disarm(self):
+            self.last_hung_testid = None
+
+    def get_metadata(self):
+        metadata = {}
+        if not self.browser:
+            return metadata
+
+        metadata["browser_info.platform"] = \
+            self.browser.browser_info.platform
+        metadata["browser_info.name"] = self.browser.browser_info.name
+        metadata["browser_info.path"] = self.browser.browser_info.path
+        metadata["ua_string"] = self.browser.ua_string
+
+        metadata["system"] = platform.system()
+        if platform.system() == "Windows":
+            metadata["win32_ver"] = platform.win32_ver()
+        elif platform.system() == "Darwin":
+            metadata["mac_ver"] = platform.mac_ver()
+        elif platform.system() == "Linux":
+            metadata["linux_distribution"] = platform.linux_distribution()
+        return metadata
 
 class Runner(object):
     def __init__(self, options, start_loop=True):
         self.options = options
         self.running = False
         self.last_test_store = None
-        self.running_test = None
-        self.hang_timer = None
-        self.last_hung_testid = None
         self.start_loop = start_loop
         self.batch = False
-        # TODO: rename to browsers when implementing multiple browser support.
+        self.browsers = []
+        # The first browser of self.browsers.
         self.browser = None
-        self.active_browser = None
+        self.watchdog = HangWatchdog(self._hang_timer_callback)
+        self.workers = [BrowserWorker(self, 0)]
+        # Protects the status, the tests and the workers. It is only held for
+        # short updates: the tests are loaded and saved and the browsers are
+        # relaunched without holding it, so that the RPCs of the other
+        # browsers are not blocked meanwhile.
+        self.lock = threading.RLock()
+        # Serializes the loading of tests.
+        self.load_lock = threading.Lock()
         self.tests_finished_event = threading.Event()
         self.end_event = threading.Event()
+        # True when the current tests may be followed by another batch, see
+        # _main_loop().
+        self.next_batch_pending = False
+        self.tests = TestTable()
         self.reset()
-        self.webapp = WebApp(self)
+        self.webapp = WebApp(self, options.host, options.port,
+                             options.webapp_workers)
 
         # Guard in an exception handler so that the webapp can shutdown if
         # there's an exception raised in _post_init().
@@ -66,20 +262,57 @@ class Runner(object):
         except:
             traceback.print_exc()
 
+    def _find_browser(self, name_or_path):
+        name = path = None
+        if len(os.path.split(name_or_path)) > 1:
+            name = name_or_path
+        else:
+            path = name_or_path
+
+        browser_info = BrowserInfo(name=name, path=path)
+        browser = browsers_manager.find_browser(browser_info)
+        log.info("Using browser: %s", browser)
+        return browser
+
+    def _find_browsers(self, name_or_path):
+        """Return the pool of browser instances to use for a --browser
+        option."""
+        instances = self.options.browser_instances
+        browsers = [self._find_browser(name_or_path) for
+                    i in range(instances)]
+        for browser in browsers:
+            browser.runner_url = self.webapp.server_url
+        return browsers
+
+    def _pool_browsers(self, browsers):
+        """Mark the browsers of a type used more than once as pooled, so
+        that each instance only handles its own process."""
+        by_name = {}
+        for browser in browsers:
+            by_name.setdefault(browser.name, []).append(browser)
+        for name, same_browsers in by_name.iteritems():
+            if len(same_browsers) < 2:
+                continue
+            if not same_browsers[0].allows_several_instances:
+                raise BrowserException("Browser %s can't run several "
+                                       "instances at the same time" % name)
+            for browser in same_browsers:
+                browser.pooled = True
+
     def _post_init(self):
-        if self.options.browser:
+        browsers = self.options.browser
+        if isinstance(browsers, basestring):
+            browsers = [browsers]
+        if browsers:
             # Batch mode is active if there's a browser to control.
             self.batch = True
-
-            name = path = None
-            if len(os.path.split(self.options.browser)) > 1:
-                name = self.options.browser
-            else:
-                path = self.options.browser
-
-            browser_info = BrowserInfo(name=name, path=path)
-            self.browser = browsers_manager.find_browser(browser_info)
-            log.info("Using browser: %s", self.browser)
+            self.browsers = []
+            for name_or_path in browsers:
+                self.browsers.extend(self._find_browsers(name_or_path))
+            self._pool_browsers(self.browsers)
+            self.browser = self.browsers[0]
+            self.workers = [BrowserWorker(self, worker_id, browser) for
+                            (worker_id, browser) in enumerate(self.browsers)]
 
         store_info = self._options_to_store_info(self.options)
 
@@ -95,7 +328,7 @@ class Runner(object):
                 self.load_tests(store_info)
 
             log.info("The runner is started. You should now point your "
-                     "browser to http://localhost:8888/")
+                     "browser to %s", self.webapp.server_url)
             self.status = STOPPED
 
         self.running = True
@@ -114,24 +347,60 @@ class Runner(object):
         self.end_event.set()
 
     def _get_ua_string(self):
-        if self.batch:
-            if not self.active_browser:
-                return None
-            return self.active_browser.ua_string
-        return self._ua_string
+        return self.workers[0].ua_string
 
     def _set_ua_string(self, value):
-        if self.batch:
-            if not self.active_browser:
-                assert not value
-                return
-            assert self.active_browser
-            self.active_browser.ua_string = value
-            return
-        self._ua_string = value
+        self.workers[0].ua_string = value
 
     ua_string = property(_get_ua_string, _set_ua_string)
 
+    def _get_worker(self, worker_id):
+        """Return the worker with the given identifier.
+
+        When worker_id is None, the only worker is returned, or None if there
+        are several workers.
+        """
+        if worker_id is None or worker_id == "":
+            if len(self.workers) == 1:
+                return self.workers[0]
+            return None
+        try:
+            return self.workers[int(worker_id)]
+        except (ValueError, IndexError):
+            raise Exception("Unknown worker identifier %r" % worker_id)
+
+    def _get_test_worker(self, testid):
+        """Return the worker running (or which last ran) the given test."""
+        for worker in self.workers:
+            if worker.is_running(testid) or worker.last_hung_testid == testid:
+                return worker
+        if len(self.workers) == 1:
+            return self.workers[0]
+        raise Exception("Test with identifier %s is not running in any "
+                        "browser" % testid)
+
+    def match_user_agent(self, ua_string, worker_id=None):
+        """Check the user agent of a request made to the webapp.
+
+        The first request of a worker (the one loading the runner page)
+        records its user agent. Returns False if the user agent doesn't match
+        the one of any worker.
+
+        This is called for every request, so the lock is only taken to record
+        a user agent.
+        """
+        try:
+            worker = self._get_worker(worker_id)
+        except Exception:
+            worker = None
+        if worker and not worker.ua_string:
+            with self.lock:
+                if not worker.ua_string:
+                    worker.ua_string = ua_string
+                    return True
+        ua_strings = [w.ua_string for w in self.workers if w.ua_string]
+        return not ua_strings or ua_string in ua_strings
+
     def _options_to_store_info(self, options):
         store_infos = []
         for store_class in teststores.STORES:
@@ -158,21 +427,28 @@ class Runner(object):
     def _main_loop(self):
         log.debug("in main_loop %s", self)
 
+        # When the store can prefetch, the next batch of tests is fetched and
+        # the results of the previous one are saved while the tests run, and
+        # the browsers keep running from one batch to the next one (next_test()
+        # tells them to wait for the next batch).
+        batch = None
+        save_call = None
         try:
-            # TODO: remove once multiple browser support is implemented.
-            self.active_browser = self.browser
-            # The browser is launched before the tests are loaded from the
-            # store, so that we can get the useragent string and give it to
-            # the store.
-            self.browser.terminate()
+            # The browsers are launched before the tests are loaded from the
+            # store, so that we can get the useragent strings and give them
+            # to the store.
+            for browser in self.browsers:
+                browser.terminate()
 
             while True:
                 log.info("Loading tests...")
                 self.set_status(INITIALIZING, "Initializing browser.")
-                self.active_browser.launch()
+                for browser in self.browsers:
+                    if batch is None or not browser.is_alive():
+                        browser.launch()
 
-                with runner_lock:
-                    found_tests = self._do_load_tests()
+                with self.load_lock:
+                    found_tests = self._do_load_tests(batch)
 
                 self.set_status(RUNNING, "Running tests.", True)
                 if not found_tests:
@@ -180,77 +456,116 @@ class Runner(object):
                     log.info("No tests found, terminating")
                     break
 
+                prefetch_call = None
+                if self.test_store.prefetch and not self.test_store.load_once:
+                    self.next_batch_pending = True
+                    prefetch_call = BackgroundCall(self.test_store.fetch,
+                                                   self._get_metadata())
+
                 log.debug("Waiting for tests to finish...")
                 self.tests_finished_event.wait()
                 self.tests_finished_event.clear()
                 log.debug("...Finished waiting for end of tests")
 
-                self._do_save_tests()
+                if save_call:
+                    save_call.get()
+                    save_call = None
+                if prefetch_call:
+                    # reset() below drops the references to the screenshots
+                    # of the results, so the save keeps its own until it is
+                    # done.
+                    blob_ids = self._get_blob_ids(self.tests)
+                    self.webapp.blob_store.retain(blob_ids)
+                    save_call = BackgroundCall(self._do_save_tests, self.tests,
+                                               blob_ids)
+                else:
+                    self._do_save_tests()
                 if self.status == ERROR:
                     break
 
                 self.reset()
                 if self.test_store.load_once:
                     break
+                if prefetch_call:
+                    batch = prefetch_call.get()
         except Exception, e:
             self.set_status(ERROR, "Exception in _main_loop: %s" % e)
             if self.tests:
                 self._do_save_tests()
 
+        self.next_batch_pending = False
+        if save_call:
+            try:
+                save_call.get()
+            except Exception, e:
+                self.set_status(ERROR, "Exception while saving tests: %s" % e)
+
         if self.status == ERROR:
             log.error("\n\nError encountered while running tests, "
                       "terminating.\n Status message: %s\n\n",
                       self.status_message)
 
-        self.browser.cleanup()
+        self.watchdog.stop()
+        for browser in self.browsers:
+            browser.cleanup()
         self.running = False
-        self.webapp.running = False
+        self.webapp.stop()
         self.end_event.set()
 
     def _set_tests(self, tests):
+        if not isinstance(tests, TestTable):
+            tests = TestTable(tests)
         self.tests = tests
-        self.testid_to_test = dict([(test["id"], test) for test in self.tests])
+        self.testid_to_test = self.tests.by_id
+        self._fill_pending_testids()
         self.finished_tests_count = 0
         self.status = STOPPED
 
-    def _get_metadata(self):
-        metadata = {}
-        if self.active_browser:
-            metadata["browser_info.platform"] = \
-                self.active_browser.browser_info.platform
-            metadata["browser_info.name"] = \
-                self.active_browser.browser_info.name
-            metadata["browser_info.path"] = \
-                self.active_browser.browser_info.path
-            metadata["ua_string"] = self.active_browser.ua_string
-
-            metadata["system"] = platform.system()
-            if platform.system() == "Windows":
-                metadata["win32_ver"] = platform.win32_ver()
-            elif platform.system() == "Darwin":
-                metadata["mac_ver"] = platform.mac_ver()
-            elif platform.system() == "Linux":
-                metadata["linux_distribution"] = platform.linux_distribution()
+    def _fill_pending_testids(self):
+        # Queue of the tests to hand out to the workers.
+        self.pending_testids = collections.deque(
+            test["id"] for test in self.tests if not "result" in test)
 
+    def _get_metadata(self):
+        metadata = self.workers[0].get_metadata()
+        if len(self.workers) > 1:
+            metadata["workers"] = [worker.get_metadata() for
+                                   worker in self.workers]
         return metadata
 
-    def _do_load_tests(self):
-        tests = self.test_store.load(self._get_metadata())
-        self.last_test_store = self.test_store
-
-        self._set_tests(tests)
+    def _do_load_tests(self, batch=None):
+        """Load the tests from the store, or the ones of a batch prefetched
+        with TestStore.fetch()."""
+        if batch is None:
+            tests = self.test_store.load(self._get_metadata())
+        else:
+            tests = self.test_store.install(batch)
+        with self.lock:
+            self.last_test_store = self.test_store
+            self._set_tests(tests)
         return len(tests) > 0
 
-    @synchronized(runner_lock)
-    def _do_save_tests(self):
-        self.test_store.save(self._get_metadata())
+    def _do_save_tests(self, tests=None, blob_ids=()):
+        # This is called once all the tests have a result, so the lock isn't
+        # needed to read them.
+        try:
+            self.test_store.save(self._get_metadata(), tests)
+        finally:
+            self.webapp.blob_store.remove(blob_ids)
 
-    def _stop_hang_timer(self):
-        if not self.hang_timer:
-            return
-        self.hang_timer.cancel()
-        self.hang_timer = None
-        self.last_hung_testid = None
+    def _get_blob_ids(self, tests):
+        blob_ids = []
+        for test in tests:
+            if "result" in test:
+                blob_ids.extend(get_result_blob_ids(test["result"]))
+        return blob_ids
+
+    def _release_blobs(self, tests):
+        """Drop the references of the results of the given tests to their
+        screenshots."""
+        blob_ids = self._get_blob_ids(tests)
+        if blob_ids:
+            self.webapp.blob_store.remove(blob_ids)
 
     def _ensure_status(self, *allowed_statuses):
         if self.status in allowed_statuses:
@@ -259,98 +574,132 @@ class Runner(object):
                         STATUS_TO_NAME[self.status],
                         [STATUS_TO_NAME[s] for s in allowed_statuses]))
 
-    @synchronized(runner_lock)
+    @synchronized
     def reset(self):
-        self._stop_hang_timer()
+        for worker in self.workers:
+            worker.reset()
         self.status = STOPPED
         self.status_message = ""
-        self._ua_string = None
-        self.testid_to_test = {}
+        self._release_blobs(self.tests)
+        self.tests = TestTable()
+        self.testid_to_test = self.tests.by_id
+        self._fill_pending_testids()
         if self.last_test_store:
             self.last_test_store.cleanup()
             self.last_test_store = None
 
-        self.tests = []
-
-    @synchronized(runner_lock)
+    @synchronized
     def clear_results(self):
         self._ensure_status(STOPPED, RUNNING, FINISHED)
+        self._release_blobs(self.tests)
         for test in self.tests:
             if "result" in test:
                 del test["result"]
-
-    @synchronized(runner_lock)
-    def get_state(self):
-        """Return a JSONifiable object representing the Runner state."""
-        state = {
-            "status": self.status,
-            "status_message": self.status_message,
-            "ua_string": self.ua_string,
-            "batch": self.batch,
-            "timeout": self.options.timeout,
-        }
-        state["tests"] = self.tests
+            if "duration" in test:
+                del test["duration"]
+        self._fill_pending_testids()
+
+    def get_state(self, worker_id=None):
+        """Return a JSONifiable object representing the Runner state.
+
+        If worker_id is given, the status and user agent are the ones seen by
+        that worker.
+        """
+        with self.lock:
+            worker = self._get_worker(worker_id) or self.workers[0]
+            status = self.status
+            if worker.initializing:
+                status = INITIALIZING
+            state = {
+                "status": status,
+                "status_message": self.status_message,
+                "ua_string": worker.ua_string,
+                "batch": self.batch,
+                "timeout": self.options.timeout,
+            }
+            # Only the columns of the test table are copied under the lock.
+            tests = self.tests.snapshot()
+        # The dicts are built from the snapshot, without blocking the other
+        # requests, and aren't kept after the call.
+        state["tests"] = tests.to_list()
         return state
 
-    @synchronized(runner_lock)
     def load_tests(self, store_info):
         log.info("Loading tests using store_info: %s", store_info)
-        self._ensure_status(STOPPED, FINISHED)
-        self.reset()
-
-        self.test_store = self._create_store(store_info)
-        if not self.test_store:
-            raise Exception("Can't find a store for store_info %s", store_info)
+        with self.load_lock:
+            with self.lock:
+                self._ensure_status(STOPPED, FINISHED)
+                self.reset()
 
-        self._do_load_tests()
+                self.test_store = self._create_store(store_info)
+                if not self.test_store:
+                    raise Exception("Can't find a store for store_info %s",
+                                    store_info)
 
-    def _do_hang_timer_callback(self):
-        self.hang_timer = None
-        self._ensure_status(RUNNING)
+            self._do_load_tests()
 
-        # XXX investigate how this sometimes happen.
-        if not self.running_test:
-            log.error("No running test when hang timer fired. "
-                      "How did that happen?")
-            return
+    def _do_hang_timer_callback(self, worker, token):
+        with self.lock:
+            if not self.watchdog.expire(worker, token):
+                # The test finished or was started again while the deadline
+                # was expiring.
+                return
+            self._ensure_status(RUNNING, FINISHED)
 
-        log.info("Detected hang while running test %s",
-                 self.running_test["id"])
-        self.last_hung_testid = self.running_test["id"]
+            # XXX investigate how this sometimes happen.
+            if not worker.running_test:
+                log.error("No running test when hang timer fired. "
+                          "How did that happen?")
+                return
 
-        status = "timeout"
-        status_message = "Timeout detected from server side"
+            testid = worker.running_test["id"]
+            log.info("Detected hang while running test %s", testid)
 
-        if self.browser and not self.browser.is_alive():
-            log.debug("Detected browser crash")
-            status = "crash"
-            status_message = "Browser crash detected from server side"
+            status = "timeout"
+            status_message = "Timeout detected from server side"
 
-        self.set_result(self.running_test["id"], {
-            "status": status,
-            "status_message": status_message,
-        }, True)
-        self.running_test = None
+            if worker.browser and not worker.browser.is_alive():
+                log.debug("Detected browser crash")
+                status = "crash"
+                status_message = "Browser crash detected from server side"
 
-        if self.tests_finished_event.is_set():
-            return
+            worker.last_hung_testid = testid
+            self.set_result(testid, {
+                "status": status,
+                "status_message": status_message,
+            }, True)
 
-        if self.active_browser:
-            self.set_status(INITIALIZING, "Initializing browser.")
-            try:
-                self.active_browser.launch()
-                self.set_status(RUNNING, "Running after browser restart.", True)
-            except BrowserException, e:
-                self.set_status(ERROR, "Exception while restarting the "
-                                       "browser: %s" % e)
+            if self.tests_finished_event.is_set() or not worker.browser:
+                return
+            worker.initializing = True
+
+        # Only this worker is restarted, the other ones keep running tests.
+        # Relaunching the browser can take a while, so it is done in another
+        # thread to let the watchdog check the deadlines of the other
+        # workers in the meantime.
+        thread = threading.Thread(target=self._relaunch_browser,
+                                  args=(worker,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _relaunch_browser(self, worker):
+        try:
+            worker.browser.launch()
+        except BrowserException, e:
+            self.set_status(ERROR, "Exception while restarting the "
+                                   "browser: %s" % e)
+        except Exception, e:
+            self.set_status(ERROR, "Error in _relaunch_browser: %s" % e)
+        finally:
+            worker.initializing = False
 
-    def _hang_timer_callback(self):
+    def _hang_timer_callback(self, worker, token):
         try:
-            self._do_hang_timer_callback()
+            self._do_hang_timer_callback(worker, token)
         except Exception, e:
             self.set_status(ERROR, "Error in _hang_timer_callback: %s" % e)
 
-    @synchronized(runner_lock)
+    @synchronized
     def set_status(self, status, message, allow_leaving_initializing=False):
         if (not allow_leaving_initializing and
             self.status == INITIALIZING and
@@ -371,7 +720,8 @@ class Runner(object):
         self.status_message = message
 
         if status == ERROR:
-            self._stop_hang_timer()
+            for worker in self.workers:
+                worker.stop_hang_timer()
             self.tests_finished_event.set()
 
     def _get_test(self, testid):
@@ -379,7 +729,74 @@ class Runner(object):
             raise Exception("Test with identifier %s not found" % testid)
         return self.testid_to_test[testid]
 
-    @synchronized(runner_lock)
+    def next_test(self, worker_id=None):
+        """Hand out the next test to run to a worker.
+
+        Return a dict whose "testid" is None when there are no more tests to
+        run. In that case, "wait" is True if the worker should ask again
+        later: reftests compare screenshots of the whole screen, so a reftest
+        only runs while no other browser is running a test (the other
+        browsers wait meanwhile), and the tests of the next batch may be on
+        their way.
+        """
+        next_test, front_browser = self._next_test(worker_id)
+        if front_browser:
+            # No other test starts while the reftest runs, so this is done
+            # outside of the lock.
+            try:
+                front_browser.move_front()
+            except Exception, e:
+                self.set_status(ERROR, "Exception while moving the browser "
+                                       "to the front: %s" % e)
+                return {"testid": None, "wait": False}
+        return next_test
+
+    @synchronized
+    def _next_test(self, worker_id):
+        worker = self._get_worker(worker_id)
+        if not worker:
+            raise Exception("A worker identifier is needed when running "
+                            "several browsers")
+        # The other statuses can be seen by browsers asking for a test after
+        # the last one finished.
+        if self.status != RUNNING:
+            wait = self.next_batch_pending and self.status != ERROR
+            return {"testid": None, "wait": wait}, None
+
+        other_tests = [w.running_test for w in self.workers if
+                       w is not worker and w.running_test]
+        # The screen is held by a running reftest.
+        if [t for t in other_tests if t["type"] == "reftest"]:
+            return {"testid": None, "wait": True}, None
+
+        testid = None
+        while self.pending_testids:
+            candidate = self.pending_testids.popleft()
+            test = self.testid_to_test[candidate]
+            if ("result" in test or
+                [w for w in self.workers if w.is_running(candidate)]):
+                continue
+            if test["type"] == "reftest" and other_tests:
+                # Keep the reftest first, so that no other test starts until
+                # the other browsers are done and the screen is free.
+                self.pending_testids.appendleft(candidate)
+                return {"testid": None, "wait": True}, None
+            testid = candidate
+            break
+
+        front_browser = None
+        if testid:
+            worker.stop_hang_timer()
+            worker.running_test = self.testid_to_test[testid]
+            # The window of another browser could cover the screen the
+            # screenshots of the reftest are taken from.
+            if (worker.running_test["type"] == "reftest" and worker.browser and
+                len(self.workers) > 1):
+                front_browser = worker.browser
+        wait = not testid and self.next_batch_pending
+        return {"testid": testid, "wait": wait}, front_browser
+
+    @synchronized
     def test_started(self, testid):
         log.info("Test %s started", testid)
         self._ensure_status(RUNNING)
@@ -388,86 +805,127 @@ class Runner(object):
             raise Exception("Starting a test which already has a result "
                             "(test id: %s, existing result: %s)" % (
                             testid, test["result"]))
-        self.running_test = test
-
-        if self.options.timeout <= 0:
-            return
-        # How much to multiply the timeout duration to get the server side
-        # waiting time. The intention is to have a timeout larger than
-        # the timout used in the client-side harness to allow it to catch
-        # hangs first.
-        SERVER_HANG_TIMER_RATIO = 1.2
-        self._stop_hang_timer()
-        self.hang_timer = threading.Timer(self.options.timeout *
-                                          SERVER_HANG_TIMER_RATIO,
-                                          self._hang_timer_callback)
-        self.hang_timer.start()
-
-    def _ensure_running_test(self, testid):
-        if not self.running_test:
+        worker = self._get_test_worker(testid)
+        if worker.initializing:
+            raise Exception("Starting a test while the browser is "
+                            "initializing (test id: %s)" % testid)
+        worker.running_test = test
+        # test_started() is called again when the timer is resumed.
+        if worker.test_start_time is None:
+            worker.test_start_time = time.time()
+        worker.start_hang_timer()
+
+    def _ensure_running_test(self, worker, testid):
+        if not worker.running_test:
             raise Exception("test_started wasn't called")
-        if testid != self.running_test["id"]:
+        if testid != worker.running_test["id"]:
             raise Exception("test_started was called with a different "
                             "test id (old: %s, new: %s)" %
-                            (self.running_test["id"], testid))
+                            (worker.running_test["id"], testid))
 
-    @synchronized(runner_lock)
+    @synchronized
     def suspend_timer(self, testid, suspended):
         log.debug("suspend_timer testid: %s, suspended: %s", testid, suspended)
         self._ensure_status(RUNNING, STOPPED)
         test = self._get_test(testid)
-        self._ensure_running_test(testid)
+        worker = self._get_test_worker(testid)
+        self._ensure_running_test(worker, testid)
 
         if suspended:
-            self._stop_hang_timer()
+            worker.stop_hang_timer()
         else:
             self.test_started(testid)
 
-    @synchronized(runner_lock)
+    @synchronized
     def set_result(self, testid, result, did_start_notify):
+        stored = False
+        try:
+            stored = self._set_result(testid, result, did_start_notify)
+        finally:
+            if result and not stored:
+                # Nothing references the screenshots of an ignored result.
+                self._release_blobs([{"result": result}])
+
+    def _set_result(self, testid, result, did_start_notify):
+        """Set the result of a test, or clear it if result is None. Returns
+        True if the result was stored."""
         log.info("Saving result for testid: %s", testid)
         self._ensure_status(RUNNING, STOPPED, FINISHED)
 
-        self._stop_hang_timer()
         test = self._get_test(testid)
+        worker = self._get_test_worker(testid)
+        worker.stop_hang_timer()
 
         if did_start_notify:
             # The last_hung_testid instance variable and this check are
             # used to ignore the rare case when a test finishes after a hang
             # was detected. It could happen if the tests used an alert() which
             # would freeze the client side timeout.
-            if (not self.running_test and self.last_hung_testid and
-                self.last_hung_testid == testid):
+            if (not worker.running_test and worker.last_hung_testid and
+                worker.last_hung_testid == testid):
                 log.info("Detecting a test which completed after a timout"
                          "was detected on the server side, ignoring the result")
-                self.last_hung_testid = None
-                return
-            self._ensure_running_test(testid)
-        self.running_test = None
+                worker.last_hung_testid = None
+                return False
+            self._ensure_running_test(worker, testid)
+        worker.running_test = None
+        start_time, worker.test_start_time = worker.test_start_time, None
 
         if not result:
             if not "result" in test:
                 raise Exception("Test with id %s has no result to clear" %
                                 testid)
+            self._release_blobs([test])
             del test["result"]
+            if "duration" in test:
+                del test["duration"]
             self.finished_tests_count -= 1
         else:
             if "result" in test:
                 raise Exception("Overwriting an existing result for test id %s" %
                                 testid)
             test["result"] = result
+            if did_start_notify and start_time is not None:
+                # Used by the stores to size the batches of tests.
+                test["duration"] = time.time() - start_time
+            if self.last_test_store:
+                self.last_test_store.result_added(test)
+            worker.finished_testids.append(testid)
             self.finished_tests_count += 1
 
         if self.finished_tests_count == len(self.tests):
             log.info("All tests finished")
+            for worker in self.workers:
+                log.debug("Worker %s ran %s tests", worker.id,
+                          len(worker.finished_testids))
+            if self.batch and self.status == RUNNING:
+                self.set_status(FINISHED, "All tests completed")
             self.tests_finished_event.set()
+        return bool(result)
 
 def main():
     parser = optparse.OptionParser(
         usage='%prog [OPTIONS]')
     parser.add_option('--browser',
+        action="append",
         help="Name or absolute path to the browser to use for running the "
-             "tests")
+             "tests. Can be given several times to run the tests in several "
+             "browsers in parallel")
+    parser.add_option("--browser-instances",
+        action="store", type="int", default=1,
+        help="Number of instances of each browser running tests in "
+             "parallel. Each instance uses its own temporary profile")
+    parser.add_option("--host",
+        default=WEBAPP_HOST,
+        help="Host name of the web server used in the tests URLs"),
+    parser.add_option("--port",
+        action="store", type="int", default=WEBAPP_PORT,
+        help="Port of the web server. Set to 0 to use a free port chosen by "
+             "the system."),
+    parser.add_option("--webapp-workers",
+        action="store", type="int", default=WEBAPP_WORKERS,
+        help="Number of threads handling the requests made to the web "
+             "server."),
     parser.add_option("--nouacheck",
         action="store_true", default=False,
         help="Disable the same user agent check. Only use when debugging."),
@@ -1,9 +1,24 @@
+# Stores give the URLs of the tests relative to this URL, the default address
+# of the webapp. They are rebased on the actual address of the webapp with
+# rebase_url().
+SERVER_URL = "http://localhost:8888/"
+
+def rebase_url(url, server_url):
+    """Replace the SERVER_URL prefix of url with server_url."""
+    if not url or not url.startswith(SERVER_URL):
+        return url
+    return server_url + url[len(SERVER_URL):]
+
 class StoreException(Exception):
     pass
 
 class TestStore(object):
     # Subclasses that can load tests multiple times should set this to False.
     load_once = True
+    # Stores loading the tests in several batches set this to True if the
+    # next batch can be fetched while the tests of the current one are
+    # running, see fetch() and install().
+    prefetch = False
 
     def __init__(self, runner, store_info):
         self.runner = runner
@@ -16,10 +31,43 @@ class TestStore(object):
         tests."""
         raise NotImplemented()
 
-    def save(self, metadata):
-        """Save the tests results."""
+    def fetch(self, metadata):
+        """Fetch the next batch of tests, without changing the environment
+        of the tests currently running.
+
+        Only used when prefetch is True. The returned object is given to
+        install()."""
+        raise NotImplementedError()
+
+    def install(self, batch):
+        """Setup the environment for running a batch returned by fetch() and
+        return its tests as a list."""
+        raise NotImplementedError()
+
+    def result_added(self, test):
+        """Called when a test gets a result, while the runner holds its lock.
+
+        Implementors must not block. Results should still be saved by
+        save()."""
+        pass
+
+    def save(self, metadata, tests=None):
+        """Save the results of the given tests (the tests of the runner by
+        default)."""
         pass
 
+    def rebase_test_urls(self, tests):
+        """Make the URLs of the given tests point to the webapp, which may
+        not listen on the default host and port."""
+        server_url = self.runner.webapp.server_url
+        if server_url == SERVER_URL:
+            return tests
+        for test in tests:
+            for key in ("url", "url2"):
+                if test.get(key):
+                    test[key] = rebase_url(test[key], server_url)
+        return tests
+
     def cleanup(self):
         """Cleanup everything the loader has setup for running the tests."""
         pass
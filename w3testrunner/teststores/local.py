@@ -1,15 +1,22 @@
 from __future__ import with_statement
+import cPickle
+import fnmatch
 import hashlib
 import itertools
 import logging
+import multiprocessing
 import os.path
 from os.path import join
+import posixpath
 import re
 import sys
+import threading
 import time
 import urlparse
 
-from w3testrunner.teststores.common import TestStore, StoreException
+from w3testrunner.teststores.common import TestStore, StoreException, \
+                                           SERVER_URL
+from w3testrunner.testtable import TestTable
 
 log = logging.getLogger(__name__)
 
@@ -18,12 +25,107 @@ log = logging.getLogger(__name__)
 def joinposix(*paths):
     return '/'.join(paths)
 
+def file_signature(path):
+    """Return a tuple identifying the state of the file at path.
+
+    The tuple changes whenever the file is modified, or replaced by another
+    file."""
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+
+def _diff_path(path):
+    path = path.split("\t")[0].strip()
+    if path == "/dev/null":
+        return None
+    if path.startswith("a/") or path.startswith("b/"):
+        path = path[2:]
+    return path
+
+def parse_changes(lines):
+    """Parse a list of changed files, or a unified diff.
+
+    Returns a dict mapping the changed paths to the list of added ("+" prefix)
+    and removed ("-" prefix) lines of the file, or to None if the file
+    content changes are not known."""
+    lines = [line.rstrip("\r\n") for line in lines]
+    changes = {}
+    if not [line for line in lines if line.startswith("+++ ")]:
+        for line in lines:
+            line = line.strip()
+            if line:
+                changes[line] = None
+        return changes
+
+    old_path = None
+    file_lines = None
+    old_count = new_count = 0
+    for line in lines:
+        # Hunk lines are counted so that a removed line starting with "-- "
+        # isn't taken for a file header.
+        if old_count > 0 or new_count > 0:
+            if line.startswith("-"):
+                old_count -= 1
+            elif line.startswith("+"):
+                new_count -= 1
+            elif not line.startswith("\\"):
+                old_count -= 1
+                new_count -= 1
+            if line[:1] in ("-", "+"):
+                file_lines.append(line)
+            continue
+        m = HUNK_HEADER_RE.match(line)
+        if m and file_lines is not None:
+            old_count = int(m.group(1) or 1)
+            new_count = int(m.group(2) or 1)
+        elif line.startswith("diff --git "):
+            # Also gives the files without content changes (such as binary
+            # files) which don't have ---/+++ headers.
+            file_lines = None
+            for path in line.split()[2:4]:
+                path = _diff_path(path)
+                if path:
+                    changes.setdefault(path, None)
+        elif line.startswith("--- "):
+            old_path = _diff_path(line[4:])
+        elif line.startswith("+++ "):
+            new_path = _diff_path(line[4:])
+            file_lines = []
+            for path in (old_path, new_path):
+                if path:
+                    changes[path] = file_lines
+    return changes
+
 class Test(object):
+    # Tests are created for each file or reftest line, use slots to keep them
+    # small.
+    ATTRIBUTES = (
+        "_flags", "id", "full_id", "type", "url", "file", "hash",
+        "resources", "test_resources", "missing_resources", "text_markers",
+        # layouttests
+        "expected_path", "exp_content",
+        # reftests
+        "equal", "expected", "failure_type", "url2", "file2",
+    )
+    __slots__ = ATTRIBUTES
+
     def __init__(self):
         self._flags = set()
         self.full_id = None
 
-SERVER_URL = "http://localhost:8888/"
+    def get_attributes(self):
+        """Return a dict of the attributes set on this test."""
+        return dict((name, getattr(self, name)) for name in self.ATTRIBUTES
+                    if hasattr(self, name))
+
+    def set_attributes(self, attributes):
+        for name, value in attributes.iteritems():
+            setattr(self, name, value)
+
+    # Tests are pickled when sent back from the extraction workers.
+    __getstate__ = get_attributes
+    __setstate__ = set_attributes
 
 class ImportedTest(object):
     TEXT_EXTENSIONS = ["css", "html", "xhtml", "js", "xml", "svg"]
@@ -34,10 +136,26 @@ class ImportedTest(object):
 
     metadata = None
     file_based = True
+    # ResourceGraph shared by the tests extracted from the same directory.
+    resource_graph = None
+
+    __slots__ = ("testid",)
 
     def __init__(self, testid):
         self.testid = testid
 
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def __eq__(self, other):
         """Two tests of different type are equal if they have the same testid.
         The purpose it to avoid having two different tests with the same id in
@@ -72,41 +190,23 @@ class ImportedTest(object):
     def exists(self):
         raise NotImplementedError()
 
-    def _get_related_resources(self, resource):
-        def find_resources(resource):
-            full_path = join(self.tests_dir, resource)
-
-            ext = os.path.splitext(resource)[1][1:]
-            if not ext in self.TEXT_EXTENSIONS:
-                return set()
-
-            content = open(full_path).read()
-            iterators = [(m.groupdict()["url"] for m in regex.finditer(content)) for
-                            regex in [self.SRC_HREF_RE, self.CSS_URL_RE, self.CSS_IMPORT_RE]]
-
-            found_resources = set()
-            base = "/" + os.path.dirname(resource)
-            if not base.endswith("/"):
-                base += "/"
-
-            for url in itertools.chain(*iterators):
-                url = urlparse.urljoin(base, url)
-                # Only keep the path from the parsed url.  We check if the file
-                # exists on the filesystem in order to crawl that resource.
-                path = urlparse.urlparse(url).path[1:]
-                if not path or not os.path.isfile(join(self.tests_dir, path)):
-                    continue
-                found_resources.add(path)
-            return found_resources
-
-        tocrawl = set([resource])
-        all_resources = set([resource])
-        while tocrawl:
-            resources = find_resources(tocrawl.pop())
-            tocrawl.update(resources - all_resources)
-            all_resources.update(resources)
-
-        return all_resources
+    @classmethod
+    def _get_resource_graph(cls):
+        graph = ImportedTest.resource_graph
+        if not graph or graph.tests_dir != cls.tests_dir:
+            graph = ImportedTest.resource_graph = ResourceGraph(cls.tests_dir)
+        return graph
+
+    def _get_related_resources(self, resource, missing=None):
+        """Return the resources referenced directly or indirectly by resource.
+
+        The referenced paths that couldn't be found on the filesystem are
+        added to the missing set if one is given."""
+        resources, missing_resources = \
+            self._get_resource_graph().get_related_resources(resource)
+        if missing is not None:
+            missing.update(missing_resources)
+        return set(resources)
 
     def _add_flags(self, test, *args):
         test._flags.update(args)
@@ -130,16 +230,16 @@ class ImportedTest(object):
         if "xul" in extensions:
             self._add_flags(test, "moz", "moz:xul")
 
-        if "netscape.security" in test.resources_text_content or \
-           "EventUtils.js" in test.resources_text_content:
+        if "netscape.security" in test.text_markers or \
+           "EventUtils.js" in test.text_markers:
             self._add_flags(test, "moz", "moz:security")
-        if "Components.interfaces" in test.resources_text_content or \
-           "Components.classes" in test.resources_text_content:
+        if "Components.interfaces" in test.text_markers or \
+           "Components.classes" in test.text_markers:
             self._add_flags(test, "moz", "moz:prop_objects")
 
         # XXX not accurate. It should check against the hosts in
         # build/pgo/server-locations.txt
-        if "example.org" in test.resources_text_content:
+        if "example.org" in test.text_markers:
             self._add_flags(test, "proxy")
 
     def _fixup_test(self, test, path_as_id=None):
@@ -154,38 +254,40 @@ class ImportedTest(object):
         if not test.full_id:
             test.full_id = test.id
 
+        test.missing_resources = set()
         for r in test.test_resources:
-            test.resources.update(self._get_related_resources(r))
+            test.resources.update(self._get_related_resources(
+                r, test.missing_resources))
 
-        test.resources_content = ""
-        test.resources_text_content = ""
+        # The test hash is computed from the digests of its resources, which
+        # are computed once per file. The same goes for the markers found in
+        # the text resources which are used to compute the flags.
+        graph = self._get_resource_graph()
+        resources_hash = hashlib.md5()
+        test.text_markers = set()
 
         for r in sorted(test.resources):
-            res_path = join(self.tests_dir, r)
-            if not os.path.exists(res_path):
+            digest = graph.get_digest(r)
+            if not digest:
+                test.missing_resources.add(r)
                 continue
-            with open(res_path) as f:
-                content = f.read()
-                test.resources_content += content
-                if not os.path.splitext(r)[1][1:] in self.TEXT_EXTENSIONS:
-                    continue
-                # SimpleTest.js references Mozilla specific objects, but it
-                # does not use them if they are not available. So don't include
-                # that file in the content scanned for Mozilla specific objects.
-                if r == "tests/SimpleTest/SimpleTest.js":
-                    continue
-                test.resources_text_content += content
+            resources_hash.update(digest)
+            # SimpleTest.js references Mozilla specific objects, but it
+            # does not use them if they are not available. So don't include
+            # that file in the content scanned for Mozilla specific objects.
+            if r == "tests/SimpleTest/SimpleTest.js":
+                continue
+            test.text_markers.update(graph.get_text_markers(r))
 
-        test.hash = hashlib.md5(test.resources_content).hexdigest()
+        test.hash = resources_hash.hexdigest()
         self._compute_common_flags(test)
         self._compute_flags(test)
 
         if self.metadata:
             self.metadata.update_test(test)
 
-        # Could be large, so free them now.
-        del test.resources_content
-        del test.resources_text_content
+        # Only needed for computing the flags.
+        del test.text_markers
 
     @classmethod
     def get_imported_tests(cls, path):
@@ -194,14 +296,31 @@ class ImportedTest(object):
             return []
         return [itest]
 
+    @classmethod
+    def get_dependencies(cls, path):
+        """Return the paths, other than path and the resources of the tests,
+        that the tests imported from path depend on.
+
+        Paths that don't exist are included, their creation can change the
+        imported tests."""
+        return []
+
     @classmethod
     def update_dirty_itests(cls, resource, lines, dirty_itests):
+        """Add the imported tests added and deleted by a change of resource.
+
+        lines are the added and removed lines of a unified diff of resource.
+        dirty_itests is a dict with "added" and "deleted" sets to update.
+        Returns False if the change can't be handled this way, in which case
+        the tests of resource have to be imported again."""
         return False
 
     def create_test(self):
         raise NotImplementedError()
 
 class Mochitest(ImportedTest):
+    __slots__ = ("path",)
+
     def __init__(self, path):
         super(Mochitest, self).__init__(path)
         self.path = path
@@ -240,6 +359,8 @@ class Mochitest(ImportedTest):
 
 # XXX refactor duplicated code with Mochitest.
 class Browsertest(ImportedTest):
+    __slots__ = ("path",)
+
     def __init__(self, path):
         super(Browsertest, self).__init__(path)
         self.path = path
@@ -283,7 +404,9 @@ class Browsertest(ImportedTest):
 
 class Layouttest(ImportedTest):
     REPLACE_EXT_RE = re.compile("\.[^\.]*$")
-    LTC_CALLS_RE = re.compile("layoutTestController\.(\w+)")
+    LTC_CALL_PREFIX = "layoutTestController."
+
+    __slots__ = ("path",)
 
     def __init__(self, path):
         super(Layouttest, self).__init__(path)
@@ -360,7 +483,8 @@ class Layouttest(ImportedTest):
         #         test_file.replace(WEBKIT_FILE_PREFIX + "http", "")
         #log.debug("url: %s", url)
 
-        funcs = set(self.LTC_CALLS_RE.findall(test.resources_text_content))
+        funcs = set(m[len(self.LTC_CALL_PREFIX):] for m in test.text_markers
+                    if m.startswith(self.LTC_CALL_PREFIX))
         unprivilegedFuncs = set(["dumpAsText", "waitUntilDone", "notifyDone"])
 
         if "waitUntilDone" in funcs:
@@ -371,8 +495,7 @@ class Layouttest(ImportedTest):
             # TODO: save this for capability testing
             #test.pfuncs = privilegedFuncs
 
-        # XXX \b not working?
-        if re.search("\Walert\(|\Wprompt\(|\Wconfirm\(", test.resources_text_content):
+        if test.text_markers & set(["alert(", "prompt(", "confirm("]):
             self._add_flags(test, "ltalert")
 
         del test.exp_content
@@ -387,106 +510,128 @@ class Layouttest(ImportedTest):
         self._fixup_test(test, path_as_id=self.path)
         return test
 
-class Reftest(ImportedTest):
-    file_based = False
-    hash_id = True
-
-    def __init__(self, testid, full_id):
-        super(Reftest, self).__init__(testid)
-        self.full_id = full_id
+class ReftestManifest(object):
+    """A parsed reftest.list manifest.
+
+    The lines of a manifest are tokenized and parsed once when it is loaded.
+    Parsed manifests are cached by file signature, so that loading the tests
+    again doesn't parse the unchanged manifests."""
+    EXPECTED_PASS = 0
+    EXPECTED_FAIL = 1
+    EXPECTED_RANDOM = 2
+    EXPECTED_DEATH = 3  # test must be skipped to avoid e.g. crash/hang
+    EXPECTED_LOAD = 4 # test without a reference (just test that it does
+                      # not assert, crash, hang, or leak)
+
+    COMMENT_RE = re.compile("\s+#.*$")
+    MODIFIER_RE = re.compile("^(fails|random|skip|asserts)")
+    STATUS_IF_RE = re.compile("^(fails|random|skip)-if(\(.*\))$")
+    STATUS_RE = re.compile("^(fails|random|skip)$")
+    ASSERTS_RE = re.compile("^asserts\((\d+)(-\d+)?\)$")
+    ASSERTS_IF_RE = re.compile("^asserts-if\((.*?),(\d+)(-\d+)?\)$")
+    HTTP_DEPTH_RE = re.compile("HTTP\(\.\.(\/\.\.)*\)")
+    URI_QUERY_RE = re.compile("[\?#].*$")
+
+    # Maps the absolute path of the loaded manifests to a
+    # (signature, manifest) tuple.
+    _cache = {}
+
+    def __init__(self, path, entries, includes=()):
+        self.path = path
+        # List of (line_no, line, reftest) tuples for the lines defining a
+        # test, reftest being the dict returned by parse_line().
+        self.entries = entries
+        # Paths of the included manifests, relative to the tests directory.
+        self.includes = list(includes)
 
     @classmethod
-    def do_create_from_test(cls, test):
-        return cls(test.pk, test.full_id)
-
-    def exists(self):
-        assert self.file_based, "Should only called for file based tests"
+    def load(cls, tests_dir, path, signature):
+        """Return the parsed manifest at path (relative to tests_dir).
+
+        The manifest is only parsed again if its signature changed since it
+        was last loaded."""
+        full_path = join(tests_dir, path)
+        cached = cls._cache.get(full_path)
+        if cached and signature is not None and cached[0] == signature:
+            return cached[1]
+        with open(full_path) as f:
+            manifest = cls.parse(path, f)
+        cls._cache[full_path] = (signature, manifest)
+        return manifest
 
     @classmethod
-    def _build_testid(cls, manifest_path, line, use_hash=True):
-        if not cls.hash_id:
-            use_hash = False
-        dir, file = os.path.split(manifest_path)
-        paths = ["reftest:%s" % (hashlib.md5(line).hexdigest() if use_hash
-                                 else line)]
-        if dir:
-            paths.insert(0, dir)
-        return joinposix(*paths)
+    def parse(cls, path, lines):
+        entries = []
+        includes = []
+        dir = posixpath.dirname(path)
+        for (line_no, line) in enumerate(lines):
+            line_no += 1
+            line = cls.clean_line(line)
+            if not line:
+                continue
+            reftest = cls.parse_line(line, path, line_no)
+            if not reftest:
+                continue
+            if "include" in reftest:
+                include = posixpath.normpath(joinposix(dir, reftest["include"])
+                                             if dir else reftest["include"])
+                if include.startswith("../") or posixpath.isabs(include):
+                    log.warn("Ignoring include of %s outside of the tests "
+                             "directory (manifest %s line %i)",
+                             reftest["include"], path, line_no)
+                    continue
+                includes.append(include)
+                continue
+            entries.append((line_no, line, reftest))
+        return cls(path, entries, includes)
 
     @classmethod
-    def _build_full_id(cls, manifest_path, line):
-        return cls._build_testid(manifest_path, line, False)
+    def clean_line(cls, line):
+        """Remove the comments and surrounding whitespace from a line.
 
-    @classmethod
-    def _line_to_itest(cls, manifest_path, line, path="", line_no=-1):
+        Returns None for lines without content."""
         if not line or line[0] == "#":
             return None
-        line = re.sub("\s+#.*$", "", line)
+        if "#" in line:
+            line = cls.COMMENT_RE.sub("", line)
         # strip leading and trailing whitespace
-        line = line.strip()
-        if not line:
-            return None
-        if not cls._parse_line(line, path, line_no):
-            return None
-
-        dir, file = os.path.split(manifest_path)
-        testid = cls._build_testid(manifest_path, line)
-        full_id = cls._build_full_id(manifest_path, line)
-        itest = Reftest(testid, full_id)
-        # The following attributes are temporary, not persisted in the database
-        # object.  They will be used in create_test() for creating the db object.
-        itest.line = line
-        itest.line_no = line_no
-        itest.directory = dir
-        return itest
+        return line.strip() or None
 
     # More or less direct port of Mozilla reftest.js::ReadManifest() in Python
     @classmethod
-    def _parse_line(cls, line, path="", line_no=-1):
-        EXPECTED_PASS = 0;
-        EXPECTED_FAIL = 1;
-        EXPECTED_RANDOM = 2;
-        EXPECTED_DEATH = 3;  # test must be skipped to avoid e.g. crash/hang
-        EXPECTED_LOAD = 4; # test without a reference (just test that it does
-                           # not assert, crash, hang, or leak)
+    def parse_line(cls, line, path="", line_no=-1):
+        """Parse a manifest line (stripped from its comments and whitespace).
+
+        Returns a dict describing the reftest, or None if the line doesn't
+        define a test."""
         urls = []
         #log.debug("reftest parsing line %s", line)
 
-        ##for (line_no, line) in enumerate(open(f)):
-        ##line_no += 1
-        #assert line[0] != "#"
-        #
-        #line = re.sub("\s+#.*$", "", line)
-        #
-        ## strip leading and trailing whitespace
-        #line = line.strip()
-        #assert line
-
         items = line.split() # split on whitespace
         #print "line", line
 
-        expected_status = EXPECTED_PASS;
+        expected_status = cls.EXPECTED_PASS;
 
         failure_types = "";
-        while re.match("^(fails|random|skip|asserts)", items[0]):
+        while cls.MODIFIER_RE.match(items[0]):
             # XXX this store a failure_types for asserts.
             failure_types += " " + items[0]
             item = items.pop(0)
             stat = ""
             cond = False
-            m = re.match("^(fails|random|skip)-if(\(.*\))$", item)
+            m = cls.STATUS_IF_RE.match(item)
             if m:
                 stat = m.group(1)
 #                // Note: m[2] contains the parentheses, and we want them.
 #                cond = Components.utils.evalInSandbox(m[2], sandbox);
                 cond = False # XXX
-            elif re.match("^(fails|random|skip)$", item):
+            elif cls.STATUS_RE.match(item):
                 stat = item
                 cond = True
-            elif re.match("^asserts\((\d+)(-\d+)?\)$", item):
+            elif cls.ASSERTS_RE.match(item):
                 cond = False
                 # XXX asserts are ignored for now
-            elif re.match("^asserts-if\((.*?),(\d+)(-\d+)?\)$", item):
+            elif cls.ASSERTS_IF_RE.match(item):
                 cond = False
                 # XXX asserts are ignored for now
             else:
@@ -517,7 +662,7 @@ class Reftest(ImportedTest):
             run_http = True
             http_depth = 0
             items.pop(0)
-        elif re.match("HTTP\(\.\.(\/\.\.)*\)", items[0]):
+        elif cls.HTTP_DEPTH_RE.match(items[0]):
             # Accept HTTP(..), HTTP(../..), HTTP(../../..), etc.
             run_http = True
             http_depth = (len(items[0]) - 5) / 3
@@ -527,30 +672,23 @@ class Reftest(ImportedTest):
         # XXX commented .js code below is not up to date.
 
         def uri_to_file(uri):
-            return re.sub("[\?#].*$", "", uri)
+            return cls.URI_QUERY_RE.sub("", uri)
 
         if items[0] == "include":
             if len(items) != 2 or run_http:
                 raise Exception("Error in manifest file %s line %i" %
                                 (path, line_no))
-            log.debug("include statement ignored (%s)", line)
-            # XXX add an exception for this file that is named reftests.list instead
-            #  of reftest.list. Should be Mozilla specific and is not included now.
-            if items[1] == "../../content/html/document/reftests/reftests.list":
-                return None
-            assert items[1].endswith("/reftest.list"), (
-                     "Including a reftest manifest file that will not be "
-                     "found (%s)") % items[1]
+            return {"include": items[1]}
 #            var incURI = gIOService.newURI(items[1], null, listURL);
 #            secMan.checkLoadURI(aURL, incURI,
 #                                CI.nsIScriptSecurityManager.DISALLOW_SCRIPT);
 #            ReadManifest(incURI);
         elif items[0] == "load":
-            if expected_status == EXPECTED_PASS:
-                expected_status = EXPECTED_LOAD
+            if expected_status == cls.EXPECTED_PASS:
+                expected_status = cls.EXPECTED_LOAD
             if len(items) != 2 or \
-                (expected_status != EXPECTED_LOAD and \
-                 expected_status != EXPECTED_DEATH):
+                (expected_status != cls.EXPECTED_LOAD and \
+                 expected_status != cls.EXPECTED_DEATH):
                 raise Exception("Error in manifest file %s line %i" %
                                 (path, line_no))
 #            var [testURI] = runHttp
@@ -625,11 +763,162 @@ class Reftest(ImportedTest):
             raise Exception("Error parsing manifest file %s line %s: '%s'" %
                             (path, line_no, line))
 
+class ReftestManifestGraph(object):
+    """Graph of the reftest manifests linked by include statements.
+
+    Each manifest is loaded at most once per graph, even when it is included
+    from several manifests. A graph is created for each ResourceGraph and
+    uses its file signatures, the parsed manifests themselves are cached
+    across loads by ReftestManifest.load()."""
+
+    def __init__(self, resource_graph, follow_include=None):
+        self.resource_graph = resource_graph
+        # Called with the path of an included manifest, returns whether the
+        # include should be followed.
+        self.follow_include = follow_include or (lambda path: True)
+        # Maps manifest paths to their ReftestManifest, or None if missing.
+        self._manifests = {}
+        self._included_manifests = {}
+        self._included_manifest_indexes = {}
+
+    def get_manifest(self, path):
+        if not path in self._manifests:
+            manifest = None
+            if self.resource_graph.is_file(path):
+                manifest = ReftestManifest.load(
+                    self.resource_graph.tests_dir, path,
+                    self.resource_graph.get_signature(path))
+            self._manifests[path] = manifest
+        return self._manifests[path]
+
+    def get_included_manifests(self, path):
+        """Return the manifests included directly or indirectly by path.
+
+        The result is a (manifests, missing) tuple. manifests is the list of
+        ReftestManifest found, starting with the one at path and in include
+        order. missing is the list of the included paths that don't exist.
+        Includes creating a cycle are ignored."""
+        if not path in self._included_manifests:
+            manifests = []
+            missing = []
+            self._visit(path, [], set(), manifests, missing)
+            self._included_manifests[path] = (manifests, missing)
+        return self._included_manifests[path]
+
+    def get_included_manifest_index(self, path):
+        """Return a dict mapping the paths of the manifests returned by
+        get_included_manifests() to the manifests."""
+        if not path in self._included_manifest_indexes:
+            manifests, missing = self.get_included_manifests(path)
+            self._included_manifest_indexes[path] = dict(
+                (manifest.path, manifest) for manifest in manifests)
+        return self._included_manifest_indexes[path]
+
+    def _visit(self, path, stack, visited, manifests, missing):
+        if path in stack:
+            log.warn("Ignoring cyclic include of reftest manifest %s (%s)",
+                     path, " -> ".join(stack + [path]))
+            return
+        if path in visited:
+            return
+        visited.add(path)
+
+        manifest = self.get_manifest(path)
+        if not manifest:
+            missing.append(path)
+            return
+        manifests.append(manifest)
+        stack.append(path)
+        for include in manifest.includes:
+            if self.follow_include(include):
+                self._visit(include, stack, visited, manifests, missing)
+        stack.pop()
+
+class Reftest(ImportedTest):
+    """Tests of the reftest manifests.
+
+    When the tests directory has a root manifest, the reftests are the ones
+    of the manifests it includes, directly or indirectly: each of these
+    manifests imports its own lines, and the other manifests are ignored.
+    Otherwise, each reftest.list found imports its lines and the lines of
+    the manifests it includes, except the included reftest.list files which
+    import their own lines.
+    """
+    file_based = False
+    hash_id = True
+    ROOT_MANIFEST = "reftest.list"
+    # ReftestManifestGraph of the current ResourceGraph.
+    manifest_graph = None
+
+    __slots__ = ("full_id", "line", "line_no", "directory", "reftest")
+
+    def __init__(self, testid, full_id):
+        super(Reftest, self).__init__(testid)
+        self.full_id = full_id
+
+    @classmethod
+    def do_create_from_test(cls, test):
+        return cls(test.pk, test.full_id)
+
+    def exists(self):
+        assert self.file_based, "Should only called for file based tests"
+
+    @classmethod
+    def _build_testid(cls, manifest_path, line, use_hash=True):
+        if not cls.hash_id:
+            use_hash = False
+        dir, file = os.path.split(manifest_path)
+        paths = ["reftest:%s" % (hashlib.md5(line).hexdigest() if use_hash
+                                 else line)]
+        if dir:
+            paths.insert(0, dir)
+        return joinposix(*paths)
+
+    @classmethod
+    def _build_full_id(cls, manifest_path, line):
+        return cls._build_testid(manifest_path, line, False)
+
+    @classmethod
+    def _create_itest(cls, manifest_path, line, line_no, reftest):
+        dir, file = os.path.split(manifest_path)
+        testid = cls._build_testid(manifest_path, line)
+        full_id = cls._build_full_id(manifest_path, line)
+        itest = Reftest(testid, full_id)
+        # The following attributes are temporary, not persisted in the database
+        # object.  They will be used in create_test() for creating the db object.
+        itest.line = line
+        itest.line_no = line_no
+        itest.directory = dir
+        itest.reftest = reftest
+        return itest
+
+    @classmethod
+    def _line_to_itest(cls, manifest_path, line, path="", line_no=-1):
+        line = ReftestManifest.clean_line(line)
+        if not line:
+            return None
+        reftest = ReftestManifest.parse_line(line, path, line_no)
+        if not reftest or "include" in reftest:
+            return None
+        return cls._create_itest(manifest_path, line, line_no, reftest)
+
     @classmethod
     def update_dirty_itests(cls, resource, lines, dirty_itests):
         dir, file = os.path.split(resource)
         if file != "reftest.list":
             return False
+        if (cls._has_root_manifest() and
+            not resource in cls._get_root_manifest_index()):
+            return False
+        # Changes to include statements modify the tests of other manifests,
+        # the manifest has to be imported again.
+        for line in lines:
+            if not line[0] in ("-", "+"):
+                continue
+            line = ReftestManifest.clean_line(line[1:])
+            if line and "include" in (ReftestManifest.parse_line(
+                                          line, resource) or {}):
+                return False
 
         for line in lines:
             if not line[0] in ("-", "+"):
@@ -650,19 +939,70 @@ class Reftest(ImportedTest):
     @classmethod
     def get_imported_tests(cls, path):
         dir, file = os.path.split(path)
-        if file != "reftest.list":
+        if cls._has_root_manifest():
+            manifest = cls._get_root_manifest_index().get(path)
+            manifests = [manifest] if manifest else []
+        elif file == "reftest.list":
+            manifests, missing = \
+                cls._get_manifest_graph().get_included_manifests(path)
+        else:
             return []
 
         itests = set()
-        with open(join(cls.tests_dir, path)) as f:
-            for (line_no, line) in enumerate(f):
-                line_no += 1
-                itest = cls._line_to_itest(path, line, path, line_no)
-                if not itest:
-                    continue
-                itests.add(itest)
+        for manifest in manifests:
+            for (line_no, line, reftest) in manifest.entries:
+                itests.add(cls._create_itest(manifest.path, line, line_no,
+                                             reftest))
         return itests
 
+    @classmethod
+    def get_dependencies(cls, path):
+        dir, file = os.path.split(path)
+        if cls._has_root_manifest():
+            # Any manifest can start or stop being included from the root
+            # manifest when one of the included manifests changes.
+            if (not path.endswith(".list") and
+                not path in cls._get_root_manifest_index()):
+                return []
+            manifests, missing = cls._get_manifest_graph(
+                ).get_included_manifests(cls.ROOT_MANIFEST)
+            return [manifest.path for manifest in manifests if
+                    manifest.path != path] + missing
+        if file != "reftest.list":
+            return []
+        manifests, missing = \
+            cls._get_manifest_graph().get_included_manifests(path)
+        # The missing root manifest is a dependency, as creating it changes
+        # the tests of all the manifests.
+        return [manifest.path for manifest in manifests[1:]] + missing + \
+               [cls.ROOT_MANIFEST]
+
+    @classmethod
+    def _has_root_manifest(cls):
+        return cls._get_resource_graph().is_file(cls.ROOT_MANIFEST)
+
+    @classmethod
+    def _get_root_manifest_index(cls):
+        return cls._get_manifest_graph().get_included_manifest_index(
+            cls.ROOT_MANIFEST)
+
+    @classmethod
+    def _follow_include(cls, path):
+        # Without a root manifest, the reftest.list files are found when
+        # walking the tests directory and import their own tests, following
+        # them here would create the same tests several times.
+        return (cls._has_root_manifest() or
+                posixpath.basename(path) != "reftest.list")
+
+    @classmethod
+    def _get_manifest_graph(cls):
+        resource_graph = cls._get_resource_graph()
+        graph = Reftest.manifest_graph
+        if not graph or graph.resource_graph is not resource_graph:
+            graph = Reftest.manifest_graph = ReftestManifestGraph(
+                resource_graph, cls._follow_include)
+        return graph
+
     def _compute_flags(self, test):
         self._compute_moz_flags(test)
 
@@ -670,9 +1010,9 @@ class Reftest(ImportedTest):
             self._add_flags(test, "rthasfailuretype")
         if not test.url2:
             self._add_flags(test, "rtloadonly")
-        if "reftest-print" in test.resources_text_content:
+        if "reftest-print" in test.text_markers:
             self._add_flags(test, "rtprint")
-        if "reftest-wait" in test.resources_text_content:
+        if "reftest-wait" in test.text_markers:
             self._add_flags(test, "rtwait")
 
     def _is_special_scheme(self, url):
@@ -685,7 +1025,8 @@ class Reftest(ImportedTest):
         # That should always the case in the current implementation.
         assert self.line, "Invalid state!"
 
-        reftest = self._parse_line(self.line, self.line_no)
+        # The parsed line is shared with the cached manifest.
+        reftest = dict(self.reftest)
 
         for prop_url in ("url", "url2"):
             u = reftest[prop_url]
@@ -738,14 +1079,356 @@ class Reftest(ImportedTest):
 
         return test
 
+class ResourceGraph(object):
+    """Graph of the references between the files of a tests directory.
+
+    Each file is read once per load. While reading it, the digest of its
+    content is computed and, for text files, its references (src/href
+    attributes, CSS url() and @import rules) and the text markers used to
+    compute the tests flags are extracted. The resources reachable from a
+    file are then computed from the graph in memory, so reading the shared
+    files used by many tests (harness scripts, style sheets) only happens
+    once.
+
+    The file information can be given from a previous load (see
+    ImportState). It is reused for the files with the same signature.
+    """
+    # Size of the blocks read when computing the digest of non text files.
+    READ_BLOCK_SIZE = 64 * 1024
+    # Strings searched in the text files, see get_text_markers().
+    TEXT_MARKERS = ("netscape.security", "EventUtils.js",
+                    "Components.interfaces", "Components.classes",
+                    "example.org", "reftest-print", "reftest-wait")
+    # Matches all the markers, so that the text files are scanned in a single
+    # pass. The layoutTestController method name is matched in a lookahead so
+    # that a dialog call such as "layoutTestController.alert(" is still found.
+    TEXT_MARKERS_RE = re.compile("|".join(
+        [re.escape(m) for m in TEXT_MARKERS] +
+        ["layoutTestController\.(?=(?P<ltc_func>\w+))",
+         r"\b(?:alert|prompt|confirm)\("]))
+
+    def __init__(self, tests_dir, file_infos=None):
+        self.tests_dir = tests_dir
+        # Maps a file path to a (signature, referenced_paths, digest,
+        # text_markers) tuple. The referenced paths are not filtered on their
+        # existence, so that they stay valid if a referenced file is added or
+        # removed.
+        self.file_infos = file_infos or {}
+        self._used_file_infos = {}
+        # Paths added to _used_file_infos since the last call to
+        # pop_new_used_file_infos().
+        self._new_used_paths = []
+        self._signatures = {}
+        self._is_file = {}
+        # Maps a file path to a (found_resources, missing_resources) tuple of
+        # frozensets.
+        self._direct_resources = {}
+        self._related_resources = {}
+
+    def get_signature(self, path):
+        """Return the signature of a file or None if it doesn't exist."""
+        if not path in self._signatures:
+            try:
+                signature = file_signature(join(self.tests_dir, path))
+            except OSError:
+                signature = None
+            self._signatures[path] = signature
+        return self._signatures[path]
+
+    def is_file(self, path):
+        if not path in self._is_file:
+            self._is_file[path] = os.path.isfile(join(self.tests_dir, path))
+        return self._is_file[path]
+
+    def _is_text(self, resource):
+        ext = os.path.splitext(resource)[1][1:]
+        return ext in ImportedTest.TEXT_EXTENSIONS
+
+    def _scan_references(self, resource, content):
+        iterators = [(m.groupdict()["url"] for m in regex.finditer(content)) for
+                        regex in [ImportedTest.SRC_HREF_RE,
+                                  ImportedTest.CSS_URL_RE,
+                                  ImportedTest.CSS_IMPORT_RE]]
+
+        base = "/" + os.path.dirname(resource)
+        if not base.endswith("/"):
+            base += "/"
+
+        paths = set()
+        for url in itertools.chain(*iterators):
+            url = urlparse.urljoin(base, url)
+            # Only keep the path from the parsed url.
+            path = urlparse.urlparse(url).path[1:]
+            if path:
+                paths.add(path)
+        return tuple(sorted(paths))
+
+    def _scan_text_markers(self, content):
+        markers = set()
+        for m in self.TEXT_MARKERS_RE.finditer(content):
+            ltc_func = m.group("ltc_func")
+            if ltc_func:
+                markers.add(Layouttest.LTC_CALL_PREFIX + ltc_func)
+            else:
+                markers.add(m.group())
+        return frozenset(markers)
+
+    def _scan_file(self, resource):
+        """Read a file and return a (referenced_paths, digest, text_markers)
+        tuple."""
+        digest = hashlib.md5()
+        with open(join(self.tests_dir, resource), "rb") as f:
+            if not self._is_text(resource):
+                # Only the digest is needed, so don't keep the whole content
+                # in memory.
+                for block in iter(lambda: f.read(self.READ_BLOCK_SIZE), ""):
+                    digest.update(block)
+                return (), digest.hexdigest(), frozenset()
+            content = f.read()
+        digest.update(content)
+        return (self._scan_references(resource, content), digest.hexdigest(),
+                self._scan_text_markers(content))
+
+    def _get_file_info(self, resource):
+        if resource in self._used_file_infos:
+            return self._used_file_infos[resource]
+        signature = self.get_signature(resource)
+        file_info = self.file_infos.get(resource)
+        if not file_info or file_info[0] != signature:
+            file_info = (signature,) + self._scan_file(resource)
+        self._used_file_infos[resource] = file_info
+        self._new_used_paths.append(resource)
+        return file_info
+
+    def get_digest(self, resource):
+        """Return the hexadecimal md5 digest of a file content or None if it
+        doesn't exist."""
+        if not self.is_file(resource):
+            return None
+        return self._get_file_info(resource)[2]
+
+    def get_text_markers(self, resource):
+        """Return the markers found in a text file.
+
+        Markers are the strings of TEXT_MARKERS found in the file, as well as
+        the layoutTestController method calls (such as
+        "layoutTestController.waitUntilDone") and dialog function calls
+        ("alert(", "prompt(" or "confirm(")."""
+        if not self._is_text(resource) or not self.is_file(resource):
+            return frozenset()
+        return self._get_file_info(resource)[3]
+
+    def get_direct_resources(self, resource):
+        """Return a (found, missing) tuple of the resources referenced by
+        resource. Missing resources are the referenced paths that couldn't be
+        found on the filesystem."""
+        if resource in self._direct_resources:
+            return self._direct_resources[resource]
+
+        found, missing = set(), set()
+        if self._is_text(resource) and self.is_file(resource):
+            for path in self._get_file_info(resource)[1]:
+                # We check if the file exists on the filesystem in order to
+                # crawl that resource.
+                if self.is_file(path):
+                    found.add(path)
+                else:
+                    missing.add(path)
+        result = (frozenset(found), frozenset(missing))
+        self._direct_resources[resource] = result
+        return result
+
+    def get_related_resources(self, resource):
+        """Return a (found, missing) tuple of the resources referenced
+        directly or indirectly by resource. The found resources include
+        resource itself."""
+        if resource in self._related_resources:
+            return self._related_resources[resource]
+
+        tocrawl = set([resource])
+        all_resources = set([resource])
+        all_missing = set()
+        while tocrawl:
+            current = tocrawl.pop()
+            if current in self._related_resources:
+                # Already computed, no need to crawl it again.
+                found, missing = self._related_resources[current]
+            else:
+                found, missing = self.get_direct_resources(current)
+                tocrawl.update(found - all_resources)
+            all_resources.update(found)
+            all_missing.update(missing)
+
+        result = (frozenset(all_resources), frozenset(all_missing))
+        self._related_resources[resource] = result
+        return result
+
+    def get_used_file_infos(self):
+        """Return the information about the files used during this load, in
+        the format of the file_infos constructor argument."""
+        return self._used_file_infos
+
+    def pop_new_used_file_infos(self):
+        """Like get_used_file_infos(), but only for the files used since the
+        last call."""
+        new_paths, self._new_used_paths = self._new_used_paths, []
+        return dict((path, self._used_file_infos[path]) for
+                    path in new_paths)
+
+class ImportState(object):
+    """Extraction state kept between two loads of the same tests directory.
+
+    For each file of the tests directory, it records the signature the file
+    had when it was scanned (see file_signature()) and the tests that were
+    created from it. The state is pickled to a file so that files that didn't
+    change are not scanned again on the next load.
+    """
+    # Increment this when the format of the state changes.
+    VERSION = 6
+
+    def __init__(self, entries=None, file_infos=None, paths=None):
+        # Maps a file path to a dict with the following keys:
+        #   signature: signature of the file.
+        #   dir_hash: hash of the file names of the containing directory.
+        #   tests: list of test records created by _test_to_record().
+        #   dependencies: signatures of the other files the tests of this
+        #     file depend on, None for the ones that don't exist.
+        self.entries = entries or {}
+        # Information about the files, see ResourceGraph.file_infos.
+        self.file_infos = file_infos or {}
+        # Paths of the entries, in the order the tests are returned.
+        self.paths = paths or []
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            return cls()
+        try:
+            with open(path, "rb") as f:
+                data = cPickle.load(f)
+        except Exception, e:
+            log.warn("Can't read import state file %s (%s), ignoring it",
+                     path, e)
+            return cls()
+        if not isinstance(data, dict) or data.get("version") != cls.VERSION:
+            log.info("Import state file %s has an old format, ignoring it",
+                     path)
+            return cls()
+        return cls(data["entries"], data["file_infos"], data["paths"])
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            cPickle.dump({
+                "version": self.VERSION,
+                "entries": self.entries,
+                "file_infos": self.file_infos,
+                "paths": self.paths,
+            }, f, cPickle.HIGHEST_PROTOCOL)
+        # os.rename() doesn't overwrite an existing file on Windows.
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+class PathFilter(object):
+    """Selects the paths to import using include and exclude patterns.
+
+    Patterns are paths relative to the tests directory which may contain
+    fnmatch wildcards in any of their components ("*" doesn't match "/"). A
+    pattern matches the path it names and everything under it. A path is
+    selected if it matches an include pattern (or if there are none) and no
+    exclude pattern."""
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [self._split(pattern) for pattern in include or []]
+        self.exclude = [self._split(pattern) for pattern in exclude or []]
+
+    def _split(self, pattern):
+        return [part for part in pattern.replace("\\", "/").split("/") if
+                part and part != "."]
+
+    def _matches(self, patterns, parts, partial=False):
+        for pattern in patterns:
+            if len(parts) < len(pattern) and not partial:
+                continue
+            if all(fnmatch.fnmatchcase(part, pattern_part) for
+                   (part, pattern_part) in zip(parts, pattern)):
+                return True
+        return False
+
+    def is_selected(self, path):
+        parts = path.split("/")
+        if self.include and not self._matches(self.include, parts):
+            return False
+        return not self._matches(self.exclude, parts)
+
+    def may_select_under(self, directory):
+        """Return whether paths under directory can be selected.
+
+        Used to prune the directories that can't contain selected paths
+        before they are listed."""
+        parts = directory.split("/")
+        if self._matches(self.exclude, parts):
+            return False
+        return not self.include or self._matches(self.include, parts,
+                                                 partial=True)
+
+# Extractor used by the processes of a parallel extraction.
+_worker_extractor = None
+
+def _reset_logging_locks():
+    """Replace the locks of the logging module and of its handlers.
+
+    The extraction processes are forked from the runner, whose other threads
+    (the webapp and the hang watchdog) keep running. If one of them held a
+    logging lock at that time, the lock would stay held forever in the
+    forked process. That's the only lock the extraction code shares with
+    these threads: the threading module resets its own state after a fork,
+    and the workers don't use the webapp.
+    """
+    logging._lock = threading.RLock()
+    loggers = [logging.getLogger()] + [
+        logger for logger in logging.Logger.manager.loggerDict.values() if
+        isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers:
+            handler.createLock()
+
+def _init_extraction_worker(tests_dir, file_infos):
+    global _worker_extractor
+    _reset_logging_locks()
+    _worker_extractor = TestsExtractor(tests_dir=tests_dir,
+                                       import_state=ImportState({}, file_infos))
+    ImportedTest.tests_dir = tests_dir
+    ImportedTest.resource_graph = _worker_extractor.resource_graph
+
+def _scan_paths_in_worker(args):
+    paths, create_tests = args
+    results = _worker_extractor._scan_paths_serially(paths, create_tests)
+    # The parent merges the file infos of all the chunks, so only the ones
+    # this chunk added are sent back.
+    return (results,
+            _worker_extractor.resource_graph.pop_new_used_file_infos())
+
 class TestsExtractor(object):
     IGNORED_PATHS_RE = re.compile(r"(^|[/\\])(\..*|CVS|\.svn)($|[/\\])")
 
-    def __init__(self, tests_dir=None):
+    # Number of path chunks given to each process of a parallel extraction.
+    # Having more than one helps balancing the load between processes.
+    CHUNKS_PER_JOB = 4
+
+    def __init__(self, tests_dir=None, import_state=None, jobs=1,
+                 path_filter=None):
         # The order of importers is important. In case of ambiguity, the first
         # importer that could locate a test will win.
         self.importers = [Browsertest, Layouttest, Mochitest, Reftest]
         self.tests_dir = tests_dir
+        self.import_state = import_state
+        self.path_filter = path_filter or PathFilter()
+        # Number of processes scanning the files. 0 means one per CPU.
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.resource_graph = ResourceGraph(
+            tests_dir, import_state and import_state.file_infos)
 
     def _toposixpath(self, path):
         """
@@ -760,17 +1443,22 @@ class TestsExtractor(object):
             return True
         return self.IGNORED_PATHS_RE.search(path) != None
 
-    def get_imported_tests_and_resources(self, directory):
-        # YYY assume self.tests_dir == directory?
-        #ImportedTest.tests_dir = self.tests_dir
-        ImportedTest.tests_dir = directory
+    def _walk(self, directory):
+        """Generate a (path, dir_hash) tuple for each file to import.
 
-        imported_tests = set()
-        resources = set()
+        dir_hash identifies the list of file names in the directory of the
+        file. It is used to detect files added or removed next to a file,
+        which can change the tests found in that file (for instance a
+        layouttest expected result)."""
         for root, dirs, files in os.walk(directory):
+            cur_dir = root[len(self.tests_dir) + 1:]
+            cur_dir = self._toposixpath(cur_dir)
+
             toremove = []
             for d in dirs:
-                if self._is_ignored(d):
+                dir_path = joinposix(cur_dir, d) if cur_dir else d
+                if (self._is_ignored(d) or
+                    not self.path_filter.may_select_under(dir_path)):
                     toremove.append(d)
             for d in toremove:
                 dirs.remove(d)
@@ -784,23 +1472,318 @@ class TestsExtractor(object):
             #        if ignored_dir in dirs:
             #            dirs.remove(ignored_dir)
 
-            cur_dir = root[len(self.tests_dir) + 1:]
-            cur_dir = self._toposixpath(cur_dir)
+            dir_hash = self._hash_file_names(files)
             for file in files:
                 path = joinposix(cur_dir, file) if cur_dir else file
-                if self._is_ignored(path):
+                if (self._is_ignored(path) or
+                    not self.path_filter.is_selected(path)):
                     continue
-                resources.add(path)
-                for importer in self.importers:
-                    itests = importer.get_imported_tests(path)
-                    if itests:
-                        imported_tests.update(itests)
-                        break
-        return (imported_tests, resources)
+                yield path, dir_hash
+
+    def _hash_file_names(self, files):
+        return hashlib.md5("\n".join(sorted(files))).hexdigest()
+
+    def _get_dir_hash(self, directory):
+        """Return the dir_hash (see _walk()) of a directory relative to
+        self.tests_dir."""
+        full_dir = join(self.tests_dir, directory)
+        try:
+            names = os.listdir(full_dir)
+        except OSError:
+            return None
+        return self._hash_file_names([name for name in names if
+                                      not os.path.isdir(join(full_dir, name))])
+
+    def _find_imported_tests(self, path):
+        for importer in self.importers:
+            itests = importer.get_imported_tests(path)
+            if itests:
+                return itests
+        return []
+
+    def _get_dependencies(self, path):
+        dependencies = {}
+        for importer in self.importers:
+            for dependency in importer.get_dependencies(path):
+                dependencies[dependency] = \
+                    self.resource_graph.get_signature(dependency)
+        return dependencies
+
+    def _scan_paths_serially(self, paths, create_tests):
+        results = []
+        for path in paths:
+            itests = self._find_imported_tests(path)
+            if create_tests:
+                results.append({
+                    "tests": [self._test_to_record(itest, itest.create_test())
+                              for itest in itests],
+                    "dependencies": self._get_dependencies(path),
+                })
+            else:
+                results.append(list(itests))
+        return results
+
+    def _scan_paths(self, paths, create_tests=False):
+        """Return the imported tests found in each path of the paths list.
+
+        The returned list has the same order as paths. If create_tests is True,
+        the tests are created and each item is a dict with the list of test
+        records (see _test_to_record()) and the signatures of the other files
+        the path depends on (see ImportedTest.get_dependencies()), instead of
+        a list of imported tests.
+
+        When self.jobs is greater than 1, the paths are split in chunks that
+        are scanned by a pool of processes."""
+        if self.jobs <= 1 or len(paths) <= 1:
+            return self._scan_paths_serially(paths, create_tests)
+
+        chunk_count = self.jobs * self.CHUNKS_PER_JOB
+        chunk_size = max(1, (len(paths) + chunk_count - 1) / chunk_count)
+        chunks = [(paths[i:i + chunk_size], create_tests) for
+                  i in range(0, len(paths), chunk_size)]
+
+        pool = multiprocessing.Pool(self.jobs, _init_extraction_worker,
+                                    (self.tests_dir,
+                                     self.resource_graph.file_infos))
+        try:
+            # map() keeps the chunks order, so that the merge is
+            # deterministic. Using get() with a timeout instead of a plain
+            # map() lets KeyboardInterrupt reach this process.
+            chunk_results = pool.map_async(_scan_paths_in_worker,
+                                           chunks).get(sys.maxint)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        results = []
+        for chunk_result, file_infos in chunk_results:
+            results.extend(chunk_result)
+            self.resource_graph.get_used_file_infos().update(file_infos)
+        return results
+
+    def get_imported_tests_and_resources(self, directory):
+        # YYY assume self.tests_dir == directory?
+        #ImportedTest.tests_dir = self.tests_dir
+        ImportedTest.tests_dir = directory
+        ImportedTest.resource_graph = self.resource_graph
+
+        resources = [path for path, dir_hash in self._walk(directory)]
+        imported_tests = set()
+        for itests in self._scan_paths(resources):
+            imported_tests.update(itests)
+        return (imported_tests, set(resources))
 
     def get_imported_tests(self, directory):
         return self.get_imported_tests_and_resources(directory)[0]
 
+    def _test_to_record(self, itest, test):
+        attributes = test.get_attributes()
+        missing = attributes.pop("missing_resources")
+        dependencies = {}
+        for resource in test.resources:
+            signature = self.resource_graph.get_signature(resource)
+            if signature:
+                dependencies[resource] = signature
+        return {
+            "importer": itest.__class__.__name__,
+            "attributes": attributes,
+            "dependencies": dependencies,
+            "missing": missing,
+        }
+
+    def _record_to_test(self, record):
+        test = Test()
+        test.set_attributes(record["attributes"])
+        return test
+
+    def _is_entry_valid(self, entry, path, dir_hash, paths):
+        if (entry["signature"] != self.resource_graph.get_signature(path) or
+            entry["dir_hash"] != dir_hash):
+            return False
+        for dependency, signature in entry["dependencies"].iteritems():
+            if self.resource_graph.get_signature(dependency) != signature:
+                return False
+        for record in entry["tests"]:
+            for resource, signature in record["dependencies"].iteritems():
+                if self.resource_graph.get_signature(resource) != signature:
+                    return False
+            # A resource that was referenced but missing may have been added.
+            if record["missing"] & paths:
+                return False
+        return True
+
+    def get_tests(self, directory):
+        """Return the list of tests found in directory.
+
+        If an import state was given, the tests created from files that didn't
+        change (as well as the resources they use) are taken from the state
+        instead of being created again. The state is updated with the tests
+        created during this call."""
+        ImportedTest.tests_dir = directory
+        ImportedTest.resource_graph = self.resource_graph
+
+        walked = list(self._walk(directory))
+        paths = set(path for path, dir_hash in walked)
+        old_entries = self.import_state.entries if self.import_state else {}
+        # The entries of the paths that were not walked are kept for the
+        # loads of other parts of the tests directory.
+        entries = dict((path, entry) for (path, entry) in
+                       old_entries.iteritems() if
+                       not self.path_filter.is_selected(path))
+
+        rescanned_paths = []
+        for path, dir_hash in walked:
+            entry = old_entries.get(path)
+            if entry and self._is_entry_valid(entry, path, dir_hash, paths):
+                entries[path] = entry
+                continue
+            rescanned_paths.append(path)
+            entries[path] = {
+                "signature": self.resource_graph.get_signature(path),
+                "dir_hash": dir_hash,
+            }
+        results = self._scan_paths(rescanned_paths, create_tests=True)
+        for path, result in zip(rescanned_paths, results):
+            entries[path].update(result)
+        log.debug("Scanned %i of %i files", len(rescanned_paths), len(walked))
+
+        ordered_paths = [path for path, dir_hash in walked]
+        if self.import_state:
+            state_paths = [path for path in self.import_state.paths if
+                           path in entries and not path in paths]
+            self._update_import_state(entries, state_paths + ordered_paths)
+        return self._entries_to_tests(entries, ordered_paths)
+
+    def _entries_to_tests(self, entries, paths):
+        tests = []
+        testids = set()
+        for path in paths:
+            for record in entries[path]["tests"]:
+                test = self._record_to_test(record)
+                # In case of duplicated identifiers, the first test found wins
+                # (See ImportedTest.__eq__).
+                if test.id in testids:
+                    continue
+                testids.add(test.id)
+                tests.append(test)
+        return tests
+
+    def _update_import_state(self, entries, paths):
+        self.import_state.entries = entries
+        self.import_state.paths = paths
+        # Keep the information about the files that weren't read during
+        # this load, it can be used by tests created in a later load.
+        file_infos = dict((path, value) for (path, value) in
+                          self.resource_graph.file_infos.iteritems()
+                          if path in entries)
+        file_infos.update(self.resource_graph.get_used_file_infos())
+        self.import_state.file_infos = file_infos
+
+    def _get_dependents(self, entries):
+        """Return a dict mapping paths to the set of paths of the entries
+        depending on them."""
+        dependents = {}
+        for path, entry in entries.iteritems():
+            dependencies = set(entry["dependencies"])
+            for record in entry["tests"]:
+                dependencies.update(record["dependencies"])
+                dependencies.update(record["missing"])
+            dependencies.discard(path)
+            for dependency in dependencies:
+                dependents.setdefault(dependency, set()).add(path)
+        return dependents
+
+    def _update_entry(self, entry, path, lines):
+        """Update the tests of entry from the diff lines of path.
+
+        Returns the updated entry, or None if the importers can't apply the
+        change."""
+        dirty_itests = {"added": set(), "deleted": set()}
+        for importer in self.importers:
+            if importer.update_dirty_itests(path, lines, dirty_itests):
+                break
+        else:
+            return None
+        deleted_ids = set(itest.testid for itest in dirty_itests["deleted"])
+        records = [record for record in entry["tests"] if
+                   not record["attributes"]["id"] in deleted_ids]
+        records.extend(self._test_to_record(itest, itest.create_test()) for
+                       itest in dirty_itests["added"])
+        entry = dict(entry)
+        entry["tests"] = records
+        entry["signature"] = self.resource_graph.get_signature(path)
+        return entry
+
+    def update_tests(self, directory, changes):
+        """Return the list of tests found in directory, from the import state
+        and the changes made to the files since it was saved.
+
+        changes is a dict in the format returned by parse_changes(). Only the
+        tests of the changed files and of the files depending on them are
+        created again. Unlike get_tests(), the other files are not checked
+        for modifications. When the diff lines of a file are known, importers
+        that support it (see ImportedTest.update_dirty_itests()) only create
+        the tests of the modified lines."""
+        assert self.import_state, "An import state is required"
+        ImportedTest.tests_dir = directory
+        ImportedTest.resource_graph = self.resource_graph
+
+        old_entries = self.import_state.entries
+        entries = dict(old_entries)
+        dependents = self._get_dependents(old_entries)
+
+        rescanned = set()
+        changed_dirs = set()
+        for path, lines in changes.iteritems():
+            if self._is_ignored(path):
+                continue
+            rescanned.update(dependents.get(path, ()))
+            exists = self.resource_graph.is_file(path)
+            if exists != (path in old_entries):
+                # Adding or removing a file changes the dir_hash of the other
+                # files of the directory.
+                changed_dirs.add(posixpath.dirname(path))
+            if not exists:
+                entries.pop(path, None)
+                continue
+            if lines and path in old_entries:
+                entry = self._update_entry(old_entries[path], path, lines)
+                if entry:
+                    entries[path] = entry
+                    continue
+            rescanned.add(path)
+
+        dir_hashes = dict((dir, self._get_dir_hash(dir)) for
+                          dir in changed_dirs)
+        if changed_dirs:
+            rescanned.update(path for path in entries if
+                             posixpath.dirname(path) in changed_dirs)
+
+        rescanned_paths = sorted(path for path in rescanned if
+                                 self.resource_graph.is_file(path) and
+                                 not self._is_ignored(path))
+        for path in rescanned_paths:
+            dir = posixpath.dirname(path)
+            entries[path] = {
+                "signature": self.resource_graph.get_signature(path),
+                "dir_hash": dir_hashes.get(dir) or
+                            entries[path]["dir_hash"],
+            }
+        results = self._scan_paths(rescanned_paths, create_tests=True)
+        for path, result in zip(rescanned_paths, results):
+            entries[path].update(result)
+        log.debug("Scanned %i files for %i changes", len(rescanned_paths),
+                  len(changes))
+
+        paths = [path for path in self.import_state.paths if path in entries]
+        paths.extend(sorted(set(entries) - set(paths)))
+        self._update_import_state(entries, paths)
+        return self._entries_to_tests(entries, [
+            path for path in paths if self.path_filter.is_selected(path)])
+
 class LocalTestStore(TestStore):
     name = "local"
 
@@ -809,42 +1792,69 @@ class LocalTestStore(TestStore):
         self.tests_path = store_info["path"]
         # tests_path shouldn't contain a trailing slash.
         self.tests_path = self.tests_path.strip().rstrip("\\/")
+        self.import_state_path = store_info.get("import_state")
+        self.import_jobs = store_info.get("import_jobs", 1)
+        self.changed_files_path = store_info.get("changed_files")
+        self.path_filter = PathFilter(store_info.get("include"),
+                                      store_info.get("exclude"))
         self.saved_tests = []
 
+    def _read_changes(self):
+        try:
+            with open(self.changed_files_path) as f:
+                return parse_changes(f)
+        except IOError, e:
+            raise StoreException("Can't read changed files from %s (%s)" %
+                                 (self.changed_files_path, e))
+
     def load(self, metadata):
         if not os.path.exists(self.tests_path):
             raise StoreException("Tests path '%s' does not exist" %
                                    self.tests_path)
 
-        testsextractor = TestsExtractor(tests_dir=self.tests_path)
-        # TODO: support importing subdirectories
-        itests = testsextractor.get_imported_tests(self.tests_path)
+        import_state = None
+        if self.import_state_path:
+            import_state = ImportState.load(self.import_state_path)
+
+        testsextractor = TestsExtractor(tests_dir=self.tests_path,
+                                        import_state=import_state,
+                                        jobs=self.import_jobs,
+                                        path_filter=self.path_filter)
+        if self.changed_files_path and not import_state:
+            log.warn("Ignoring the changed files list, it requires an "
+                     "import state")
+        if self.changed_files_path and import_state and import_state.paths:
+            extracted_tests = testsextractor.update_tests(
+                self.tests_path, self._read_changes())
+        else:
+            extracted_tests = testsextractor.get_tests(self.tests_path)
+
+        if import_state:
+            try:
+                import_state.save(self.import_state_path)
+            except (IOError, OSError), e:
+                log.warn("Can't save import state file %s (%s)",
+                         self.import_state_path, e)
 
-        props = [
-            "id", "full_id", "type", "url", "file",
-            # reftests
-            "equal", "expected", "failure_type", "url2", "file2"
-        ]
-        tests = []
-        for itest in itests:
-            test_obj = {}
-            test = itest.create_test()
+        tests = TestTable()
+        for test in extracted_tests:
             # Ignore layouttests for now.
             if test.type == "layouttest":
                 continue
-            for p in props:
-                test_obj[p] = getattr(test, p, None)
-            tests.append(test_obj)
+            tests.append(dict((p, getattr(test, p, None)) for
+                              p in TestTable.COLUMNS))
 
         self.runner.webapp.enable_localtests(self.tests_path)
-        return tests
+        return self.rebase_test_urls(tests)
 
-    def save(self, metadata):
-        self.saved_tests = self.runner.tests
+    def save(self, metadata, tests=None):
+        if tests is None:
+            tests = self.runner.tests
+        self.saved_tests = tests
         log.info("Test results:")
         if self.runner.options.debug:
             import pprint
-            pprint.pprint(self.saved_tests)
+            pprint.pprint(self.saved_tests.to_list())
         statuses = []
         for t in self.saved_tests:
             status = "not-run"
@@ -862,6 +1872,31 @@ class LocalTestStore(TestStore):
     def add_options(cls, parser):
         parser.add_option("--tests-path",
             help="(Local Test Store) Path to the tests to load")
+        parser.add_option("--tests-include", action="append",
+            metavar="PATTERN",
+            help="(Local Test Store) Only load the tests under this path "
+                 "(relative to the tests path). Path components may contain "
+                 "wildcards such as 'reftests/*/bugs'. Can be given several "
+                 "times.")
+        parser.add_option("--tests-exclude", action="append",
+            metavar="PATTERN",
+            help="(Local Test Store) Don't load the tests under this path, "
+                 "same format as --tests-include. Can be given several "
+                 "times.")
+        parser.add_option("--import-state",
+            help="(Local Test Store) Path to a file where the state of the "
+                 "tests extraction is saved. Only the files that changed "
+                 "since the previous load are scanned again.")
+        parser.add_option("--changed-files",
+            help="(Local Test Store) Path to a file listing the files that "
+                 "changed since the import state was saved (relative to the "
+                 "tests path), or containing a unified diff of the changes "
+                 "(for instance the output of 'git diff --relative' run in "
+                 "the tests directory). Only the tests depending on these "
+                 "files are imported again. Requires --import-state.")
+        parser.add_option("--import-jobs", type="int", default=1,
+            help="(Local Test Store) Number of processes used to scan the "
+                 "tests files. Use 0 for one process per CPU.")
 
     @classmethod
     def options_to_store_info(cls, options):
@@ -870,4 +1905,9 @@ class LocalTestStore(TestStore):
         return {
             "name": cls.name,
             "path": options.tests_path,
+            "import_state": options.import_state,
+            "import_jobs": options.import_jobs,
+            "changed_files": options.changed_files,
+            "include": options.tests_include,
+            "exclude": options.tests_exclude,
         }
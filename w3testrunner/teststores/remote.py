@@ -1,11 +1,20 @@
+from __future__ import with_statement
+
+import httplib
 import logging
-import urllib2
+import socket
+import threading
+import time
+import zlib
 try:
     import simplejson as json
 except ImportError:
     import json # Python >= 2.6
 
-from w3testrunner.teststores.common import TestStore, StoreException
+from w3testrunner.blobstore import get_result_blob_ids
+from w3testrunner.httppool import HTTPConnectionPool, RequestNotSent
+from w3testrunner.teststores.common import TestStore, StoreException, \
+                                           rebase_url
 
 log = logging.getLogger(__name__)
 
@@ -17,29 +26,118 @@ class RemoteTestStore(TestStore):
     DEFAULT_REMOTE_URL = "http://localhost:9999/"
     # Default number of tests to load per iteration.
     DEFAULT_COUNT = 50
+    # Default wall-clock duration in seconds targeted for a batch of tests.
+    DEFAULT_BATCH_DURATION = 300
+    # Bounds of the number of tests to load when it is computed from the
+    # batch duration.
+    MIN_COUNT = 1
+    MAX_COUNT = 2000
+    # Weight of the last saved batch in the average duration of the tests of
+    # a type.
+    DURATION_SMOOTHING = 0.5
+    # Default interval in seconds between the uploads of the results
+    # received during a batch.
+    DEFAULT_STREAM_INTERVAL = 10
+    # Number of times a request is sent before giving up, and delay in
+    # seconds before the first retry, doubled for each following one.
+    MAX_TRIES = 3
+    RETRY_DELAY = 0.5
+    # Request bodies smaller than this are not compressed.
+    COMPRESS_MIN_SIZE = 1024
     LOAD_PATH = "load/"
+    # Followed by the blob identifier.
+    BLOB_PATH = "blob/"
     SAVE_PATH = "save/"
 
-    PROTOCOL_VERSION = 1
+    # Version 2 added the partial saves, the blob uploads and the results
+    # referencing blobs by URL, and allowed gzip request bodies.
+    PROTOCOL_VERSION = 2
 
     def __init__(self, runner, store_info):
         super(RemoteTestStore, self).__init__(runner, store_info)
+        self.prefetch = store_info.get("prefetch", False)
+        # Average duration of the tests of each type.
+        self.type_durations = {}
+        # Number of tests of each type with a duration in the last saved
+        # batch.
+        self.type_counts = {}
+
+        self.stream_interval = store_info.get("stream_interval")
+        self.stream_lock = threading.Lock()
+        # Results received since the last upload.
+        self.pending_results = []
+        self.stream_thread = None
+        self.stream_stop_event = None
+        # Set while a save is waiting for the upload thread to stop.
+        self.stream_paused = False
+        self.last_metadata = {}
+        self.connections = HTTPConnectionPool(store_info["remote_url"])
+        self.blob_lock = threading.Lock()
+        self.uploaded_blob_ids = set()
 
     def _send_server(self, request, path):
-        urllib_request = urllib2.Request(self.store_info["remote_url"] + path)
         request.update({
             "protocol_version": self.PROTOCOL_VERSION,
             "username": self.store_info["username"],
             "token": self.store_info["token"],
         })
 
-        urllib_request.add_header("Content-Type", "application/json")
-        try:
-            response_body = urllib2.urlopen(urllib_request,
-                                            json.dumps(request)).read()
-        except urllib2.URLError, e:
+        body = json.dumps(request)
+        headers = {
+            "Content-Type": "application/json",
+        }
+        if (self.store_info.get("compress") and
+            len(body) >= self.COMPRESS_MIN_SIZE):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers["Content-Encoding"] = "gzip"
+        return self._post(path, body, headers)
+
+    def _post(self, path, body, headers):
+        """Send a POST request to the server and return the JSON response.
+
+        The load and save requests aren't idempotent, so the request is only
+        sent again if the server didn't get it, or answered that it is
+        temporarily unavailable.
+        """
+        headers["Accept-Encoding"] = "gzip"
+        error = None
+        for attempt in range(self.MAX_TRIES):
+            if attempt:
+                delay = self.RETRY_DELAY * 2 ** (attempt - 1)
+                log.warn("Error sending request to remote store (%s), "
+                         "retrying in %s seconds", error, delay)
+                time.sleep(delay)
+            try:
+                http_response, response_body = self.connections.request(
+                    "POST", path, body, headers)
+            except RequestNotSent, e:
+                error = e
+                continue
+            except (httplib.HTTPException, socket.error), e:
+                raise StoreException("Error sending request to remote store "
+                                     "at %s, not sent again as it may have "
+                                     "been handled (%s)" % (
+                                     self.store_info["remote_url"], e))
+            if http_response.status == httplib.SERVICE_UNAVAILABLE:
+                error = "HTTP status %s" % http_response.status
+                continue
+            break
+        else:
             raise StoreException("Can't connect to remote store at %s (%s)" % (
-                                 self.store_info["remote_url"], e))
+                                 self.store_info["remote_url"], error))
+        if http_response.status != 200:
+            raise StoreException("Error response from remote store at %s "
+                                 "(HTTP status %s)" % (
+                                 self.store_info["remote_url"],
+                                 http_response.status))
+
+        if http_response.getheader("Content-Encoding") == "gzip":
+            try:
+                response_body = zlib.decompress(response_body,
+                                                16 + zlib.MAX_WBITS)
+            except zlib.error, e:
+                raise StoreException("Can't decompress response: %s" % e)
 
         try:
             response = json.loads(response_body)
@@ -53,26 +151,203 @@ class RemoteTestStore(TestStore):
         return response
 
     def load(self, metadata):
+        return self.install(self.fetch(metadata))
+
+    def fetch(self, metadata):
+        self.last_metadata = metadata
         request = {
             "metadata": metadata,
             "types": self.store_info.get("types"),
-            "count": self.store_info.get("count"),
+            "count": self._get_count(),
         }
-        load_response = self._send_server(request, RemoteTestStore.LOAD_PATH)
+        return self._send_server(request, RemoteTestStore.LOAD_PATH)
+
+    def _get_count(self):
+        """Return the number of tests to load.
+
+        If a batch duration is set, the count is chosen so that running a
+        batch with the same mix of test types as the last saved one takes
+        that long, using the average duration measured for each type. The
+        tests of a batch are shared by the browser workers, so the count is
+        multiplied by their number. Until a batch is saved, the fixed count
+        is used.
+        """
+        batch_duration = self.store_info.get("batch_duration")
+        type_counts = self.type_counts
+        if not batch_duration or not type_counts:
+            return self.store_info.get("count")
+
+        total_duration = sum(self.type_durations[test_type] * count for
+                             (test_type, count) in type_counts.iteritems())
+        test_duration = total_duration / sum(type_counts.values())
+        count = int(batch_duration * len(self.runner.workers) /
+                    max(test_duration, 0.001))
+        return max(self.MIN_COUNT, min(self.MAX_COUNT, count))
 
+    def _update_durations(self, tests):
+        durations = {}
+        for test in tests:
+            if "duration" in test:
+                durations.setdefault(test["type"], []).append(test["duration"])
+        if not durations:
+            return
+
+        for test_type, values in durations.iteritems():
+            duration = sum(values) / len(values)
+            if test_type in self.type_durations:
+                duration = (self.DURATION_SMOOTHING * duration +
+                            (1 - self.DURATION_SMOOTHING) *
+                            self.type_durations[test_type])
+            self.type_durations[test_type] = duration
+        # Replaced after updating the durations, as fetch() may run at the
+        # same time in another thread.
+        self.type_counts = dict((test_type, len(values)) for
+                                (test_type, values) in durations.iteritems())
+
+    def install(self, load_response):
         if "proxy_mappings" in load_response:
+            server_url = self.runner.webapp.server_url
+            proxy_mappings = [[rebase_url(source, server_url), target] for
+                              (source, target) in
+                              load_response["proxy_mappings"]]
             self.runner.webapp.enable_remotetests(
-                load_response["proxy_mappings"], self.store_info["remote_url"])
+                proxy_mappings, self.store_info["remote_url"])
+
+        return self.rebase_test_urls(load_response["tests"])
+
+    def _upload_blob(self, blob_id, data):
+        # Blobs are sent as is, the authentication is in the headers.
+        headers = {
+            "Content-Type": "image/png",
+            "X-Protocol-Version": str(self.PROTOCOL_VERSION),
+            "X-Username": self.store_info["username"],
+            "X-Token": self.store_info["token"],
+        }
+        self._post(RemoteTestStore.BLOB_PATH + blob_id, data, headers)
+
+    def _upload_blobs(self, results):
+        """Upload the screenshots referenced by the given results.
+
+        Each blob is only uploaded once.
+        """
+        for result in results:
+            for blob_id in get_result_blob_ids(result):
+                # Held during the upload, so that the upload thread and a
+                # save don't both send the blob, and that a blob isn't
+                # considered as uploaded before it is on the server.
+                with self.blob_lock:
+                    if blob_id in self.uploaded_blob_ids:
+                        continue
+                    data = self.runner.webapp.blob_store.get(blob_id)
+                    if data is None:
+                        log.warn("Blob %s referenced by test %s is missing",
+                                 blob_id, result["testid"])
+                        continue
+                    self._upload_blob(blob_id, data)
+                    self.uploaded_blob_ids.add(blob_id)
+
+    def _make_result(self, test):
+        # The result dicts are shared with the Runner state snapshots, so
+        # they are copied before being modified.
+        result = dict(test.get("result", {}))
+        result["testid"] = test["id"]
+        return result
+
+    def result_added(self, test):
+        if not self.stream_interval:
+            return
+        with self.stream_lock:
+            self.pending_results.append(self._make_result(test))
+            self._start_streaming()
+
+    def _start_streaming(self):
+        # Called with stream_lock held.
+        if self.stream_thread or self.stream_paused:
+            return
+        self.stream_stop_event = threading.Event()
+        self.stream_thread = threading.Thread(target=self._stream,
+                                              args=(self.stream_stop_event,))
+        self.stream_thread.setDaemon(True)
+        self.stream_thread.start()
+
+    def _stop_streaming(self):
+        """Stop the upload thread and wait until the upload it may be doing
+        is finished. Results added in the meantime don't start it again
+        until stream_paused is cleared."""
+        with self.stream_lock:
+            self.stream_paused = True
+            thread, self.stream_thread = self.stream_thread, None
+            if thread:
+                self.stream_stop_event.set()
+        if thread:
+            thread.join()
+
+    def _stream(self, stop_event):
+        """Upload the pending results every stream_interval seconds, until
+        stop_event is set.
+
+        The uploads are save requests with a "partial" flag. The results of
+        a failed upload are sent again with the next one. Nothing is lost if
+        they can't be sent at all, as the save at the end of the batch sends
+        all the results.
+        """
+        try:
+            self._stream_loop(stop_event)
+        finally:
+            # Let the next result start a new thread if this one died.
+            with self.stream_lock:
+                if self.stream_stop_event is stop_event:
+                    self.stream_thread = None
+
+    def _stream_loop(self, stop_event):
+        while True:
+            stop_event.wait(self.stream_interval)
+            if stop_event.isSet():
+                return
+            with self.stream_lock:
+                results = self.pending_results
+                self.pending_results = []
+            if not results:
+                continue
+
+            log.debug("Uploading %s results", len(results))
+            request = {
+                "metadata": self.last_metadata,
+                "results": results,
+                "partial": True,
+            }
+            try:
+                self._upload_blobs(results)
+                self._send_server(request, RemoteTestStore.SAVE_PATH)
+            except Exception, e:
+                # Not only StoreException, the thread must keep running
+                # whatever the error.
+                log.warn("Can't upload the results, retrying later: %s", e)
+                with self.stream_lock:
+                    self.pending_results[:0] = results
+
+    def save(self, metadata, tests=None):
+        if tests is None:
+            tests = self.runner.tests
+        results = [self._make_result(test) for test in tests]
 
-        return load_response["tests"]
+        # The results of the batch which weren't uploaded yet are all sent
+        # now. The upload thread is stopped first, so that it doesn't send
+        # any of them after this save, for instance after a failed upload.
+        # It is started again for the results of the next batch.
+        self._stop_streaming()
+        testids = set(result["testid"] for result in results)
+        with self.stream_lock:
+            self.pending_results = [result for result in
+                                    self.pending_results if
+                                    not result["testid"] in testids]
+            self.stream_paused = False
+            if self.pending_results:
+                self._start_streaming()
 
-    def save(self, metadata):
-        results = []
-        for test in self.runner.tests:
-            result = test.get("result", {})
-            result["testid"] = test["id"]
-            results.append(result)
+        self._update_durations(tests)
 
+        self._upload_blobs(results)
         log.debug("Saving results: %s", results)
         request = {
             "metadata": metadata,
@@ -81,6 +356,10 @@ class RemoteTestStore(TestStore):
         self._send_server(request, RemoteTestStore.SAVE_PATH)
 
     def cleanup(self):
+        self._stop_streaming()
+        with self.stream_lock:
+            self.pending_results = []
+            self.stream_paused = False
         self.runner.webapp.disable_remotetests()
 
     @classmethod
@@ -95,7 +374,32 @@ class RemoteTestStore(TestStore):
                  "Only the test types in the list will be fetched.")
         parser.add_option("--filter-count", type="int",
             default=cls.DEFAULT_COUNT,
-            help="(Remote Test Store) Number of tests to fetch.")
+            help="(Remote Test Store) Number of tests to fetch. With "
+                 "--batch-duration, only used for the first batch.")
+        parser.add_option("--batch-duration", type="int",
+            default=cls.DEFAULT_BATCH_DURATION,
+            help="(Remote Test Store) Duration in seconds targeted for "
+                 "running a batch of tests. The number of tests to fetch is "
+                 "computed from the durations of the tests of each type in "
+                 "the previous batches. Set to 0 to always fetch "
+                 "--filter-count tests.")
+        parser.add_option("--stream-interval", type="int",
+            default=cls.DEFAULT_STREAM_INTERVAL,
+            help="(Remote Test Store) Interval in seconds between the "
+                 "uploads of the results received since the previous one, "
+                 "so that the results are saved before the end of a batch. "
+                 "Set to 0 to only save the results at the end of the "
+                 "batches.")
+        parser.add_option("--compress",
+            action="store_true", default=False,
+            help="(Remote Test Store) Gzip the requests sent to the remote "
+                 "store. The store server must support it.")
+        parser.add_option("--no-prefetch",
+            action="store_true", default=False,
+            help="(Remote Test Store) Fetch the next batch of tests only "
+                 "after saving the results of the current one and restart "
+                 "the browser between batches. By default, the next batch "
+                 "is fetched and the results saved while the tests run.")
         # TODO
         # --filter-path
         # --filter-testsuite
@@ -113,4 +417,8 @@ class RemoteTestStore(TestStore):
             "token": options.token,
             "types": options.filter_types,
             "count": options.filter_count,
+            "batch_duration": options.batch_duration,
+            "stream_interval": options.stream_interval,
+            "compress": options.compress,
+            "prefetch": not options.no_prefetch,
         }
@@ -0,0 +1,261 @@
+import array
+import itertools
+
+# Marks the properties that are not set on a test.
+_MISSING = object()
+
+class TestRow(object):
+    """Dict-like view of a test stored in a TestTable.
+
+    Reading and writing keys goes to the table, so all the views of the same
+    test share their values.
+    """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.table._get_value(self.index, key)
+
+    def __setitem__(self, key, value):
+        self.table._set_value(self.index, key, value)
+
+    def __delitem__(self, key):
+        self.table._del_value(self.index, key)
+
+    def __contains__(self, key):
+        try:
+            self.table._get_value(self.index, key)
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self.table._get_value(self.index, key)
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.table._get_keys(self.index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, TestRow):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.copy())
+
+class TestsById(object):
+    """Read-only mapping of test identifiers to the rows of a TestTable."""
+
+    def __init__(self, table):
+        self.table = table
+        self._indexes = {}
+
+    def _add(self, testid, index):
+        self._indexes[testid] = index
+
+    def __getitem__(self, testid):
+        return TestRow(self.table, self._indexes[testid])
+
+    def __contains__(self, testid):
+        return testid in self._indexes
+
+    def get(self, testid, default=None):
+        if not testid in self._indexes:
+            return default
+        return self[testid]
+
+    def __len__(self):
+        return len(self._indexes)
+
+class _TestColumns(object):
+    """Reading of the tests stored by column, shared by TestTable and
+    TestTableSnapshot."""
+
+    def _decode(self, prefix_index, value):
+        if prefix_index < 0:
+            return value
+        return self._prefixes[prefix_index] + value
+
+    def to_list(self):
+        """Return the tests as a list of dicts, for JSON serialization.
+
+        The dicts are built column by column, which is faster than copying
+        each TestRow.
+        """
+        tests = [{} for index in xrange(self._length)]
+        for name, (prefix_indexes, values) in self._columns.iteritems():
+            for test, prefix_index, value in itertools.izip(
+                tests, prefix_indexes, values):
+                if value is not _MISSING:
+                    test[name] = self._decode(prefix_index, value)
+        for index, extra in self._extra_values.iteritems():
+            tests[index].update(extra)
+        return tests
+
+class TestTableSnapshot(_TestColumns):
+    """Copy of the content of a TestTable, not affected by its later
+    changes.
+
+    Only the lists holding the columns are copied, the tests are converted
+    to dicts by to_list(). Taking a snapshot is cheap enough to be done
+    while holding a lock that the table changes are made under, and the
+    conversion done after releasing it.
+    """
+
+    def __init__(self, table):
+        self._length = table._length
+        self._prefixes = table._prefixes[:]
+        self._columns = dict((name, (prefix_indexes[:], values[:])) for
+                             (name, (prefix_indexes, values)) in
+                             table._columns.iteritems())
+        # The dicts of the other properties are replaced rather than
+        # modified by the table, so they can be shared.
+        self._extra_values = table._extra_values.copy()
+
+class TestTable(_TestColumns):
+    """Compact storage for a list of tests.
+
+    Tests are usually handled as dicts (that is what the stores return and
+    what is sent to the browser). With large test suites, having one dict per
+    test uses a lot of memory, so the properties listed in COLUMNS are stored
+    in one list per property instead, and indexing or iterating over the
+    table returns TestRow views that behave like dicts. Other properties
+    (such as the test result) are stored in a dict per test, only created
+    when needed.
+
+    String values are split after their last slash. The prefixes (URL
+    prefixes and directories, shared by many tests) are stored once, and the
+    remaining parts are interned, so that for instance the id, file and url
+    of a test share the same string.
+    """
+    COLUMNS = ("id", "full_id", "type", "url", "file",
+               # reftests
+               "equal", "expected", "failure_type", "url2", "file2")
+
+    def __init__(self, tests=()):
+        self._length = 0
+        self._prefixes = []
+        self._prefix_indexes = {}
+        self._strings = {}
+        # For each column, a (prefix_indexes, values) tuple. A prefix index
+        # of -1 means that the value is stored unmodified.
+        self._columns = dict((name, (array.array("i"), [])) for
+                             name in self.COLUMNS)
+        self._extra_values = {}
+        self.by_id = TestsById(self)
+        for test in tests:
+            self.append(test)
+
+    def _encode(self, value):
+        if not isinstance(value, basestring):
+            return -1, value
+        split = value.rfind("/") + 1
+        prefix, suffix = value[:split], value[split:]
+        prefix_index = self._prefix_indexes.get(prefix)
+        if prefix_index is None:
+            prefix_index = len(self._prefixes)
+            self._prefix_indexes[prefix] = prefix_index
+            self._prefixes.append(prefix)
+        return prefix_index, self._strings.setdefault(suffix, suffix)
+
+    def append(self, test):
+        """Append a test given as a dict (or any mapping)."""
+        index = self._length
+        for name, (prefix_indexes, values) in self._columns.iteritems():
+            prefix_index, value = self._encode(test.get(name, _MISSING))
+            prefix_indexes.append(prefix_index)
+            values.append(value)
+        extra = dict((k, v) for (k, v) in test.iteritems() if
+                     not k in self._columns)
+        if extra:
+            self._extra_values[index] = extra
+        self._length += 1
+
+        testid = test.get("id")
+        if testid is not None and not testid in self.by_id:
+            self.by_id._add(testid, index)
+
+    def _get_value(self, index, key):
+        if key in self._columns:
+            prefix_indexes, values = self._columns[key]
+            value = values[index]
+            if value is _MISSING:
+                raise KeyError(key)
+            return self._decode(prefix_indexes[index], value)
+        return self._extra_values.get(index, {})[key]
+
+    def _set_value(self, index, key, value):
+        if key in self._columns:
+            prefix_indexes, values = self._columns[key]
+            prefix_indexes[index], values[index] = self._encode(value)
+            return
+        # Copied, as the dict may be shared with a snapshot.
+        extra = dict(self._extra_values.get(index, {}))
+        extra[key] = value
+        self._extra_values[index] = extra
+
+    def _del_value(self, index, key):
+        if key in self._columns:
+            # Raises KeyError if the key is not set.
+            self._get_value(index, key)
+            self._set_value(index, key, _MISSING)
+            return
+        extra = dict(self._extra_values.get(index, {}))
+        del extra[key]
+        if extra:
+            self._extra_values[index] = extra
+        else:
+            self._extra_values.pop(index, None)
+
+    def _get_keys(self, index):
+        keys = [name for (name, (prefix_indexes, values)) in
+                self._columns.iteritems() if values[index] is not _MISSING]
+        keys.extend(self._extra_values.get(index, {}).keys())
+        return keys
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("test index out of range")
+        return TestRow(self, index)
+
+    def __iter__(self):
+        for index in xrange(self._length):
+            yield TestRow(self, index)
+
+    def snapshot(self):
+        """Return a TestTableSnapshot of the table."""
+        return TestTableSnapshot(self)
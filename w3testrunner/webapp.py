@@ -4,14 +4,17 @@ import base64
 import errno
 import httplib
 import logging
+import mimetypes
 import os
 import random
 import re
 import select
+import socket
 import subprocess
 import sys
 import threading
 import time
+import urllib
 import urllib2
 import urlparse
 try:
@@ -21,7 +24,9 @@ except ImportError:
 
 from lovely.jsonrpc import dispatcher, wsgi
 from paste.urlparser import StaticURLParser
-from paste.proxy import TransparentProxy
+from paste.fileapp import DataApp
+from paste.request import path_info_pop
+from paste.proxy import parse_headers, filtered_headers
 from paste.httpserver import WSGIHandler
 from paste.cgiapp import CGIApplication, CGIWriter, StdinReader, \
                          proc_communicate
@@ -29,6 +34,10 @@ import paste.httpserver
 from webob import Request
 from webob.headerdict import HeaderDict
 
+from w3testrunner.blobstore import BlobStore, blob_url, blob_id_from_url
+from w3testrunner.cgiworker import CGIWorkerPool
+from w3testrunner.filecache import FileCache
+from w3testrunner.httppool import HTTPConnectionPool
 from w3testrunner.imagecompare import ImageComparator, ImageCompareException
 from w3testrunner.teststores.common import StoreException
 
@@ -36,6 +45,10 @@ log = logging.getLogger(__name__)
 
 WEBAPP_HOST = "localhost"
 WEBAPP_PORT = 8888
+# Number of threads handling the requests.
+WEBAPP_WORKERS = 10
+# Maximum size in bytes of the test files kept in memory.
+TESTS_CACHE_SIZE = 32 * 1024 * 1024
 
 class RPC(object):
     def __init__(self, webapp):
@@ -44,6 +57,9 @@ class RPC(object):
 
         self.image_comparator = ImageComparator()
         self.screenshot1_id = -1
+        # The requests are handled in several threads, and there is only one
+        # screen to take screenshots of.
+        self.screenshot_lock = threading.RLock()
 
     def reset(self):
         self.runner.reset()
@@ -51,8 +67,8 @@ class RPC(object):
     def clear_results(self):
         self.runner.clear_results()
 
-    def get_state(self):
-        return self.runner.get_state()
+    def get_state(self, worker_id=None):
+        return self.runner.get_state(worker_id)
 
     def load_tests(self, store_info):
         success, message = True, ""
@@ -70,6 +86,10 @@ class RPC(object):
         self.runner.set_status(status, message)
 
     def take_screenshot1(self):
+        with self.screenshot_lock:
+            return self._take_screenshot1()
+
+    def _take_screenshot1(self):
         try:
             self.image_comparator.grab_image1()
         except ImageCompareException, e:
@@ -87,6 +107,11 @@ class RPC(object):
         }
 
     def take_screenshot2_and_compare(self, screenshot1_id, save_images):
+        with self.screenshot_lock:
+            return self._take_screenshot2_and_compare(screenshot1_id,
+                                                      save_images)
+
+    def _take_screenshot2_and_compare(self, screenshot1_id, save_images):
         if screenshot1_id != self.screenshot1_id:
             raise Exception("Unknown screenshot id to compare with")
         try:
@@ -106,7 +131,10 @@ class RPC(object):
             (save_images == "if_pixel_diff_gt_0" and pixel_diff > 0) or
             (save_images == "if_pixel_diff_eq_0" and pixel_diff == 0)):
             log.debug("Saving images")
-            images = self.image_comparator.save_images()
+            # The images are referenced by URL in the results, instead of
+            # being sent back and forth as data URLs.
+            for name, data in self.image_comparator.save_images().iteritems():
+                images[name] = blob_url(self.webapp.blob_store.put(data))
 
         self.image_comparator.reset()
         ret = {
@@ -116,6 +144,9 @@ class RPC(object):
         ret.update(images)
         return ret
 
+    def next_test(self, worker_id=None):
+        return self.runner.next_test(worker_id)
+
     def test_started(self, testid):
         self.runner.test_started(testid)
 
@@ -180,22 +211,80 @@ class MimeAndHeadersUpdaterMiddleware(object):
         "svg": "image/svg+xml",
     }
 
+    # Number of seconds during which the index of a directory is used without
+    # checking whether the directory was modified.
+    INDEX_CHECK_INTERVAL = 1
+
+    class DirectoryIndex(object):
+        """Names of the files of a directory having a headers file."""
+
+        def __init__(self, mtime, names):
+            self.mtime = mtime
+            self.check_time = time.time()
+            # Maps a file name to None or to the (mtime, status, headers)
+            # parsed from its headers file.
+            self.headers = dict((name, None) for name in names)
+
     def __init__(self, application, tests_path=None):
         self.application = application
         self.tests_path = tests_path
+        self.lock = threading.Lock()
+        # Maps a directory path to its DirectoryIndex.
+        self.directory_indexes = {}
+
+    def _get_directory_index(self, directory):
+        with self.lock:
+            index = self.directory_indexes.get(directory)
+            if (index and
+                time.time() - index.check_time < self.INDEX_CHECK_INTERVAL):
+                return index
+
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return None
+        if index and index.mtime == mtime:
+            index.check_time = time.time()
+            return index
+
+        try:
+            names = set(os.listdir(directory))
+        except OSError:
+            return None
+        suffix_len = len(self.HEADERS_FILE_SUFFIX)
+        index = self.DirectoryIndex(mtime, [
+            name[:-suffix_len] for name in names
+            if name.endswith(self.HEADERS_FILE_SUFFIX) and
+               name[:-suffix_len] in names and
+               os.path.isfile(os.path.join(directory, name[:-suffix_len]))])
+        with self.lock:
+            self.directory_indexes[directory] = index
+        return index
 
     def _maybe_parse_headers_file(self, path_info):
         if not self.tests_path:
             return None, {}
         path_info = path_info.lstrip("/")
         target = os.path.normpath(os.path.join(self.tests_path, path_info))
-        if not os.path.isfile(target):
+        directory, name = os.path.split(target)
+        index = self._get_directory_index(directory)
+        if not index or not name in index.headers:
             return None, {}
 
         headers_file = target + self.HEADERS_FILE_SUFFIX
-        if not os.path.isfile(headers_file):
+        try:
+            mtime = os.stat(headers_file).st_mtime
+        except OSError:
             return None, {}
+        parsed = index.headers[name]
+        if parsed and parsed[0] == mtime:
+            return parsed[1], parsed[2]
 
+        status, headers = self._parse_headers_file(headers_file)
+        index.headers[name] = (mtime, status, headers)
+        return status, headers
+
+    def _parse_headers_file(self, headers_file):
         status = None
         headers = {}
         with open(headers_file) as f:
@@ -238,15 +327,114 @@ class MimeAndHeadersUpdaterMiddleware(object):
 
         return self.application(environ, start_mime_update)
 
+class CachedFileApp(DataApp):
+    """Serve a file of a FileCache.
+
+    The ETag is computed from the file content, and a gzip compressed variant
+    is sent to the clients accepting it if the file is textual.
+    """
+
+    COMPRESSIBLE_TYPES = ("application/javascript", "application/json",
+                          "application/x-javascript", "application/xml",
+                          "application/xhtml+xml", "image/svg+xml")
+
+    def __init__(self, file_cache, cached_file, use_gzip=True):
+        self.file_cache = file_cache
+        self.cached_file = cached_file
+        content_type = mimetypes.guess_type(cached_file.path)[0]
+        self.compressible = use_gzip and bool(content_type) and (
+            content_type.startswith("text/") or
+            content_type in self.COMPRESSIBLE_TYPES)
+        kwargs = {}
+        if content_type:
+            kwargs["content_type"] = content_type
+        DataApp.__init__(self, None, **kwargs)
+        self.etag = cached_file.etag
+        self.set_content(cached_file.data, cached_file.mtime)
+
+    def calculate_etag(self):
+        return self.etag
+
+    def get(self, environ, start_response):
+        if self.compressible:
+            self.headers.append(("Vary", "Accept-Encoding"))
+            accept_encoding = environ.get("HTTP_ACCEPT_ENCODING", "")
+            gzip_data = "gzip" in accept_encoding and \
+                        self.file_cache.get_gzip_data(self.cached_file)
+            if gzip_data:
+                self.headers.append(("Content-Encoding", "gzip"))
+                # Each variant needs its own ETag.
+                self.etag = self.etag[:-1] + '-gzip"'
+                self.set_content(gzip_data, self.cached_file.mtime)
+        body = DataApp.get(self, environ, start_response)
+        if environ["REQUEST_METHOD"].upper() == "HEAD":
+            return [""]
+        return body
+
+class CachingStaticURLParser(StaticURLParser):
+    """StaticURLParser that serves the files from a FileCache.
+
+    The files that can't be cached (because they are too large) are served
+    from disk by StaticURLParser.
+    """
+
+    def __init__(self, directory, file_cache, root_directory=None,
+                 cache_max_age=None, use_gzip=True):
+        StaticURLParser.__init__(self, directory, root_directory,
+                                 cache_max_age)
+        self.file_cache = file_cache
+        self.use_gzip = use_gzip
+
+    def __call__(self, environ, start_response):
+        # Adapted from StaticURLParser.__call__, looking up the file in the
+        # cache before touching the disk.
+        path_info = environ.get("PATH_INFO", "")
+        if not path_info:
+            return self.add_slash(environ, start_response)
+        if path_info == "/":
+            filename = "index.html"
+        else:
+            filename = path_info_pop(environ)
+        full = self.normpath(os.path.join(self.directory, filename))
+        if not full.startswith(self.root_directory):
+            # Out of bounds
+            return self.not_found(environ, start_response)
+
+        cached_file = self.file_cache.get(full)
+        if not cached_file:
+            if not os.path.exists(full):
+                return self.not_found(environ, start_response)
+            if os.path.isdir(full):
+                return self.__class__(full, self.file_cache,
+                                      root_directory=self.root_directory,
+                                      cache_max_age=self.cache_max_age,
+                                      use_gzip=self.use_gzip)(environ,
+                                                              start_response)
+        if environ.get("PATH_INFO") and environ.get("PATH_INFO") != "/":
+            return self.error_extra_path(environ, start_response)
+
+        if cached_file:
+            app = CachedFileApp(self.file_cache, cached_file, self.use_gzip)
+        else:
+            app = self.make_app(full)
+        if self.cache_max_age:
+            app.cache_control(max_age=self.cache_max_age)
+        return app(environ, start_response)
+
 class PythonCGIApplication(CGIApplication):
     """
     Override CGIApplication to execute CGI scripts with the current Python
-    interpreter.
+    interpreter, using a process of worker_pool if given.
 
     (and apply the patch from
      http://trac.pythonpaste.org/pythonpaste/ticket/382).
     """
 
+    def __init__(self, global_conf, script, path=None, worker_pool=None,
+                 **kwargs):
+        CGIApplication.__init__(self, global_conf, script, path, **kwargs)
+        self.worker_pool = worker_pool
+
     def __call__(self, environ, start_response):
         if 'REQUEST_URI' not in environ:
             environ['REQUEST_URI'] = (
@@ -271,18 +459,22 @@ class PythonCGIApplication(CGIApplication):
         # absolute and tests fail.
         self.script = os.path.abspath(self.script)
         cgi_environ['SCRIPT_FILENAME'] = self.script
-        proc = subprocess.Popen(
-            # Begin Paste modification.
-            # The -u option is used prevent Python replacing \n to \r\n when
-            # writing to sys.stdout on Windows.
-            [sys.executable, '-u', self.script],
-            # End Paste modification.
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=cgi_environ,
-            cwd=os.path.dirname(self.script),
-            )
+        # Begin Paste modification.
+        if self.worker_pool:
+            proc = self.worker_pool.run(self.script, cgi_environ,
+                                        os.path.dirname(self.script))
+        else:
+            proc = subprocess.Popen(
+                # The -u option is used prevent Python replacing \n to \r\n
+                # when writing to sys.stdout on Windows.
+                [sys.executable, '-u', self.script],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=cgi_environ,
+                cwd=os.path.dirname(self.script),
+                )
+        # End Paste modification.
         writer = CGIWriter(environ, start_response)
         if select and sys.platform != 'win32':
             proc_communicate(
@@ -295,28 +487,148 @@ class PythonCGIApplication(CGIApplication):
             if stderr:
                 environ['wsgi.errors'].write(stderr)
             writer.write(stdout)
+        if self.worker_pool:
+            self.worker_pool.fill()
         if not writer.headers_finished:
             start_response(writer.status, writer.headers)
         return []
 
+class PrefixTrie(object):
+    """Map string prefixes to values, looking up the longest prefix of a
+    string in a time proportional to its length."""
+
+    def __init__(self):
+        # Each node is a dict mapping a character to the child node. The
+        # value of a node is stored under the None key.
+        self.root = {}
+
+    def add(self, prefix, value):
+        """Add a prefix, unless it was already added."""
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node.setdefault(None, (prefix, value))
+
+    def find(self, s):
+        """Return the (prefix, value) of the longest prefix of s, or None."""
+        node = self.root
+        match = node.get(None)
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
 class ProxyRemappingMiddleware(object):
     def __init__(self, application, paths_mappings):
+        """paths_mappings is a list of (source_path, target_path). The
+        longest source_path matching the request path is used."""
         self.application = application
-        self.paths_mappings = paths_mappings
+        self.paths_mappings = PrefixTrie()
+        for source_path, target_path in paths_mappings:
+            self.paths_mappings.add(source_path, target_path)
 
     def __call__(self, environ, start_response):
         path_info = environ["PATH_INFO"]
-        for source_path, target_path in self.paths_mappings:
-            if not path_info.startswith(source_path):
-                continue
-            environ["PATH_INFO"] = path_info.replace(source_path,
-                                                     target_path, 1)
+        match = self.paths_mappings.find(path_info)
+        if match:
+            source_path, target_path = match
+            environ["PATH_INFO"] = target_path + path_info[len(source_path):]
             log.debug("Found mapping %s => %s", source_path, target_path)
             return self.application(environ, start_response)
 
         start_response("404 Not found", [("Content-type", "text/plain")])
         return "Not found"
 
+class StreamingProxy(object):
+    """Proxy sending the requests to a given host, like
+    paste.proxy.TransparentProxy with force_host.
+
+    The connections to the host are kept alive between requests, and the
+    response bodies are sent while they are received.
+    """
+    # Size of the chunks of response body sent to the client.
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, host):
+        self.host = host
+        self.connections = HTTPConnectionPool("http://%s/" % host)
+
+    def __call__(self, environ, start_response):
+        if "HTTP_HOST" not in environ:
+            raise ValueError("WSGI environ must contain an HTTP_HOST key")
+        headers = {}
+        for key, value in environ.iteritems():
+            if key.startswith("HTTP_"):
+                key = key[5:].lower().replace("_", "-")
+                if not key in filtered_headers:
+                    headers[key] = value
+        if "REMOTE_ADDR" in environ and "HTTP_X_FORWARDED_FOR" not in environ:
+            headers["x-forwarded-for"] = environ["REMOTE_ADDR"]
+        if environ.get("CONTENT_TYPE"):
+            headers["content-type"] = environ["CONTENT_TYPE"]
+        body = ""
+        if environ.get("CONTENT_LENGTH"):
+            body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+
+        path = urllib.quote(environ.get("SCRIPT_NAME", "") +
+                            environ.get("PATH_INFO", ""))
+        if "QUERY_STRING" in environ:
+            path += "?" + environ["QUERY_STRING"]
+
+        while True:
+            connection, reused = self.connections.acquire()
+            try:
+                connection.request(environ["REQUEST_METHOD"], path, body,
+                                   headers)
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # The server may have closed an idle connection.
+                if not reused:
+                    raise
+
+        start_response("%s %s" % (response.status, response.reason),
+                       parse_headers(response.msg))
+        return ProxiedBody(self.connections, connection, response,
+                           self.BLOCK_SIZE)
+
+class ProxiedBody(object):
+    """Iterable over the body of a proxied response, read by blocks.
+
+    The connection goes back to the pool once the body is read entirely.
+    It is closed if the server closes the iterable before, which can happen
+    before its first block is read.
+    """
+
+    def __init__(self, connections, connection, response, block_size):
+        self.connections = connections
+        self.connection = connection
+        self.response = response
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.connection:
+            raise StopIteration
+        data = self.response.read(self.block_size)
+        if not data:
+            connection, self.connection = self.connection, None
+            self.connections.release(connection, self.response)
+            raise StopIteration
+        return data
+
+    def close(self):
+        # The connection can't be reused if the client went away before the
+        # end of the body.
+        connection, self.connection = self.connection, None
+        if connection:
+            connection.close()
+
 class PortCheckerMixin(object):
     server_host = "localhost"
     server_port = -1
@@ -339,15 +651,25 @@ class PortCheckerMixin(object):
                 return False
         return True
 
-    def check_free_port(self):
-        for i in range(5):
-            if not self._can_connect("/stop"):
-                break
-            log.info("Server already running, trying to stop it...")
-            time.sleep(2)
-        else:
-            raise Exception("Something is listening on port %s, can't start "
-                            " the server." % self.server_port)
+    def check_port_available(self):
+        """Raise an Exception if the port can't be bound, because another
+        server (such as another runner) is listening on it. That server is
+        left running."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Same option as the server, so that a port in TIME_WAIT is usable.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            try:
+                sock.bind(("", self.server_port))
+            except socket.error, e:
+                if e.args[0] != errno.EADDRINUSE:
+                    raise
+                raise Exception("Port %s is already in use, another runner "
+                                "may be running. Use another port, or port 0 "
+                                "to let the system choose a free one." %
+                                self.server_port)
+        finally:
+            sock.close()
 
     def check_server_started(self):
         for i in range(5):
@@ -359,17 +681,26 @@ class PortCheckerMixin(object):
                             "startup" % self.server_port)
 
 class WebApp(PortCheckerMixin):
-    def __init__(self, runner):
+    def __init__(self, runner, host=WEBAPP_HOST, port=WEBAPP_PORT,
+                 workers=WEBAPP_WORKERS):
+        """Start serving on the given port, or on a port chosen by the
+        system if port is 0. host is the name used in the URLs of the
+        webapp. The requests are handled by a pool of worker threads."""
         self.runner = runner
         self.image_store = {}
+        self.image_store_lock = threading.Lock()
         self.image_store_last_index = -1
+        self.blob_store = BlobStore()
         self.running = False
 
         thisdir = os.path.dirname(os.path.abspath(__file__))
 
+        # The harness files are kept in memory for the life of the runner.
+        self.resources_cache = FileCache(revalidate=False)
         self.resourcesapp = MimeAndHeadersUpdaterMiddleware(
-            StaticURLParser(os.path.join(thisdir, "resources"),
-                            cache_max_age=60))
+            CachingStaticURLParser(os.path.join(thisdir, "resources"),
+                                   self.resources_cache, cache_max_age=60))
+        self.tests_cache = FileCache(TESTS_CACHE_SIZE)
 
         self.rpc = RPC(self)
         rpcdispatcher = dispatcher.JSONRPCDispatcher(self.rpc, json_impl=json)
@@ -383,45 +714,68 @@ class WebApp(PortCheckerMixin):
         self.tests_path = None
         self.localtests_app = None
         self.remotetests_app = None
+        self.cgi_worker_pool = CGIWorkerPool()
 
-        self.server_host = WEBAPP_HOST
-        self.server_port = WEBAPP_PORT
-        self.check_free_port()
-
-        threading.Thread(target=self._run_server).start()
-
-        self.check_server_started()
-        self.runner.ua_string = None
+        self.server_host = host
+        self.server_port = port
+        if port:
+            self.check_port_available()
 
-    def _run_server(self):
         # NOTE: wsgiref.simple_server.make_server raises
         # "Hop-by-hop headers not allowed" when using the
-        # paste.proxy.TransparentProxy application. There's no issue with
-        # paste.httpserver
-        #server = simple_server.make_server(WEBAPP_HOST, WEBAPP_PORT, self)
+        # paste.proxy.TransparentProxy application (and StreamingProxy).
+        # There's no issue with paste.httpserver
+        #server = simple_server.make_server(host, port, self)
 
         # Reduce some paste server noise
         logging.getLogger('paste').setLevel(logging.INFO)
-        server = paste.httpserver.serve(self, host="%s:%s" % ("", WEBAPP_PORT),
-                                        start_loop=False)
+        # The server is bound here so that the port chosen by the system is
+        # known before anything uses the webapp URL. The requests are
+        # accepted in _run_server() and handled by the threads of the pool,
+        # so that a slow request (such as a proxied test resource) doesn't
+        # delay the RPC calls of the test harness.
+        self.server = paste.httpserver.serve(self, host="%s:%s" % ("", port),
+                                             start_loop=False,
+                                             use_threadpool=True,
+                                             threadpool_workers=workers,
+                                             daemon_threads=True)
+        self.server_port = self.server.server_address[1]
+        self.server_url = "http://%s:%s/" % (self.server_host,
+                                             self.server_port)
 
         self.running = True
-        log.debug("Serving on http://%s:%s" % (WEBAPP_HOST, WEBAPP_PORT))
+        self.server_thread = threading.Thread(target=self._run_server)
+        self.server_thread.start()
+
+        self.check_server_started()
+        self.runner.ua_string = None
+
+    def stop(self):
+        """Stop the server and wait until its port is closed."""
+        self.running = False
+        if self.server_thread is not threading.currentThread():
+            self.server_thread.join()
+
+    def _run_server(self):
+        log.debug("Serving on %s" % self.server_url)
 
         while self.running:
             #log.debug("Handling request")
-            server.handle_request()
-        server.server_close()
+            self.server.handle_request()
+        self.server.server_close()
+        self.cgi_worker_pool.close()
         log.debug("Web Server stopped")
 
     def enable_localtests(self, tests_path):
         self.tests_path = tests_path
         self.localtests_app = MimeAndHeadersUpdaterMiddleware(
-            StaticURLParser(tests_path, cache_max_age=60), tests_path)
+            CachingStaticURLParser(tests_path, self.tests_cache,
+                                   cache_max_age=60), tests_path)
 
     def disable_localtests(self):
         self.tests_path = None
         self.localtests_app = None
+        self.tests_cache.clear()
 
     def enable_remotetests(self, proxy_mappings, default_target_url):
         """Set up a proxy to reach remote tests through another host.
@@ -434,7 +788,7 @@ class WebApp(PortCheckerMixin):
         Limitations:
 
         The source host and port must be the same as the Web Application
-        (localhost:8888).
+        (self.server_host and self.server_port).
         The target_url hostname and port must match the ones in the
         default_target_url argument, or not be specified.
         """
@@ -447,8 +801,8 @@ class WebApp(PortCheckerMixin):
         for (source, target) in proxy_mappings:
             source_parseresult = urlparse.urlparse(source)
             assert source_parseresult.scheme == "http"
-            assert source_parseresult.hostname == WEBAPP_HOST
-            assert source_parseresult.port == WEBAPP_PORT
+            assert source_parseresult.hostname == self.server_host
+            assert source_parseresult.port == self.server_port
             target_parseresult = urlparse.urlparse(target)
 
             assert target_parseresult.scheme in ("", "http")
@@ -460,7 +814,7 @@ class WebApp(PortCheckerMixin):
                                   target_parseresult.path))
 
         self.remotetests_app = ProxyRemappingMiddleware(
-            TransparentProxy(force_host=target_netloc), path_mappings)
+            StreamingProxy(target_netloc), path_mappings)
 
     def disable_remotetests(self):
         self.remotetests_app = None
@@ -539,19 +893,21 @@ class WebApp(PortCheckerMixin):
             if not data.startswith("\x89PNG"):
                 return return_500("Bad image. Should be PNG")
 
-            self.image_store_last_index += 1
-            self.image_store[self.image_store_last_index] = data
+            with self.image_store_lock:
+                self.image_store_last_index += 1
+                index = self.image_store_last_index
+                self.image_store[index] = data
 
-            MAX_IMAGES = 5
-            trim_index_start = self.image_store_last_index - MAX_IMAGES
-            while True:
-                if not trim_index_start in self.image_store:
-                    break
-                del self.image_store[trim_index_start]
-                trim_index_start -= 1
+                MAX_IMAGES = 5
+                trim_index_start = index - MAX_IMAGES
+                while True:
+                    if not trim_index_start in self.image_store:
+                        break
+                    del self.image_store[trim_index_start]
+                    trim_index_start -= 1
 
             start_response("200 OK", [("Content-type", "text/plain")])
-            return str(self.image_store_last_index)
+            return str(index)
 
         if req.path_info_peek() == "get":
             req.path_info_pop()
@@ -565,6 +921,17 @@ class WebApp(PortCheckerMixin):
             start_response("200 OK", [("Content-type", "image/png")])
             return self.image_store[index]
 
+    def _handle_blobs(self, req, start_response):
+        blob_id = blob_id_from_url(req.path_info)
+        data = blob_id and self.blob_store.get(blob_id)
+        if not data:
+            start_response("404 Not found", [("Content-type", "text/plain")])
+            return "Not found"
+        # Blobs never change, as they are named after their content.
+        start_response("200 OK", [("Content-type", "image/png"),
+                                  ("Cache-Control", "max-age=31536000")])
+        return data
+
     def __call__(self, environ, start_response):
         req = Request(environ)
 
@@ -580,12 +947,12 @@ class WebApp(PortCheckerMixin):
                            [("Content-type", "text/plain")])
             return "Error: The Runner is not running"
 
-        if not self.runner.ua_string:
-            self.runner.ua_string = req.user_agent
+        # The runner page is loaded with the identifier of the browser
+        # worker in its query string.
+        ua_matches = self.runner.match_user_agent(req.user_agent,
+                                                  req.GET.get("worker"))
 
-        if (not self.runner.options.nouacheck and
-            self.runner.ua_string and
-            self.runner.ua_string != req.user_agent):
+        if not self.runner.options.nouacheck and not ua_matches:
             start_response("500 Internal Server Error",
                            [("Content-type", "text/plain")])
             return (("The server received a request from a different user "
@@ -597,6 +964,9 @@ class WebApp(PortCheckerMixin):
         if req.path_info_peek() == "imagestore":
             return self._handle_image_store(req, start_response)
 
+        if req.path_info_peek() == "blobs":
+            return self._handle_blobs(req, start_response)
+
         if req.path_info_peek() == "report":
             return self._create_report(environ, start_response)
 
@@ -615,7 +985,9 @@ class WebApp(PortCheckerMixin):
 
         if req.path_info.endswith(".py") and self.tests_path:
             script = req.path_info.lstrip("/")
-            cgiapp = PythonCGIApplication({}, script=script, path=[self.tests_path])
+            cgiapp = PythonCGIApplication({}, script=script,
+                                          path=[self.tests_path],
+                                          worker_pool=self.cgi_worker_pool)
             return cgiapp(environ, start_response)
 
         if self.localtests_app: